@@ -0,0 +1,428 @@
+import datetime
+import fnmatch
+import os
+import shutil
+import threading
+import typing as t
+from dataclasses import dataclass
+
+from duckingit._utils import (
+    create_conn_with_httpfs_loaded,
+    create_hash_string,
+    scan_source_for_versions,
+)
+
+if t.TYPE_CHECKING:
+    from duckingit._planner import Task
+    from duckingit.providers.provider import Provider
+
+CATALOG_SCHEMA = """
+    subquery_hashed VARCHAR,
+    location VARCHAR,
+    bytes BIGINT,
+    created_at TIMESTAMP,
+    fingerprint VARCHAR,
+    accessed_at TIMESTAMP
+"""
+
+# Output accessed lately is never evicted, as it may be about to be read, e.g. the output of
+# a plan that has just been executed, or output another process has just found in the catalog
+# and marked as accessed, see `CacheCatalog.access`
+MIN_IDLE_SECONDS = 300
+
+
+@dataclass
+class CacheEntry:
+    subquery_hashed: str
+    location: str
+    bytes: int | None  # None until the output is measured on eviction, see `CacheCatalog.evict`
+    created_at: datetime.datetime
+    fingerprint: str
+    accessed_at: datetime.datetime
+
+
+class CacheCatalog:
+    """A catalog of the output of tasks cached at a prefix
+
+    The catalog maps the location of the output of each task to the hash of its subquery, and
+    the size, creation time and input fingerprint of the output, see `Task.fingerprint`. The
+    size is measured only once it's needed, i.e. when evicting by a budget of bytes. The
+    fingerprint holds the versions of the files scanned, i.e. their size and time of last
+    modification, thus cached output is valid until any of its input changes, see
+    `fingerprint`. It's stored as a parquet file at the prefix, e.g.
+    s3://BUCKET_NAME/.cache/duckingit/catalog.parquet, such that identical tasks of any
+    session or process are skipped. Entries added are merged with the stored catalog on
+    `save`, and entries reused are marked as accessed in the stored catalog right away on
+    `access`, where the last writer wins, i.e. concurrent writers can at worst lose entries
+    and thereby recompute their tasks. Entries evicted in the meantime are never added back.
+
+    Attributes:
+        path, str: The prefix of the cached output, where the catalog is stored
+
+    Methods:
+        fingerprint: Adds the versions of the files scanned by tasks to their fingerprint
+        lookup: Returns the entry of a task if its cached output is still valid
+        access: Marks the entries of output about to be reused as accessed
+        exists: Tells which locations the output is still stored at
+        add: Adds the output of a task that has finished
+        save: Stores the entries added along with the entries of the stored catalog
+        evict: Removes the entries beyond a budget of bytes and age from the stored catalog
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path.rstrip("/")
+
+        self._entries: dict[str, CacheEntry] | None = None
+        self._added: dict[str, CacheEntry] = {}
+
+    @property
+    def location(self) -> str:
+        return f"{self.path}/catalog.parquet"
+
+    @property
+    def entries(self) -> dict[str, CacheEntry]:
+        """Returns the entries of the catalog by the location of their output"""
+        if self._entries is None:
+            self._entries = self.load()
+        return self._entries
+
+    def load(self) -> dict[str, CacheEntry]:
+        """Reads the entries of the stored catalog"""
+        # The catalog is rewritten, thus it's read without the caches of the shared connection
+        conn = create_conn_with_httpfs_loaded()
+        if not conn.sql(f"SELECT file FROM GLOB('{self.location}')").fetchall():
+            return {}
+
+        rows = conn.sql(f"SELECT * FROM READ_PARQUET('{self.location}')").fetchall()
+        return {row[1]: CacheEntry(*row) for row in rows}
+
+    def versions(self, paths: list[str]) -> dict[str, str]:
+        """Returns the version of each file at the paths, see `scan_source_for_versions`"""
+        return dict(scan_source_for_versions(source=str(paths)))
+
+    def fingerprint(self, tasks: t.Iterable["Task"]) -> None:
+        """Adds the versions of the files scanned by each task to its fingerprint
+
+        The versions of the files of all tasks are listed at once. A task scanning prefixes,
+        e.g. of JSON or CSV files, gets the versions of all files of its prefixes.
+
+        Args:
+            tasks, Iterable[Task]: The tasks to fingerprint, whose files are set
+        """
+        tasks = [task for task in tasks if task.files]
+        if len(tasks) == 0:
+            return
+
+        versions = self.versions(sorted(set(path for task in tasks for path in task.files)))
+        for task in tasks:
+            scanned = []
+            for path in task.files:
+                if path in versions:
+                    scanned.append((path, versions[path]))
+                else:
+                    scanned.extend((f, versions[f]) for f in fnmatch.filter(versions, path))
+            task.fingerprint = create_hash_string(task.fingerprint + repr(sorted(scanned)))
+
+    def lookup(self, task: "Task", key: str, max_age_seconds: float) -> CacheEntry | None:
+        """Returns the entry of the cached output of a task, if it's still valid
+
+        Args:
+            task, Task: The task to look up
+            key, str: The key the output of the task is expected at, see `Task.key`
+            max_age_seconds, float: The age of an entry before it has expired, or 0 if entries
+                never expire
+
+        Returns:
+            The entry if the output is stored at the key, the input of the task is unchanged
+            and the entry hasn't expired, otherwise None
+        """
+        entry = self.entries.get(key)
+        if (
+            entry is None
+            or entry.subquery_hashed != task.subquery_hashed
+            or entry.fingerprint != task.fingerprint
+        ):
+            return None
+
+        now = datetime.datetime.now()
+        if max_age_seconds and (now - entry.created_at).total_seconds() > max_age_seconds:
+            return None
+
+        return entry
+
+    def access(self, entries: list[CacheEntry]) -> list[CacheEntry]:
+        """Marks the entries of output about to be reused as accessed in the stored catalog,
+        such that a vacuum of any process keeps the output, see `MIN_IDLE_SECONDS`
+
+        Args:
+            entries, list[CacheEntry]: The entries found by `lookup`
+
+        Returns:
+            The entries that are still in the stored catalog, i.e. not evicted in the meantime
+        """
+        if len(entries) == 0:
+            return []
+
+        now = datetime.datetime.now()
+        stored = self.load()
+
+        accessed = [stored[entry.location] for entry in entries if entry.location in stored]
+        for entry in accessed:
+            entry.accessed_at = now
+        if accessed:
+            self.write(list(stored.values()))
+
+        self._entries = {**stored, **self._added}
+        return accessed
+
+    def add(self, task: "Task", key: str, created_at: datetime.datetime) -> None:
+        """Adds the output of a task at a key of the prefix of the catalog"""
+        if not key.startswith(f"{self.path}/"):
+            return  # Output stored elsewhere isn't managed by the catalog
+
+        entry = CacheEntry(
+            subquery_hashed=task.subquery_hashed,
+            location=key,
+            bytes=None,
+            created_at=created_at,
+            fingerprint=task.fingerprint,
+            accessed_at=created_at,
+        )
+        self._added[key] = self.entries[key] = entry
+
+    def exists(self, locations: list[str]) -> t.Set[str]:
+        """Returns the locations the output is still stored at, e.g. unless it's been deleted
+        by anything but the catalog"""
+        if len(locations) == 0:
+            return set()
+
+        globs = [
+            location if location.endswith(".parquet") else f"{location}/*.parquet"
+            for location in locations
+        ]
+        conn = create_conn_with_httpfs_loaded()
+        files = set(row[0] for row in conn.sql(f"SELECT file FROM GLOB({globs})").fetchall())
+        return set(
+            location
+            for location, glob in zip(locations, globs)
+            if location in files or (glob != location and any(fnmatch.filter(files, glob)))
+        )
+
+    def measure(self, locations: list[str]) -> dict[str, int]:
+        """Returns the compressed size in bytes of the output at each location, i.e. of a
+        parquet file or a directory of a parquet file per partition"""
+        sources = [
+            location if location.endswith(".parquet") else f"{location}/*.parquet"
+            for location in locations
+        ]
+        conn = create_conn_with_httpfs_loaded()
+        rows = conn.sql(
+            f"SELECT file_name, SUM(total_compressed_size) FROM PARQUET_METADATA({sources}) "
+            "GROUP BY file_name"
+        ).fetchall()
+
+        sizes = dict.fromkeys(locations, 0)
+        for file, size in rows:
+            location = file if file in sizes else file.rsplit("/", 1)[0]
+            sizes[location] = sizes.get(location, 0) + size
+        return sizes
+
+    def save(self) -> None:
+        """Stores the entries added along with the entries of the stored catalog, which may
+        have been added to, accessed or evicted by others in the meantime"""
+        if not self._added:
+            return
+
+        entries = {**self.load(), **self._added}
+        self.write(list(entries.values()))
+
+        self._entries = entries
+        self._added = {}
+
+    def evict(
+        self, max_bytes: int = 0, max_age_seconds: int = 0, keep: t.Collection[str] = ()
+    ) -> list[CacheEntry]:
+        """Removes the least recently used entries beyond a budget from the stored catalog
+
+        Entries not accessed for longer than the maximum age are evicted first, and then the
+        least recently used entries until the cached output fits the maximum number of
+        bytes. Entries accessed in the last `MIN_IDLE_SECONDS` are never evicted. Entries not
+        measured yet are measured first if there's a maximum number of bytes, rather than when
+        they're saved, i.e. off the critical path of the queries adding them.
+
+        Args:
+            max_bytes, int: The maximum size of the cached output, or 0 for no maximum
+            max_age_seconds, int: The maximum time since an entry was accessed, or 0 for no
+                maximum
+            keep, Collection[str]: The locations of output to keep, e.g. of running plans
+
+        Returns:
+            The evicted entries, whose output is left to the caller to delete
+        """
+        entries = self.load()
+        now = datetime.datetime.now()
+
+        unmeasured = [location for location, e in entries.items() if e.bytes is None]
+        if max_bytes and unmeasured:
+            # Output deleted by anything but the catalog can't be measured, and counts as empty
+            stored = self.exists(unmeasured)
+            sizes = self.measure(sorted(stored)) if stored else {}
+            for location in unmeasured:
+                entries[location].bytes = sizes.get(location, 0)
+
+        size = sum(entry.bytes or 0 for entry in entries.values())
+        evicted = []
+        for entry in sorted(entries.values(), key=lambda entry: entry.accessed_at):
+            idle = (now - entry.accessed_at).total_seconds()
+            if entry.location in keep or idle < MIN_IDLE_SECONDS:
+                continue
+
+            if (max_age_seconds and idle > max_age_seconds) or (max_bytes and size > max_bytes):
+                evicted.append(entry)
+                size -= entry.bytes or 0
+
+        if evicted or (max_bytes and unmeasured):
+            for entry in evicted:
+                entries.pop(entry.location)
+            self.write(list(entries.values()))
+            self._entries = entries
+
+        return evicted
+
+    def write(self, entries: list[CacheEntry]) -> None:
+        conn = create_conn_with_httpfs_loaded()
+
+        conn.execute(f"CREATE TABLE catalog ({CATALOG_SCHEMA})")
+        if entries:
+            conn.executemany(
+                "INSERT INTO catalog VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        e.subquery_hashed,
+                        e.location,
+                        e.bytes,
+                        e.created_at,
+                        e.fingerprint,
+                        e.accessed_at,
+                    )
+                    for e in entries
+                ],
+            )
+
+        if "://" not in self.path:
+            os.makedirs(self.path, exist_ok=True)
+        conn.execute(f"COPY catalog TO '{self.location}' (FORMAT PARQUET)")
+
+
+class Cache:
+    """Manages the cached output of tasks at the cache prefixes of a session
+
+    The cached output at a prefix is bounded by `session.cache_max_bytes` and
+    `session.cache_max_age_seconds`, by evicting the least recently used output, see
+    `CacheCatalog.evict`. Output referenced by a running plan of the session is never evicted.
+    The output is evicted on `vacuum`, and in the background after each execution of a plan
+    if a budget is set.
+
+    Attributes:
+        provider, Provider: The provider to delete evicted output from, e.g. S3 objects
+
+    Methods:
+        open: Opens the catalog of the cached output at a prefix
+        reference: Protects the output of a running plan against eviction
+        release: Releases the output of a plan that is no longer running
+        vacuum: Evicts the cached output beyond the budgets
+        vacuum_in_background: Evicts the cached output beyond the budgets in a thread
+    """
+
+    def __init__(self, provider: "Provider | None" = None) -> None:
+        self.provider = provider
+
+        self._lock = threading.Lock()
+        self._prefixes: t.Set[str] = set()
+        self._references: dict[str, int] = {}
+        self._vacuums: dict[str, threading.Thread] = {}
+
+    def open(self, prefix: str) -> CacheCatalog:
+        with self._lock:
+            self._prefixes.add(prefix.rstrip("/"))
+        return CacheCatalog(path=prefix)
+
+    def reference(self, keys: t.Iterable[str]) -> None:
+        with self._lock:
+            for key in keys:
+                self._references[key] = self._references.get(key, 0) + 1
+
+    def release(self, keys: t.Iterable[str]) -> None:
+        with self._lock:
+            for key in keys:
+                self._references[key] = self._references.get(key, 1) - 1
+                if self._references[key] <= 0:
+                    self._references.pop(key)
+
+    def vacuum(self, prefix: str | None = None) -> list[str]:
+        """Evicts the cached output beyond `session.cache_max_bytes` and
+        `session.cache_max_age_seconds`, and deletes it
+
+        Args:
+            prefix, str | None: The cache prefix to vacuum, or None for every prefix opened
+                by the session
+
+        Returns:
+            The keys of the deleted output
+
+        Example:
+            >>> session.cache.vacuum()
+        """
+        from duckingit._config import DuckConfig
+
+        conf = DuckConfig().session
+        with self._lock:
+            prefixes = sorted(self._prefixes) if prefix is None else [prefix]
+
+        deleted = []
+        for path in prefixes:
+            with self._lock:
+                keep = set(self._references)
+
+            evicted = self.open(path).evict(
+                max_bytes=conf.cache_max_bytes,
+                max_age_seconds=conf.cache_max_age_seconds,
+                keep=keep,
+            )
+            keys = [entry.location for entry in evicted]
+            self.delete(keys)
+            deleted.extend(keys)
+
+        return deleted
+
+    def vacuum_in_background(self, prefix: str) -> None:
+        """Vacuums a prefix in a thread, unless a vacuum of the prefix is running already or
+        no budget is set"""
+        from duckingit._config import DuckConfig
+
+        conf = DuckConfig().session
+        if not conf.cache_max_bytes and not conf.cache_max_age_seconds:
+            return
+
+        with self._lock:
+            thread = self._vacuums.get(prefix)
+            if thread is not None and thread.is_alive():
+                return
+
+            thread = threading.Thread(target=self.vacuum, args=(prefix,), daemon=True)
+            self._vacuums[prefix] = thread
+        thread.start()
+
+    def delete(self, keys: list[str]) -> None:
+        """Deletes the output at keys, i.e. parquet files or directories of partitions"""
+        objects = [key for key in keys if "://" in key]
+        if objects:
+            self.provider.s3.delete_objects(objects)  # type: ignore
+
+        for key in keys:
+            if "://" in key:
+                continue
+            if os.path.isdir(key):
+                shutil.rmtree(key)
+            elif os.path.exists(key):
+                os.remove(key)
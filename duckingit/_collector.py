@@ -0,0 +1,238 @@
+import queue
+import threading
+import typing as t
+from dataclasses import dataclass
+
+if t.TYPE_CHECKING:
+    from duckingit.providers.aws import AWS
+
+
+# Messages of request ids that nobody watches (yet) are kept around for a while, as the
+# message of an invokation can arrive before its request id is watched
+MAX_UNCLAIMED_COMPLETIONS = 10_000
+MAX_DELETE_BATCH_SIZE = 10  # Limit of SQS
+DELETE_INTERVAL_SECONDS = 0.1
+IDLE_INTERVAL_SECONDS = 0.5
+
+# Calls to SQS that fail are retried with an exponential backoff, e.g. on a throttled or
+# dropped connection, until they have failed this many times in a row
+MAX_RETRIES = 5
+RETRY_BACKOFF_SECONDS = 0.5
+
+
+@dataclass
+class Completion:
+    request_id: str
+    succeeded: bool
+    message: str = ""
+    rows: int | None = None
+
+    def __repr__(self) -> str:
+        status = "SUCCEEDED" if self.succeeded else "FAILED"
+        return f"Completion<REQUEST_ID='{self.request_id}' | {status}>"
+
+
+class Collector:
+    """Collects the completions of invokations from the success and failure queues
+
+    A number of receivers long-poll each of the queues concurrently in background threads,
+    while another thread deletes the received messages in batches. A completion is handed
+    to the scheduler the moment it arrives, see `collect`. The receivers only poll the
+    queues while there are request ids being watched. A call to SQS that keeps failing stops
+    the threads, and its error is raised by `collect`, while the threads are started anew
+    once request ids are watched again.
+
+    Attributes:
+        provider, AWS: The provider to poll the queues of
+        success_queue, str: The name of the queue of successful invokations
+        failure_queue, str: The name of the queue of failed invokations
+        receivers, int: The number of concurrent receivers per queue
+        wait_time_seconds, int: The time a receiver waits for messages per poll
+
+    Methods:
+        watch: Starts watching request ids, e.g. right after the invokations
+        forget: Stops watching request ids
+        collect: Waits for the completions of watched request ids
+        close: Stops the background threads, until request ids are watched again
+    """
+
+    def __init__(
+        self,
+        provider: "AWS",
+        success_queue: str,
+        failure_queue: str,
+        receivers: int = 2,
+        wait_time_seconds: int = 5,
+    ) -> None:
+        self.provider = provider
+        self.success_queue = success_queue
+        self.failure_queue = failure_queue
+        self.receivers = receivers
+        self.wait_time_seconds = wait_time_seconds
+
+        self._lock = threading.Lock()
+        self._watched: t.Set[str] = set()
+        self._unclaimed: dict[str, Completion] = {}
+        self._completions: queue.Queue[Completion] = queue.Queue()
+        self._deletions: queue.Queue[tuple[str, dict[str, str]]] = queue.Queue()
+
+        self._active = threading.Event()
+        self._closed = threading.Event()
+        self._threads: list[threading.Thread] = []
+        self._error: Exception | None = None
+
+    def _start(self) -> None:
+        if self._threads and not self._closed.is_set():
+            return
+
+        # Threads stopping still see the event they were started with
+        self._closed = threading.Event()
+        self._active.clear()
+
+        self._threads = []
+        for name in [self.success_queue, self.failure_queue]:
+            for _ in range(self.receivers):
+                self._threads.append(
+                    threading.Thread(target=self._receive, args=(name, self._closed), daemon=True)
+                )
+        self._threads.append(
+            threading.Thread(target=self._delete, args=(self._closed,), daemon=True)
+        )
+
+        for thread in self._threads:
+            thread.start()
+
+    def close(self) -> None:
+        self._closed.set()
+        self._active.set()  # Wake up idle receivers to let them exit
+
+    def watch(self, request_ids: t.Iterable[str]) -> None:
+        with self._lock:
+            self._start()
+
+            for request_id in request_ids:
+                completion = self._unclaimed.pop(request_id, None)
+                if completion is not None:
+                    self._completions.put(completion)
+                    continue
+
+                self._watched.add(request_id)
+
+            if self._watched:
+                self._active.set()
+
+    def forget(self, request_ids: t.Iterable[str]) -> None:
+        with self._lock:
+            self._watched.difference_update(request_ids)
+
+            if not self._watched:
+                self._active.clear()
+
+    def collect(self, timeout: float | None = None) -> list[Completion]:
+        """Waits for completions of watched request ids
+
+        Args:
+            timeout, float | None: The maximum time to wait for the first completion
+
+        Returns:
+            All completions available, or an empty list if none arrived in time
+        """
+        completions = []
+        try:
+            completions.append(self._completions.get(timeout=timeout))
+            while True:
+                completions.append(self._completions.get_nowait())
+        except queue.Empty:
+            pass
+
+        if self._error is not None and len(completions) == 0:
+            error, self._error = self._error, None
+            raise error
+
+        return completions
+
+    def _dispatch(self, completion: Completion) -> None:
+        with self._lock:
+            if completion.request_id in self._watched:
+                self._watched.remove(completion.request_id)
+                if not self._watched:
+                    self._active.clear()
+
+                self._completions.put(completion)
+                return
+
+            self._unclaimed[completion.request_id] = completion
+            if len(self._unclaimed) > MAX_UNCLAIMED_COMPLETIONS:
+                self._unclaimed.pop(next(iter(self._unclaimed)))
+
+    def _back_off(self, error: Exception, failures: int, closed: threading.Event) -> bool:
+        """Waits before a failed call to SQS is retried, or stops the threads once the call has
+        failed more than `MAX_RETRIES` times in a row
+
+        Returns:
+            Whether to retry the call
+        """
+        if failures > MAX_RETRIES:
+            self._error = error
+            closed.set()
+            self._active.set()  # Wake up idle receivers to let them exit
+            return False
+
+        closed.wait(timeout=RETRY_BACKOFF_SECONDS * 2 ** (failures - 1))
+        return True
+
+    def _receive(self, name: str, closed: threading.Event) -> None:
+        succeeded = name == self.success_queue
+
+        failures = 0
+        while not closed.is_set():
+            if not self._active.wait(timeout=IDLE_INTERVAL_SECONDS):
+                continue
+
+            try:
+                messages = self.provider.sqs.poll_messages_from_queue(
+                    name=name, wait_time_seconds=self.wait_time_seconds
+                )
+            except Exception as e:
+                failures += 1
+                if not self._back_off(e, failures=failures, closed=closed):
+                    return
+                continue
+
+            failures = 0
+            for message in messages:
+                self._deletions.put((name, message.create_entry_payload()))
+                self._dispatch(
+                    Completion(
+                        request_id=message.request_id,
+                        succeeded=succeeded,
+                        message=message.response_payload,
+                        rows=message.rows,
+                    )
+                )
+
+    def _delete(self, closed: threading.Event) -> None:
+        batches: dict[str, list[dict[str, str]]] = {}
+
+        failures = 0
+        while not (closed.is_set() and self._deletions.empty() and not batches):
+            try:
+                name, entry = self._deletions.get(timeout=DELETE_INTERVAL_SECONDS)
+                batches.setdefault(name, []).append(entry)
+
+                if len(batches[name]) < MAX_DELETE_BATCH_SIZE:
+                    continue
+            except queue.Empty:
+                pass
+
+            try:
+                for name in list(batches):
+                    self.provider.sqs.delete_messages_from_queue(name=name, entries=batches[name])
+                    batches.pop(name)
+            except Exception as e:
+                failures += 1
+                if not self._back_off(e, failures=failures, closed=closed):
+                    return
+                continue
+
+            failures = 0
@@ -20,6 +20,7 @@ class LambdaConfig(BaseConfig):
     MemorySize: int = 128
     Timeout: int = 30
     WarmUp: bool = False
+    MaxConcurrentInvokes: int = 64
 
     def __repr__(self) -> str:
         repr = cast_mapping_to_string_with_newlines(
@@ -44,6 +45,10 @@ class LambdaConfig(BaseConfig):
             if not isinstance(value, str):
                 raise ValueError("`FunctionName` must be a string")
 
+        elif name == "MaxConcurrentInvokes":
+            if not isinstance(value, int) or value < 1:
+                raise ValueError("`MaxConcurrentInvokes` must be a positive integer")
+
         else:
             raise AttributeError()
 
@@ -52,11 +57,12 @@ class LambdaConfig(BaseConfig):
     def update(self):
         config_dict = copy.deepcopy(self.__dict__)
         warm_up = config_dict.pop("WarmUp")
+        config_dict.pop("MaxConcurrentInvokes")  # Client side only
         provider = Providers.get_or_raise("aws").lambda_
 
         provider.update_lambda_configurations(config_dict)
         if warm_up:
-            provider.lambda_.warm_up_lambda_function()
+            provider.warm_up_lambda_function()
 
 
 @dataclass
@@ -68,6 +74,7 @@ class SQSConfig(BaseConfig):
     MaxNumberOfMessages: int = 10
     VisibilityTimeout: int = 5
     WaitTimeSeconds: int = 5
+    NumberOfReceivers: int = 2
 
     # Configs on Queue itself
     DelaySeconds: int = 0
@@ -91,6 +98,10 @@ class SQSConfig(BaseConfig):
             if not isinstance(value, int):
                 raise ValueError("`WaitTimeSeconds` must be an integer")
 
+        elif name == "NumberOfReceivers":
+            if not isinstance(value, int) or value < 1:
+                raise ValueError("`NumberOfReceivers` must be a positive integer")
+
         elif name == "DelaySeconds":
             if not isinstance(value, int):
                 raise ValueError("`DelaySeconds` must be an integer")
@@ -133,6 +144,7 @@ class AWSConfig(BaseConfig):
     aws_region: str = ""
     aws_access_key_id: str = ""
     aws_secret_access_key: str = ""
+    max_pool_connections: int = 50
 
     def __repr__(self) -> str:
         repr = cast_mapping_to_string_with_newlines(
@@ -153,6 +165,10 @@ class AWSConfig(BaseConfig):
             if not isinstance(value, str):
                 raise ValueError("`aws_secret_access_key` must be a string")
 
+        elif name == "max_pool_connections":
+            if not isinstance(value, int) or value < 1:
+                raise ValueError("`max_pool_connections` must be a positive integer")
+
         else:
             raise AttributeError()
 
@@ -161,8 +177,22 @@ class AWSConfig(BaseConfig):
 
 @dataclass
 class SessionConfig(BaseConfig):
-    cache_expiration_time: int = 15
+    cache_expiration_time: int = 0
+    cache_max_bytes: int = 0
+    cache_max_age_seconds: int = 0
     max_invokations: int | str = "auto"
+    bytes_per_invokation: int = 128 * 1024**2
+    max_retries: int = 2
+    retry_backoff: float = 1.0
+    speculation: bool = False
+    speculation_multiplier: float = 1.5
+    shuffle_partitions: int = 0
+    broadcast_threshold_bytes: int = 64 * 1024**2
+    statistics_path: str = ""
+    plan_cache_size: int = 64
+    listing_ttl_seconds: int = 0
+    listing_concurrency: int = 16
+    listing_incremental: bool = False
     provider: str = "aws"
     verbose: bool = False
 
@@ -172,8 +202,16 @@ class SessionConfig(BaseConfig):
 
     def __setattr__(self, name: str, value: t.Any) -> None:
         if name == "cache_expiration_time":
-            if not isinstance(value, int):
-                raise ValueError("`cache expiration time` must be an integer")
+            if not isinstance(value, int) or value < 0:
+                raise ValueError("`cache expiration time` must be a non-negative integer")
+
+        elif name == "cache_max_bytes":
+            if not isinstance(value, int) or value < 0:
+                raise ValueError("`cache max bytes` must be a non-negative integer")
+
+        elif name == "cache_max_age_seconds":
+            if not isinstance(value, int) or value < 0:
+                raise ValueError("`cache max age seconds` must be a non-negative integer")
 
         elif name == "max_invokations":
             if not (isinstance(value, int) or isinstance(value, str)):
@@ -182,6 +220,54 @@ class SessionConfig(BaseConfig):
                         raise WrongInvokationType("`value` can only be 'auto' or an integer")
                 raise ValueError("`max invokations` must be an integer")
 
+        elif name == "bytes_per_invokation":
+            if not isinstance(value, int) or value < 1:
+                raise ValueError("`bytes per invokation` must be a positive integer")
+
+        elif name == "max_retries":
+            if not isinstance(value, int) or value < 0:
+                raise ValueError("`max retries` must be a non-negative integer")
+
+        elif name == "retry_backoff":
+            if not isinstance(value, (int, float)) or value < 0:
+                raise ValueError("`retry backoff` must be a non-negative number of seconds")
+
+        elif name == "speculation":
+            if not isinstance(value, bool):
+                raise ValueError("`speculation` must be a boolean")
+
+        elif name == "speculation_multiplier":
+            if not isinstance(value, (int, float)) or value < 1:
+                raise ValueError("`speculation multiplier` must be a number of at least 1")
+
+        elif name == "shuffle_partitions":
+            if not isinstance(value, int) or value < 0:
+                raise ValueError("`shuffle partitions` must be a non-negative integer")
+
+        elif name == "broadcast_threshold_bytes":
+            if not isinstance(value, int) or value < 0:
+                raise ValueError("`broadcast threshold bytes` must be a non-negative integer")
+
+        elif name == "statistics_path":
+            if not isinstance(value, str):
+                raise ValueError("`statistics path` must be a string")
+
+        elif name == "plan_cache_size":
+            if not isinstance(value, int) or value < 0:
+                raise ValueError("`plan cache size` must be a non-negative integer")
+
+        elif name == "listing_ttl_seconds":
+            if not isinstance(value, int) or value < 0:
+                raise ValueError("`listing ttl seconds` must be a non-negative integer")
+
+        elif name == "listing_concurrency":
+            if not isinstance(value, int) or value < 1:
+                raise ValueError("`listing concurrency` must be a positive integer")
+
+        elif name == "listing_incremental":
+            if not isinstance(value, bool):
+                raise ValueError("`listing incremental` must be a boolean")
+
         elif name == "provider":
             if not isinstance(value, str):
                 raise ValueError("`provider` must be a string")
@@ -289,5 +375,8 @@ class DuckConfig:
         return self
 
     def update(self):
+        # Providers, and their clients, are created again using the new configurations
+        Providers.clear()
+
         for _, service in self.services_to_be_updated.items():
             service.update()
@@ -1,19 +1,26 @@
 import datetime
+import heapq
+import itertools
+import statistics
+import time
 import typing as t
 
-from duckingit._exceptions import FailedLambdaFunctions
+from duckingit._cache import CacheCatalog
+from duckingit._collector import Completion
+from duckingit._exceptions import FailedInvokations, FailedLambdaFunctions
 from duckingit._planner import Plan, Stage, Task
-from duckingit._utils import scan_source_for_files
-from duckingit.providers import Providers
 
 if t.TYPE_CHECKING:
     from duckingit._session import DuckSession
 
 
-# TODO: define heuristics for this
-ITERATIONS_TO_CHECK_FAILED = 3
-WAIT_TIME_SUCCESS_QUEUE_SECONDS = [3] * ITERATIONS_TO_CHECK_FAILED
-WAIT_TIME_FAILURE_QUEUE_SECONDS = 1
+# The scheduler wakes up at least this often while waiting on completions
+COLLECT_TIMEOUT_SECONDS = 1.0
+
+# The share of finished tasks of a stage before stragglers are copied, and the minimum
+# time a task must have been running to be a straggler
+SPECULATION_QUANTILE = 0.75
+SPECULATION_MIN_SECONDS = 1.0
 
 
 class Controller:
@@ -31,156 +38,429 @@ class Controller:
         self.session = session
 
         self._set_provider()
+        self.collector = session.collector
         self.cache_expiration_time = getattr(session.conf, "session.cache_expiration_time")
 
-        self.success_queue = getattr(self.session.conf, "aws_sqs.QueueSuccess")
-        self.failure_queue = getattr(self.session.conf, "aws_sqs.QueueFailure")
         self.verbose = getattr(self.session.conf, "session.verbose")
+        self.max_retries = getattr(self.session.conf, "session.max_retries")
+        self.retry_backoff = getattr(self.session.conf, "session.retry_backoff")
+        self.speculation = getattr(self.session.conf, "session.speculation")
+        self.speculation_multiplier = getattr(self.session.conf, "session.speculation_multiplier")
 
     def _set_provider(self):
-        self.provider = Providers.get_or_raise("aws")
+        self.provider = self.session.provider
+
+    def open_catalog(self, prefix: str) -> CacheCatalog:
+        return self.session.cache.open(prefix)
+
+    def update_cache_metadata(self, execution: "Execution", stage: Stage) -> None:
+        """Adds the output of the tasks of a stage invoked in the execution to the catalog"""
+        for task in stage.tasks:
+            if task in execution.finished:
+                execution.catalog.add(
+                    task,
+                    key=task.key(execution.prefixes[task]),
+                    created_at=execution.submitted_at[stage],
+                )
 
-    def fetch_cache_metadata(self) -> dict[str, datetime.datetime]:
-        return self.session.metadata_cached
+    def evaluate_execution_stage(
+        self, execution: "Execution", stage: Stage, prefix: str
+    ) -> t.Set[Task]:
+        """Returns the tasks of a stage whose output is cached, see `CacheCatalog`
 
-    def update_cache_metadata(
-        self, execution_stage: Stage, execution_time: datetime.datetime
-    ) -> None:
-        for task in execution_stage.tasks:
-            self.session.metadata_cached[task.subquery_hashed] = execution_time
+        Cached output is valid as long as the input of the task is unchanged, i.e. the files
+        it scans and the output of the stages it depends on, see `CacheCatalog.fingerprint`,
+        and at most `session.cache_expiration_time` minutes, unless it's 0. Output that is no
+        longer stored, e.g. deleted by anything but the catalog, is computed again.
+        """
+        execution.catalog.fingerprint(stage.tasks)
+
+        max_age_seconds = self.cache_expiration_time * 60
+        cached, entries = {}, []
+        for task in stage.tasks:
+            entry = execution.catalog.lookup(
+                task, key=task.key(prefix), max_age_seconds=max_age_seconds
+            )
+            if entry is not None:
+                cached[entry.location] = task
+                entries.append(entry)
+
+        # The output is marked as accessed before it's checked, such that no vacuum deletes it
+        # from then on, see `MIN_IDLE_SECONDS`
+        accessed = execution.catalog.access(entries)
+        locations = execution.catalog.exists([entry.location for entry in accessed])
+        return set(cached[location] for location in locations)
+
+    def prepare_stage(self, stage: Stage, context: dict[str, list[str]], prefix: str) -> None:
+        """Creates the tasks of a stage and registers its output in the context
+
+        Args:
+            stage, Stage: The stage to prepare
+            context, dict[str, list[str]]: The output of the completed stages
+            prefix, str: The prefix to store the output of the stage
+        """
+        stage_deps = {dep.id: context[dep.id] for dep in stage.dependencies}
+        stage.tasks.clear()  # The tasks of an earlier execution of the plan
+        stage.create_tasks(dependencies=stage_deps)
+        if self.verbose:
+            print(f"RUNNING STAGE: [{stage}]")
 
-    def scan_cache_data(self, prefix: str) -> list[str]:
-        return scan_source_for_files(source=prefix)
+        if stage.branches:
+            # A UNION ALL concatenates the output of its branches
+            context[stage.id] = [key for branch in stage.branches for key in context[branch]]
+        else:
+            context[stage.id] = [task.key(prefix) for task in stage.parts]
 
-    def evaluate_execution_stage(self, execution_stage: Stage, prefix: str) -> None:
-        """Evaluate the execution plan
+    def invoke(self, execution: "Execution", tasks: t.Set[Task], prefix: str) -> dict[str, Task]:
+        """Invokes the tasks and starts collecting their completions right away
 
-        Filters cached objects to minimize compute power
+        Returns:
+            A mapping of request ids to tasks
         """
-        cached_objects = self.scan_cache_data(prefix=prefix)
-        session_cache_metadata = self.fetch_cache_metadata()
 
-        for step in list(execution_stage.tasks):
-            last_executed = session_cache_metadata.get(step.subquery_hashed, None)
+        def on_invoked(request_id: str, _: Task) -> None:
+            execution.invoked_at[request_id] = time.monotonic()
+            self.collector.watch([request_id])
+
+        return self.provider.lambda_.invoke(
+            execution_tasks=tasks, prefix=prefix, callback=on_invoked
+        )
+
+    def submit_ready_stages(self, execution: "Execution", prefix: str, default_prefix: str):
+        """Prepares and invokes all stages whose dependencies have completed
 
-            if last_executed is None:
+        Sibling stages share the fan-out of invokations. The output of the root is stored at
+        `prefix`, as well as the output of the branches of a root UNION ALL.
+        """
+        root = execution.plan.root
+
+        submitted: dict[str, t.Set[Task]] = {}
+        for stage in execution.ready:
+            is_output = stage is root or stage.id in root.branches
+            stage_prefix = prefix if is_output and prefix != "" else default_prefix
+
+            execution.submitted_at[stage] = datetime.datetime.now()
+            stage.speculative_copies = 0
+            self.prepare_stage(stage=stage, context=execution.context, prefix=stage_prefix)
+
+            # The output of the stage is kept in the cache until the execution is done
+            keys = [task.key(stage_prefix) for task in stage.tasks]
+            self.session.cache.reference(keys)
+            execution.referenced.extend(keys)
+
+            # Tasks whose output is cached are skipped, while their output is read as is
+            cached = self.evaluate_execution_stage(execution, stage=stage, prefix=stage_prefix)
+            execution.cached.update(cached)
+            for task in cached:
+                execution.prefixes[task] = stage_prefix
+            if self.verbose and cached:
+                print(f"\tSKIPPED {len(cached)} CACHED TASKS OF [{stage.id}]")
+
+            tasks = [task for task in stage.parts if task not in cached]
+            if len(tasks) == 0:
+                self.complete_stage(execution, stage=stage)
                 continue
 
-            last_executed_seconds = (datetime.datetime.now() - last_executed).seconds
-            last_executed_minutes = int(last_executed_seconds / 60)
-
-            # The order of evaluations matters
-            if (
-                last_executed_minutes < self.cache_expiration_time
-                and step.subquery_hashed in cached_objects
-            ):
-                execution_stage.tasks.remove(step)
-
-    def execute_stage(
-        self,
-        stage: Stage,
-        dag: dict[Stage, t.Set[Stage]],
-        context: dict[str, list[str]],
-        completed: t.Set[Stage],
-        root_id: str,
-        prefix: str,
-        default_prefix: str,
-    ):
-        for dep in dag[stage]:
-            if dep not in completed:
-                self.execute_stage(
-                    stage=dep,
-                    dag=dag,
-                    context=context,
-                    completed=completed,
-                    root_id=root_id,
-                    prefix=prefix,
-                    default_prefix=default_prefix,
-                )
+            if stage.limit:
+                # A limited stage starts off with a single task, see `submit_next_wave`
+                execution.rows[stage] = 0
+                execution.pending[stage] = tasks[1:]
+                tasks = tasks[:1]
 
-        stage_deps = {}
-        for dep in stage.dependencies:
-            if dep.id in context:
-                stage_deps[dep.id] = context[dep.id]
+            execution.running[stage] = set(tasks)
+            submitted.setdefault(stage_prefix, set()).update(tasks)
 
-        stage.create_tasks(dependencies=context)
-        if self.verbose:
-            print(f"RUNNING STAGE: [{stage}]")
+        for stage_prefix, tasks in submitted.items():
+            self.submit_tasks(execution, tasks=tasks, prefix=stage_prefix)
 
-        if stage.id == root_id and prefix != "":
-            default_prefix = prefix
+    def submit_next_wave(self, execution: "Execution", stage: Stage) -> bool:
+        """Invokes the next wave of tasks of a limited stage, see `Stage.limit`
 
-        context[stage.id] = [f"{default_prefix}/{i}.parquet" for i in stage.output]
-        # self.evaluate_execution_stage(execution_stage=stage, prefix=default_prefix)
+        Each wave is as large as all waves before it, i.e. the number of tasks invoked doubles,
+        until the tasks invoked so far have output enough rows, while every task left is
+        invoked if a task didn't report its rows.
+        Once enough rows are output, the tasks left are dropped from the stage, and the output
+        of the stage is the output of the tasks invoked.
 
-        execution_time = datetime.datetime.now()
-        if len(stage.tasks) > 0:
-            request_ids = self.provider.lambda_.invoke(
-                execution_tasks=stage.tasks, prefix=default_prefix
-            )
+        Returns:
+            True if a wave was invoked, or False if the stage is complete
+        """
+        pending = execution.pending.pop(stage, [])
+        rows = execution.rows.get(stage)
+
+        if pending and (rows is None or rows < stage.limit):
+            invoked = [task for task in stage.tasks if task not in execution.cached]
+            size = len(pending) if rows is None else len(invoked) - len(pending)
+            wave, execution.pending[stage] = pending[:size], pending[size:]
+
+            execution.running[stage] = set(wave)
+            self.submit_tasks(execution, tasks=set(wave), prefix=execution.prefixes[stage.parts[0]])
+            return True
+
+        if pending:
+            stage.tasks.difference_update(pending)
+            execution.context[stage.id] = [
+                task.key(execution.prefixes[task]) for task in stage.parts
+            ]
+            if self.verbose:
+                print(f"\tSKIPPED {len(pending)} TASKS OF [{stage.id}] AFTER {rows} ROWS")
+        return False
+
+    def submit_tasks(self, execution: "Execution", tasks: t.Set[Task], prefix: str) -> None:
+        for task in tasks:
+            execution.prefixes[task] = prefix
+
+        failed: dict[Task, Exception] = {}
+        try:
+            request_ids = self.invoke(execution, tasks=tasks, prefix=prefix)
+        except FailedInvokations as e:
+            request_ids, failed = e.request_ids, e.failed
+
+        # The tasks invoked are tracked even if others couldn't be, as they're running anyway
+        for request_id, task in request_ids.items():
+            execution.request_ids[request_id] = task
+            execution.in_flight.setdefault(task, set()).add(request_id)
+
+        for task, error in failed.items():
+            if len(execution.in_flight.get(task, set())) == 0:
+                self.retry(execution, task=task, message=str(error))
+
+    def resubmit_failed_tasks(self, execution: "Execution") -> None:
+        """Invokes the failed tasks whose backoff has passed once again"""
+        resubmitted: dict[str, t.Set[Task]] = {}
+        while execution.retries and execution.retries[0][0] <= time.monotonic():
+            _, _, task = heapq.heappop(execution.retries)
+            resubmitted.setdefault(execution.prefixes[task], set()).add(task)
+
+        for prefix, tasks in resubmitted.items():
+            self.submit_tasks(execution, tasks=tasks, prefix=prefix)
+
+    def speculate(self, execution: "Execution") -> None:
+        """Invokes a copy of the tasks that are running far longer than the rest of their stage
+
+        Once a share of `SPECULATION_QUANTILE` of the tasks of a stage has finished, a task
+        running longer than `session.speculation_multiplier` times the median of the
+        finished tasks is invoked once more. Whichever copy finishes first completes the
+        task, which is safe, as both copies write the same object.
+        """
+        now = time.monotonic()
+
+        speculated: dict[str, t.Set[Task]] = {}
+        for stage, outstanding in execution.running.items():
+            durations = execution.durations.get(stage, [])
+            if len(durations) == 0 or len(durations) < SPECULATION_QUANTILE * len(stage.tasks):
+                continue
 
-            self.check_status_of_invokations(request_ids=request_ids)
+            threshold = max(
+                self.speculation_multiplier * statistics.median(durations),
+                SPECULATION_MIN_SECONDS,
+            )
+            for task in outstanding - execution.speculated:
+                invoked_at = [
+                    execution.invoked_at[request_id]
+                    for request_id in execution.in_flight.get(task, set())
+                ]
+                # Tasks waiting for a retry aren't running
+                if len(invoked_at) == 0 or now - min(invoked_at) < threshold:
+                    continue
+
+                execution.speculated.add(task)
+                stage.speculative_copies += 1
+                speculated.setdefault(execution.prefixes[task], set()).add(task)
+
+                if self.verbose:
+                    print(f"\tSPECULATIVE COPY OF TASK [{task.subquery_hashed}] IN [{stage.id}]")
+
+        for prefix, tasks in speculated.items():
+            self.submit_tasks(execution, tasks=tasks, prefix=prefix)
+
+    def complete_stage(self, execution: "Execution", stage: Stage) -> None:
+        execution.completed.add(stage)
+        self.update_cache_metadata(execution, stage=stage)
+
+    def handle_completion(self, execution: "Execution", completion: Completion) -> None:
+        """Completes the stages of a finished task, or schedules a failed task for a retry
+
+        Raises:
+            FailedLambdaFunctions: If a task has failed more times than `session.max_retries`
+        """
+        task = execution.request_ids.pop(completion.request_id, None)
+        if task is None:
+            return
+
+        invoked_at = execution.invoked_at.pop(completion.request_id)
+        in_flight = execution.in_flight[task]
+        in_flight.discard(completion.request_id)
+
+        # Another copy of the task has finished first
+        if task in execution.finished:
+            return
+
+        if completion.succeeded:
+            execution.finished.add(task)
+
+            for stage, outstanding in list(execution.running.items()):
+                if task not in outstanding:
+                    continue
+
+                outstanding.remove(task)
+                execution.durations.setdefault(stage, []).append(time.monotonic() - invoked_at)
+                if stage in execution.rows:
+                    rows = execution.rows[stage]
+                    execution.rows[stage] = (
+                        None if rows is None or completion.rows is None else rows + completion.rows
+                    )
+
+                if len(outstanding) == 0:
+                    execution.running.pop(stage)
+                    if not self.submit_next_wave(execution, stage=stage):
+                        self.complete_stage(execution, stage=stage)
+            return
+
+        # Another copy of the task is still running
+        if len(in_flight) > 0:
+            return
+
+        self.retry(execution, task=task, message=completion.message)
+
+    def retry(self, execution: "Execution", task: Task, message: str) -> None:
+        """Schedules a failed task to be invoked once again, after an exponential backoff
+
+        Raises:
+            FailedLambdaFunctions: If the task has failed more times than `session.max_retries`
+        """
+        failures = execution.failures[task] = execution.failures.get(task, 0) + 1
+        if failures > self.max_retries:
+            raise FailedLambdaFunctions(
+                f"Task {task.subquery_hashed} failed {failures} times: {message}"
+            )
 
-        completed.add(stage)
-        self.update_cache_metadata(execution_stage=stage, execution_time=execution_time)
+        backoff = self.retry_backoff * 2 ** (failures - 1)
+        heapq.heappush(
+            execution.retries, (time.monotonic() + backoff, next(execution.counter), task)
+        )
+        if self.verbose:
+            print(f"\tRETRYING TASK [{task.subquery_hashed}] IN {backoff}s: {message}")
 
     def execute_plan(self, execution_plan: Plan, prefix: str, default_prefix: str):
-        """Executes the execution plan"""
-        completed: t.Set[Stage] = set()
-        dag = execution_plan.dag
-        context: dict[str, list[str]] = {}
-
-        for stage in dag:
-            if stage not in completed:
-                self.execute_stage(
-                    stage=stage,
-                    dag=dag,
-                    context=context,
-                    completed=completed,
-                    root_id=execution_plan.root.id,
-                    prefix=prefix,
-                    default_prefix=default_prefix,
-                )
+        """Executes the execution plan
 
-    def check_status_of_invokations(self, request_ids: dict[str, Task]):
-        cnt = 0
+        A stage is submitted as soon as all of its dependencies have completed. Thus,
+        independent branches of the DAG, e.g. both sides of a join, are running at the
+        same time, and share both the invokations and the collection of completions.
 
-        total_tasks = len(request_ids)
-        while len(request_ids) > 0:
-            # Logic to speed up fast queries
-            if cnt < len(WAIT_TIME_SUCCESS_QUEUE_SECONDS):
-                wait_time = WAIT_TIME_SUCCESS_QUEUE_SECONDS[cnt]
-            messages = self.provider.sqs.poll_messages_from_queue(
-                name=self.success_queue, wait_time_seconds=wait_time
-            )
+        Only the failed tasks of a stage are invoked again, with an exponential backoff,
+        until they have failed more than `session.max_retries` times. Stragglers are
+        invoked once more if `session.speculation` is enabled, and the number of copies is
+        kept in `Stage.speculative_copies`. The tasks of a stage with a LIMIT are invoked in
+        waves, which stop once enough rows are output, see `submit_next_wave`.
 
-            if len(messages) > 0:
-                for message in messages:
-                    try:
-                        request_ids.pop(message.request_id)
-                    except KeyError:
-                        continue
+        Tasks whose output is cached at `default_prefix` are skipped, and the output of the
+        tasks invoked is added to the catalog of the cache, see `CacheCatalog`. The cache is
+        vacuumed in the background afterwards, see `Cache`.
+        """
+        execution = Execution(plan=execution_plan, catalog=self.open_catalog(default_prefix))
 
-                entries = list(message.create_entry_payload() for message in messages)
-                self.provider.sqs.delete_messages_from_queue(
-                    name=self.success_queue, entries=entries
-                )
+        try:
+            while not execution.done:
+                self.submit_ready_stages(execution, prefix=prefix, default_prefix=default_prefix)
+                self.resubmit_failed_tasks(execution)
+                if self.speculation:
+                    self.speculate(execution)
 
-            if self.verbose:
-                print(f"\tTASKS COMPLETED: {total_tasks - len(request_ids)}/{total_tasks}")
+                if len(execution.running) == 0:
+                    if len(execution.ready) == 0 and not execution.done:
+                        raise ValueError("The execution plan contains a cycle")
+                    continue
 
-            cnt += 1
+                timeout = COLLECT_TIMEOUT_SECONDS
+                if execution.retries:
+                    timeout = min(timeout, max(execution.retries[0][0] - time.monotonic(), 0))
 
-            if cnt % ITERATIONS_TO_CHECK_FAILED == 0:
-                messages = self.provider.sqs.poll_messages_from_queue(
-                    name=self.failure_queue,
-                    wait_time_seconds=WAIT_TIME_FAILURE_QUEUE_SECONDS,
-                )
+                for completion in self.collector.collect(timeout=timeout):
+                    self.handle_completion(execution, completion=completion)
+
+                if self.verbose:
+                    for stage, outstanding in execution.running.items():
+                        total_tasks = len(stage.tasks)
+                        print(
+                            f"\tTASKS COMPLETED [{stage.id}]: "
+                            f"{total_tasks - len(outstanding)}/{total_tasks}"
+                        )
+
+            execution.catalog.save()
+
+        finally:
+            self.collector.forget(execution.request_ids)
+            self.session.cache.release(execution.referenced)
 
-                if len(messages) > 0:
-                    self.provider.sqs.purge_queue(self.failure_queue)  # clean up
-                    raise FailedLambdaFunctions(f"{messages}")
+        self.session.cache.vacuum_in_background(default_prefix)
 
     # def show(self):
     #     # Select only X parquet files?
     #     pass
+
+
+class Execution:
+    """The state of an execution of a plan
+
+    Attributes:
+        plan, Plan: The plan being executed
+        catalog, CacheCatalog: The catalog of the cached output of tasks
+        context, dict[str, list[str]]: The output of the prepared stages
+        completed, Set[Stage]: The completed stages
+        running, dict[Stage, Set[Task]]: The outstanding tasks of the running stages
+        submitted_at, dict[Stage, datetime]: The time each stage was submitted
+        request_ids, dict[str, Task]: The tasks of the invokations in flight
+        invoked_at, dict[str, float]: The time of each invokation in flight
+        in_flight, dict[Task, Set[str]]: The request ids of the invokations of each task
+        prefixes, dict[Task, str]: The prefix to store the output of each task
+        finished, Set[Task]: The tasks that have finished successfully
+        durations, dict[Stage, list[float]]: The durations of the finished tasks per stage
+        speculated, Set[Task]: The tasks that have been copied speculatively
+        failures, dict[Task, int]: The number of failed invokations of each task
+        retries, list[tuple[float, int, Task]]: A heap of failed tasks to invoke again
+        cached, Set[Task]: The tasks skipped, as their output is cached
+        referenced, list[str]: The keys of the output of the prepared stages, which are kept
+            in the cache until the execution is done
+        pending, dict[Stage, list[Task]]: The tasks of limited stages not invoked yet
+        rows, dict[Stage, int | None]: The rows output by the finished tasks of limited
+            stages, or None if a task didn't report its rows
+    """
+
+    def __init__(self, plan: Plan, catalog: CacheCatalog) -> None:
+        self.plan = plan
+        self.catalog = catalog
+        self.context: dict[str, list[str]] = {}
+
+        self.completed: t.Set[Stage] = set()
+        self.running: dict[Stage, t.Set[Task]] = {}
+        self.submitted_at: dict[Stage, datetime.datetime] = {}
+
+        self.request_ids: dict[str, Task] = {}
+        self.invoked_at: dict[str, float] = {}
+        self.in_flight: dict[Task, t.Set[str]] = {}
+        self.prefixes: dict[Task, str] = {}
+        self.finished: t.Set[Task] = set()
+        self.durations: dict[Stage, list[float]] = {}
+        self.speculated: t.Set[Task] = set()
+        self.failures: dict[Task, int] = {}
+        self.retries: list[tuple[float, int, Task]] = []
+        self.counter = itertools.count()
+        self.cached: t.Set[Task] = set()
+        self.referenced: list[str] = []
+        self.pending: dict[Stage, list[Task]] = {}
+        self.rows: dict[Stage, int | None] = {}
+
+    @property
+    def ready(self) -> list[Stage]:
+        """The stages that are ready to be submitted"""
+        return [
+            stage
+            for stage, deps in self.plan.dag.items()
+            if stage not in self.completed and stage not in self.running and deps <= self.completed
+        ]
+
+    @property
+    def done(self) -> bool:
+        return len(self.completed) == len(self.plan.dag)
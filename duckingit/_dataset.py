@@ -6,7 +6,7 @@ import duckdb
 from duckingit._config import CACHE_PREFIX
 from duckingit._controller import Controller
 from duckingit._exceptions import DatasetExistError
-from duckingit._planner import Plan
+from duckingit._planner import Plan, Stage
 from duckingit._utils import scan_source_for_files
 
 if t.TYPE_CHECKING:
@@ -103,6 +103,7 @@ class Dataset:
         self._session = session
 
         self._set_controller()
+        self._output: Stage | None = None
 
         self.default_prefix = f"{execution_plan.query.bucket}/{CACHE_PREFIX}"
 
@@ -112,7 +113,26 @@ class Dataset:
     def _set_controller(self) -> None:
         self._controller = Controller(session=self._session)
 
+    def _answer_from_metadata(self) -> Stage | None:
+        """Returns the stage answering the query from the statistics of its source, if they
+        can, see `Plan.metadata`"""
+        metadata = self.execution_plan.metadata
+        if metadata is None:
+            return None
+
+        metadata.create_tasks()
+        return metadata if metadata.tasks else None
+
     def _execute_plan(self, prefix: str = ""):
+        self._output = self._answer_from_metadata()
+        if self._output is not None:
+            # Answered in the session, without invoking any serverless function
+            for task in self._output.tasks:
+                key = task.key(prefix or self.default_prefix)
+                self._session.conn.execute(f"COPY ({task.subquery}) TO '{key}' (FORMAT PARQUET)")
+            return
+
+        self._output = self.execution_plan.root
         self._controller.execute_plan(
             execution_plan=self.execution_plan,
             prefix=prefix,
@@ -121,10 +141,7 @@ class Dataset:
 
     @property
     def stored_objects(self) -> list[str]:
-        return list(
-            self.default_prefix + "/" + task.subquery_hashed + ".parquet"
-            for task in self.execution_plan.root.tasks
-        )
+        return (self._output or self.execution_plan.root).keys(self.default_prefix)
 
     @property
     def write(self) -> DatasetWriter:
@@ -134,6 +151,10 @@ class Dataset:
         raise NotImplementedError()
 
     def show(self) -> duckdb.DuckDBPyRelation:
+        metadata = self._answer_from_metadata()
+        if metadata is not None:
+            return self._session.conn.sql(next(iter(metadata.tasks)).subquery)
+
         self._execute_plan(prefix=self.default_prefix)
 
         return self._session.conn.sql(f"SELECT * FROM READ_PARQUET({self.stored_objects})")
@@ -20,3 +20,17 @@ class DatasetExistError(Exception):
 
 class FailedLambdaFunctions(Exception):
     pass
+
+
+class FailedInvokations(Exception):
+    """Raised once every task has been invoked, if any of them couldn't be
+
+    Attributes:
+        request_ids, dict[str, Task]: The tasks that were invoked, by their request ids
+        failed, dict[Task, Exception]: The tasks that couldn't be invoked, with their errors
+    """
+
+    def __init__(self, message: str, request_ids: dict, failed: dict) -> None:
+        super().__init__(message)
+        self.request_ids = request_ids
+        self.failed = failed
@@ -0,0 +1,215 @@
+import fnmatch
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+from duckingit._utils import flatten_list, scan_source_for_paths
+
+# The characters of a glob that match more than themselves
+WILDCARDS = re.compile(r"[*?\[]")
+
+# The number of globs whose listing is kept, dropping the least recently used
+MAX_LISTINGS = 1024
+
+
+@dataclass
+class Listing:
+    paths: list[str]
+    listed_at: float
+    # The paths of each sub-prefix the glob was split into, see `ListingCache`
+    subprefixes: dict[str, list[str]] = field(default_factory=dict)
+
+
+def split_glob(pattern: str) -> tuple[str, str, str]:
+    """Splits a glob at its first path component with a wildcard
+
+    Args:
+        pattern, str: The glob, e.g. 's3://BUCKET_NAME/year=*/month=*/*.parquet'
+
+    Returns:
+        The prefix without wildcards, the component with a wildcard and the rest of the glob
+
+    Examples:
+        >>> split_glob("s3://BUCKET_NAME/year=*/month=*/*.parquet")
+        ("s3://BUCKET_NAME/", "year=*", "month=*/*.parquet")
+        >>> split_glob("s3://BUCKET_NAME/2023/*")
+        ("s3://BUCKET_NAME/2023/", "*", "")
+    """
+    match = WILDCARDS.search(pattern)
+    if match is None:
+        return pattern, "", ""
+
+    start = pattern.rfind("/", 0, match.start()) + 1
+    end = pattern.find("/", match.start())
+    if end == -1:
+        return pattern[:start], pattern[start:], ""
+    return pattern[:start], pattern[start:end], pattern[end + 1 :]
+
+
+def scan_prefix_for_subprefixes(prefix: str, start_after: str = "") -> list[str] | None:
+    """Scans a prefix for the prefixes directly under it, i.e. its directories
+
+    Objects of S3 are listed with a delimiter, page by page, such that only the keys of the
+    prefix itself are returned rather than every key under it.
+
+    Args:
+        prefix, str: The prefix to scan, ending with a slash, e.g. 's3://BUCKET_NAME/2023/'
+        start_after, str: A sub-prefix to scan from, or '' to scan all
+
+    Returns:
+        The sub-prefixes ending with a slash in order, from `start_after` on, or None if the
+        filesystem cannot be listed by prefix
+    """
+    if prefix.startswith("s3://"):
+        from duckingit.providers import Providers
+
+        return Providers.get_or_raise("aws").s3.list_prefixes(prefix, start_after=start_after)
+
+    if "://" in prefix or prefix == "":
+        return None
+
+    try:
+        entries = [entry.name for entry in os.scandir(prefix) if entry.is_dir()]
+    except FileNotFoundError:
+        return []
+
+    return sorted(
+        subprefix
+        for subprefix in (f"{prefix}{name}/" for name in entries)
+        if subprefix >= start_after
+    )
+
+
+class ListingCache:
+    """A cache of the listings of the files of globs, kept for `session.listing_ttl_seconds`
+
+    A glob is listed concurrently by splitting it at its first path component with a
+    wildcard, i.e. the sub-prefixes matching the component are listed first, and then the rest
+    of the glob under each sub-prefix by up to `session.listing_concurrency` threads, e.g.
+    s3://BUCKET_NAME/year=*/month=*/* is listed as s3://BUCKET_NAME/year=2023/month=*/* etc.
+    The globs of a source are listed concurrently as well, while its paths without a wildcard
+    are listed at once. If `session.listing_incremental` is set, the sources are taken to be
+    append-only in the order of their sub-prefixes, e.g. partitioned by date, thus an expired
+    listing is refreshed by listing the last sub-prefix seen and the ones after it only, while
+    the listings of the sub-prefixes before it are kept.
+
+    Methods:
+        paths: Returns the paths of the files of a source
+        prefixes: Returns the prefixes of the files of a source
+        glob: Returns the paths of the files matching a glob
+        clear: Removes all listings from the cache
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._listings: OrderedDict[str, Listing] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._listings)
+
+    def paths(self, source: str) -> list[str]:
+        """Returns the paths of the files of a source in order
+
+        Args:
+            source, str: The source to list, e.g. "['s3://BUCKET_NAME/2023/*']"
+        """
+        from duckingit._config import DuckConfig
+
+        patterns = re.findall(r"'([^']*)'", source) or [source]
+        globs = [pattern for pattern in patterns if WILDCARDS.search(pattern)]
+        files = sorted(pattern for pattern in patterns if not WILDCARDS.search(pattern))
+
+        concurrency = min(DuckConfig().session.listing_concurrency, max(len(globs), 1))
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            listed = list(executor.map(self.glob, globs))
+        if files:
+            listed.append(self.glob(str(files)))
+
+        return sorted(set(flatten_list(listed)))
+
+    def prefixes(self, source: str) -> list[str]:
+        """Returns the prefixes of the files of a source in order, e.g. 's3://BUCKET_NAME/2023/*'
+
+        Args:
+            source, str: The source to list, e.g. "['s3://BUCKET_NAME/2023/*']"
+        """
+        return sorted(set(f"{path.rsplit('/', 1)[0]}/*" for path in self.paths(source)))
+
+    def glob(self, pattern: str) -> list[str]:
+        """Returns the paths of the files matching a glob, or of a list of paths, e.g.
+        "['s3://BUCKET_NAME/2023/01.parquet']", listed only if the cached listing has expired"""
+        from duckingit._config import DuckConfig
+
+        conf = DuckConfig().session
+        with self._lock:
+            listing = self._listings.get(pattern)
+            if listing is not None:
+                self._listings.move_to_end(pattern)
+
+        now = time.monotonic()
+        if listing is not None and now - listing.listed_at <= conf.listing_ttl_seconds:
+            return listing.paths
+
+        previous = listing if conf.listing_incremental else None
+        listing = self._list(pattern, previous=previous, concurrency=conf.listing_concurrency)
+        if conf.listing_ttl_seconds == 0 and not conf.listing_incremental:
+            return listing.paths
+
+        with self._lock:
+            self._listings[pattern] = listing
+            while len(self._listings) > MAX_LISTINGS:
+                self._listings.popitem(last=False)
+
+        return listing.paths
+
+    def clear(self) -> None:
+        with self._lock:
+            self._listings.clear()
+
+    def _list(self, pattern: str, previous: Listing | None, concurrency: int) -> Listing:
+        now = time.monotonic()
+
+        # A glob is listed at once if it cannot be split into sub-prefixes, e.g. a recursive
+        # glob, whose files may be directly under the prefix
+        if pattern.startswith("["):
+            return Listing(paths=scan_source_for_paths(source=pattern), listed_at=now)
+
+        prefix, component, rest = split_glob(pattern)
+        subprefixes = None
+        if rest != "" and "**" not in component:
+            kept: dict[str, list[str]] = {}
+            start_after = ""
+            if previous is not None and previous.subprefixes:
+                start_after = max(previous.subprefixes)
+                kept = {k: v for k, v in previous.subprefixes.items() if k < start_after}
+
+            subprefixes = scan_prefix_for_subprefixes(prefix, start_after=start_after)
+
+        if subprefixes is None:
+            return Listing(paths=scan_source_for_paths(source=f"'{pattern}'"), listed_at=now)
+
+        subprefixes = [
+            subprefix
+            for subprefix in subprefixes
+            if fnmatch.fnmatchcase(subprefix[len(prefix) : -1], component)
+        ]
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            listed = executor.map(
+                lambda subprefix: scan_source_for_paths(source=f"'{subprefix}{rest}'"),
+                subprefixes,
+            )
+            listings = {**kept, **dict(zip(subprefixes, listed))}
+
+        return Listing(
+            paths=sorted(flatten_list(list(listings.values()))),
+            listed_at=now,
+            subprefixes=listings,
+        )
+
+
+# Listings are shared by the sessions, as sources are listed by the parser of any query
+LISTINGS = ListingCache()
@@ -1,4 +1,7 @@
+import ast
 import copy
+import fnmatch
+import itertools
 import re
 import typing as t
 from dataclasses import dataclass
@@ -7,7 +10,25 @@ import sqlglot
 import sqlglot.expressions as exp
 
 from duckingit._exceptions import InvalidFilesystem, ParserError
-from duckingit._utils import create_hash_string, scan_source_for_prefixes
+from duckingit._listing import LISTINGS
+from duckingit._statistics import StatisticsIndex
+from duckingit._utils import (
+    create_hash_string,
+    match_hive_partitions,
+    scan_source_parquet_metadata,
+    scan_source_parquet_statistics,
+)
+
+# Comparisons of a column and a literal that can filter the files of a source, e.g. year = 2023
+FILTER_OPERATORS: dict[t.Type[exp.Expression], str] = {
+    exp.EQ: "=",
+    exp.NEQ: "!=",
+    exp.LT: "<",
+    exp.LTE: "<=",
+    exp.GT: ">",
+    exp.GTE: ">=",
+}
+FLIPPED_OPERATORS = {"=": "=", "!=": "!=", "<": ">", "<=": ">=", ">": "<", ">=": "<="}
 
 
 @dataclass
@@ -16,7 +37,10 @@ class Query:
     hashed: str
     ast: exp.Expression
 
+    _pruned_source: str | None = None
     _list_of_prefixes: list[str] | None = None
+    _list_of_row_groups: list[tuple[str, int, int, int]] | None = None
+    _list_of_statistics: list[tuple] | None = None
 
     @classmethod
     def parse(cls, query: str):
@@ -37,9 +61,79 @@ class Query:
     @property
     def list_of_prefixes(self) -> list[str]:
         if self._list_of_prefixes is None:
-            self._list_of_prefixes = scan_source_for_prefixes(source=self.source)
+            self._list_of_prefixes = LISTINGS.prefixes(source=self.pruned_source)
         return self._list_of_prefixes
 
+    @property
+    def list_of_row_groups(self) -> list[tuple[str, int, int, int]]:
+        """Returns the row groups of the parquet files of the source, i.e. the file, row
+        group id, number of rows and compressed size in bytes"""
+        if self._list_of_row_groups is None:
+            from duckingit._config import DuckConfig
+
+            path = DuckConfig().session.statistics_path
+            if path == "":
+                self._list_of_row_groups = scan_source_parquet_metadata(source=self.pruned_source)
+            else:
+                self._list_of_row_groups = self._skip_row_groups(StatisticsIndex(path, self.source))
+        return self._list_of_row_groups
+
+    @property
+    def list_of_statistics(self) -> list[tuple]:
+        """Returns the statistics of each column of each row group of the parquet files of the
+        source, as in the index of `session.statistics_path` if any, see `STATISTICS_SCHEMA`"""
+        if self._list_of_statistics is None:
+            from duckingit._config import DuckConfig
+
+            path = DuckConfig().session.statistics_path
+            if path == "":
+                self._list_of_statistics = scan_source_parquet_statistics(source=self.source)
+            else:
+                self._list_of_statistics = StatisticsIndex(path, self.source).statistics
+        return self._list_of_statistics
+
+    def _skip_row_groups(self, index: StatisticsIndex) -> list[tuple[str, int, int, int]]:
+        """Returns the row groups of the files of the source that may hold rows passing the
+        WHERE clause by the statistics of the index, and aren't pruned by hive partitions"""
+        files = index.match(self.source_filters)
+        if self.pruned_source != self.source:
+            # The globs of the directories left, see `pruned_source`
+            globs = ast.literal_eval(self.pruned_source)
+            files = [
+                file
+                for file in files
+                if any(
+                    file.rsplit("/", 1)[0] == glob.rsplit("/", 1)[0]
+                    and fnmatch.fnmatchcase(file, glob)
+                    for glob in globs
+                )
+            ]
+
+        # A file is kept even if all are skipped, such that the scan still knows the schema
+        row_groups = index.row_groups(files=files)
+        return row_groups or index.row_groups()[:1]
+
+    @property
+    def list_of_files(self) -> list[tuple[str, int]]:
+        """Returns the parquet files of the source and their compressed size in bytes"""
+        files: dict[str, int] = {}
+        for file, _, _, size in self.list_of_row_groups:
+            files[file] = files.get(file, 0) + size
+        return list(files.items())
+
+    @property
+    def format(self) -> str:
+        """Returns the format of the source, e.g. parquet, json or csv"""
+        for table in self.tables:
+            table = str(table).upper()
+
+            if table.startswith("READ_JSON"):
+                return "json"
+            elif table.startswith("READ_CSV"):
+                return "csv"
+
+        return "parquet"
+
     @property
     def tables(self) -> t.Generator:
         """Returns a generator that yields over table expressions, e.g. READ_PARQUET(VALUES(XX))"""
@@ -88,6 +182,112 @@ class Query:
             "An acceptable filesystem, e.g. 's3://BUCKET_NAME/*', couldn't be found."
         )
 
+    @property
+    def source_filters(self) -> list[tuple[str, str, list[str | float]]]:
+        """Returns the conditions of the WHERE clause over the source that compare a column
+        with literals or NULL, i.e. filters of the files of the source by their hive partitions
+        or statistics, e.g. ('year', '=', [2023.0]) or ('amount', 'IS NOT NULL', [])"""
+        for table in self.tables:
+            if not re.search(r"ARRAY\(", str(table)):
+                continue
+
+            # Conditions of a join may refer to the columns of other tables
+            select = table.find_ancestor(exp.Select)
+            if select is None or select.args.get("joins") or not select.args.get("where"):
+                return []
+
+            condition = select.args["where"].this
+            conditions = (
+                list(condition.flatten()) if isinstance(condition, exp.And) else [condition]
+            )
+
+            filters = []
+            for condition in conditions:
+                inner = condition.this if isinstance(condition, exp.Not) else condition
+                if isinstance(inner, exp.Is) and isinstance(inner.expression, exp.Null):
+                    column, values = inner.this, []
+                    operator = "IS NULL" if inner is condition else "IS NOT NULL"
+                elif isinstance(condition, exp.In) and not condition.args.get("query"):
+                    column, operator, values = condition.this, "IN", condition.expressions
+                elif type(condition) in FILTER_OPERATORS:
+                    column, value = condition.this, condition.expression
+                    operator = FILTER_OPERATORS[type(condition)]
+                    if isinstance(column, exp.Literal):
+                        column, value, operator = value, column, FLIPPED_OPERATORS[operator]
+                    values = [value]
+                else:
+                    continue
+
+                if (
+                    not isinstance(column, exp.Column)
+                    or column.table not in ("", table.alias)
+                    or not all(isinstance(value, exp.Literal) for value in values)
+                ):
+                    continue
+
+                filters.append(
+                    (
+                        column.name,
+                        operator,
+                        [value.this if value.is_string else float(value.this) for value in values],
+                    )
+                )
+
+            return filters
+
+        return []
+
+    @property
+    def pruned_source(self) -> str:
+        """Returns the source without the hive partitions filtered out by the WHERE clause,
+        i.e. a list of a glob per directory left, e.g. s3://BUCKET_NAME/year=2023/*.parquet,
+        or the source itself if nothing can be pruned"""
+        if self._pruned_source is not None:
+            return self._pruned_source
+
+        self._pruned_source = self.source
+
+        filters = self.source_filters
+        if not filters:
+            return self._pruned_source
+
+        # Partitions compared to strings for equality are left out of the listing, e.g.
+        # s3://BUCKET_NAME/year=*/* is listed as s3://BUCKET_NAME/year=2023/*
+        patterns = re.findall(r"'([^']*)'", self.source)
+        for column, operator, values in filters:
+            if operator not in ("=", "IN") or not all(isinstance(v, str) for v in values):
+                continue
+
+            segment = re.compile(rf"/{re.escape(column)}=\*/", flags=re.IGNORECASE)
+            patterns = [
+                segment.sub(lambda match: f"{match.group(0)[:-2]}{value}/", pattern)
+                for pattern, value in itertools.product(patterns, values)
+            ]
+
+        paths = LISTINGS.paths(source=str(sorted(set(patterns))))
+        if not paths:
+            return self._pruned_source
+
+        # A file is kept even if all are pruned, such that the scan still knows the schema
+        kept = [path for path in paths if match_hive_partitions(path, filters)]
+        if not kept:
+            self._pruned_source = str(paths[:1])
+            return self._pruned_source
+
+        # The files of a directory are kept or pruned as a whole, thus a directory is listed
+        # by the last component of its pattern rather than file by file
+        globs: dict[str, None] = {}
+        for path in kept:
+            directory, name = path.rsplit("/", 1)
+            for pattern in patterns:
+                if fnmatch.fnmatchcase(path, pattern):
+                    name = pattern.rsplit("/", 1)[-1]
+                    break
+            globs[f"{directory}/{name}"] = None
+
+        self._pruned_source = str(list(globs))
+        return self._pruned_source
+
     def copy(self):
         """Returns a deep copy of the object itself"""
         return copy.deepcopy(self)
@@ -1,13 +1,28 @@
 import copy
+import decimal
+import math
+import threading
+import time
 import typing as t
-from dataclasses import dataclass
+from collections import OrderedDict
+from dataclasses import dataclass, field
 from enum import Enum
 
+import duckdb
 import sqlglot
 import sqlglot.expressions as exp
 
 from duckingit._parser import Query
-from duckingit._utils import create_hash_string, split_list_in_chunks
+from duckingit._utils import (
+    create_hash_string,
+    flatten_list,
+    sample_systematically,
+    scan_query_schema,
+    scan_source_schema,
+    split_list_in_bins,
+    split_list_in_chunks,
+    split_row_groups_in_ranges,
+)
 
 
 class Stages(Enum):
@@ -16,6 +31,7 @@ class Stages(Enum):
     SCAN = "SCAN"
     UNION = "UNION"
     SORT = "SORT"
+    METADATA = "METADATA"
 
     def __str__(self) -> str:
         return f"{self.value}"
@@ -25,14 +41,38 @@ class Stages(Enum):
 class Task:
     subquery: str
     subquery_hashed: str
+    partitions: int = 0
+    partition: int = 0
+    fingerprint: str = field(default="", compare=False)
+    files: list[str] = field(default_factory=list, compare=False)
 
     @classmethod
-    def create(cls, query: Query, files: list[str] | None = None):
+    def create(
+        cls,
+        query: Query,
+        files: list[str] | None = None,
+        rows: tuple[int, int] | None = None,
+        partitions: int = 0,
+        tables: list[exp.Expression] | None = None,
+        partition: int = 0,
+        fingerprint: str = "",
+    ):
         """Creates a task to execute on a serverless function
 
         Args:
             query, Query: A query parsed by the Query class
             files, list[str]: A list of files to scan
+            rows, tuple[int, int]: The first and last row number to scan of a parquet file.
+                Ranges aligned with row groups let DuckDB skip the other row groups
+            partitions, int: The number of files to write the output to by the `__partition`
+                column of the query. Defaults to a single file
+            tables, list[exp.Expression]: The tables to scan the files of. Defaults to the
+                tables of the FROM clauses
+            partition, int: The partition of shuffled dependencies the task reads
+            fingerprint, str: A fingerprint of the input of the task, which tells whether a
+                cached output of the task is still valid, see `CacheCatalog`
+            files, list[str]: The files or prefixes the task scans, whose versions are added
+                to the fingerprint before the task is invoked, see `CacheCatalog.fingerprint`
 
         Returns:
             Task<SUBQUERY | SUBQUERY_HASHED>
@@ -41,8 +81,13 @@ class Task:
         subquery = query.copy().sql
 
         if files:
-            for table in query.from_:
-                table = table.expressions[0]
+            if tables is None:
+                tables = [from_.expressions[0] for from_ in query.from_]
+
+            for table in tables:
+                if isinstance(table, exp.Subquery):
+                    continue
+
                 alias = table.alias
                 table = str(table).replace("ARRAY", "LIST_VALUE")  # Current sqlglot bug
 
@@ -53,14 +98,36 @@ class Task:
                     subquery = subquery.replace(table, f"{read_json}({files}) {alias}")
                 elif table[: len(read_csv)] == read_csv:
                     subquery = subquery.replace(table, f"{read_csv}({files}) {alias}")
+                elif rows is not None:
+                    first, last = rows
+                    subquery = subquery.replace(
+                        table,
+                        "(SELECT * EXCLUDE (file_row_number) "
+                        f"FROM READ_PARQUET({files}, file_row_number=true) "
+                        f"WHERE file_row_number BETWEEN {first} AND {last}) {alias}",
+                    )
                 else:
                     subquery = subquery.replace(table, f"READ_PARQUET({files}) {alias}")
 
-        return cls(subquery=subquery, subquery_hashed=create_hash_string(subquery))
+        return cls(
+            subquery=subquery,
+            subquery_hashed=create_hash_string(subquery),
+            partitions=partitions,
+            partition=partition,
+            fingerprint=fingerprint,
+            files=list(files or []),
+        )
 
     def __hash__(self) -> int:
         return hash(self.subquery)
 
+    def key(self, prefix: str) -> str:
+        """Returns the key of the output of the task at prefix, i.e. a parquet file or a
+        directory of a parquet file per partition"""
+        if self.partitions:
+            return f"{prefix}/{self.subquery_hashed}"
+        return f"{prefix}/{self.subquery_hashed}.parquet"
+
     def __repr__(self) -> str:
         return f"Task<QUERY='{self.subquery}' | HASH='{self.subquery_hashed}'>"
 
@@ -96,6 +163,12 @@ class Stage:
 
                 cte_stages[cte.alias] = stage
 
+        if isinstance(ast, exp.Union):
+            stage = Union.from_union(ast, cte_stages=cte_stages)
+            if previous_stage is not None:
+                previous_stage.add_dependency(stage)
+            return stage
+
         from_ = ast.args.get("from")
         if isinstance(ast, exp.Select) and from_:
             if len(from_.expressions) > 1:
@@ -135,7 +208,9 @@ class Stage:
 
                 if table_name in cte_stages:
                     cte = cte_stages[table_name]
-                    stage.replace_child_with_id(child=expression, id=cte.id, alias=expression.alias)
+                    stage.replace_child_with_id(
+                        child=expression, id=cte.id, alias=expression.alias or table_name
+                    )
                     stage.add_dependency(cte)
 
         else:
@@ -161,7 +236,9 @@ class Stage:
                 else:
                     if (table_name := join.this.sql()) in cte_stages:
                         cte = cte_stages[table_name]
-                        stage.replace_child_with_id(child=join, id=cte.id, alias=alias)
+                        stage.replace_child_with_id(
+                            child=join, id=cte.id, alias=alias or table_name
+                        )
                         stage.add_dependency(cte)
 
         if previous_stage is not None:
@@ -181,6 +258,29 @@ class Stage:
 
         self.tasks: t.Set[Task] = set()
 
+        # Number of tasks invoked twice to work around stragglers
+        self.speculative_copies: int = 0
+
+        # Number of hash partitions the output of each task is written to
+        self.partitions: int = 0
+
+        # The side of a broadcast join split across tasks, i.e. the id of a stage or the SQL of
+        # a source, while every task reads the other side in full
+        self.probe: str = ""
+
+        # The ids of the stages the output of a UNION ALL concatenates, in order, see `keys`
+        self.branches: list[str] = []
+
+        # The number of rows the stage outputs at most, such that its tasks are invoked in
+        # waves until enough rows are output, see `plan_limits`
+        self.limit: int = 0
+
+        # The share of the files or prefixes of the source the stage scans, see `plan_sample`
+        self.sample: float = 1.0
+
+        # The queries of the stage parsed so far, which keep the listing of their source
+        self._queries: dict[str, Query] = {}
+
     def __repr__(self) -> str:
         return f"{self.stage_type} - {self.id}: {self.sql}"
 
@@ -208,35 +308,166 @@ class Stage:
 
     @property
     def output(self) -> list[str]:
-        return list(task.subquery_hashed for task in self.tasks)
+        return list(task.subquery_hashed for task in self.parts)
+
+    def keys(self, prefix: str) -> list[str]:
+        """Returns the keys of the output of the stage at prefix, in order"""
+        if self.branches:
+            stages = {stage.id: stage for stage in self.dependencies}
+            return [key for branch in self.branches for key in stages[branch].keys(prefix)]
+        return [task.key(prefix) for task in self.parts]
+
+    @property
+    def fingerprint(self) -> str:
+        """A fingerprint of the output of the stage, i.e. of the input of its tasks, or of the
+        output of the branches of a UNION ALL"""
+        fingerprints = sorted(task.fingerprint for task in self.tasks)
+        if self.branches:
+            fingerprints = sorted(dependency.fingerprint for dependency in self.dependencies)
+        return create_hash_string("".join(fingerprints))
+
+    def parse(self, sql: str) -> Query:
+        """Parses a query of the stage once, such that the listing of its source is reused by
+        later executions of the plan, see `PlanCache`"""
+        if sql not in self._queries:
+            self._queries[sql] = Query.parse(sql)
+        return self._queries[sql]
+
+    @property
+    def parts(self) -> list[Task]:
+        """Returns the tasks in the order of their output, i.e. by the partition they read"""
+        return sorted(self.tasks, key=lambda task: (task.partition, task.subquery_hashed))
 
     def create_tasks(self, dependencies: dict[str, list[str]] = {}) -> None:
         # TODO: Focus on Stage ID in dependencies
         from duckingit._config import DuckConfig
 
+        if self.branches:
+            return  # The output of the branches is the output of the stage
+
         # Wide operations can only have 1 invokation
-        # Narrow operations like SCAN can have multiple invokations
-        invokations = DuckConfig().session.max_invokations if self.stage_type == Stages.SCAN else 1
+        # Narrow operations like SCAN can have multiple invokations, as well as the probe side
+        # of a broadcast join
+        narrow = self.stage_type == Stages.SCAN or self.probe != ""
+        invokations = DuckConfig().session.max_invokations if narrow else 1
 
-        query = Query.parse(self.sql)
-        if dependencies:
-            for _id, output in dependencies.items():
-                query.replace(_id, f"(SELECT * FROM READ_PARQUET({output}))")
+        query = self.parse(self.sql)
 
-            self.tasks.add(Task.create(query=query))
+        # The input of a task is the output of the dependencies, and the files it scans
+        inputs = "".join(sorted(dependency.fingerprint for dependency in self.dependencies))
 
+        if not dependencies:
+            queries = [(0, query)]
         else:
-            files = query.list_of_prefixes
+            # A task per partition of shuffled dependencies, see `partitions`, and per output
+            # of the probe side of a broadcast join, see `probe`
+            partitions = {d.id: d.partitions for d in self.dependencies if d.partitions}
+            probes = [[output] for output in dependencies.get(self.probe, [])] or [[]]
+
+            queries = []
+            for partition in range(max(partitions.values(), default=1)):
+                for probe in probes:
+                    partition_query = query.copy()
+                    for _id, output in dependencies.items():
+                        if _id in partitions:
+                            output = [f"{directory}/{partition}.parquet" for directory in output]
+                        elif _id == self.probe:
+                            output = probe
+                        partition_query.replace(_id, f"(SELECT * FROM READ_PARQUET({output}))")
+
+                    queries.append((partition, partition_query))
+
+            if self.probe == "" or self.probe in dependencies:
+                for partition, partition_query in queries:
+                    self.tasks.add(
+                        Task.create(
+                            query=partition_query,
+                            partitions=self.partitions,
+                            partition=partition,
+                            fingerprint=create_hash_string(inputs),
+                        )
+                    )
+                return
+
+        # The source is split across tasks, i.e. the source of the FROM clause, or the source
+        # on the probe side of a broadcast join
+        source, tables = query, None
+        if self.probe:
+            source = self.parse(f"SELECT * FROM {self.probe}")
+            tables = [table for table in query.tables if table.sql() == self.probe]
+
+        sizes = dict(source.list_of_files) if source.format == "parquet" else {}
+        for files, rows in self._split_source(source, invokations=invokations):
+            fingerprint = create_hash_string(inputs + repr([(f, sizes.get(f)) for f in files]))
+            for partition, partition_query in queries:
+                self.tasks.add(
+                    Task.create(
+                        query=partition_query,
+                        files=files,
+                        rows=rows,
+                        partitions=self.partitions,
+                        tables=tables,
+                        partition=partition,
+                        fingerprint=fingerprint,
+                    )
+                )
+
+    def _split_source(
+        self, query: Query, invokations: int | str
+    ) -> list[tuple[list[str], tuple[int, int] | None]]:
+        """Splits the source of a query across invokations
+
+        Args:
+            query, Query: The query of the source to split
+            invokations, int | str: The maximum number of invokations, or 'auto'
+
+        Returns:
+            A list of files to scan per invokation, and the range of rows to scan if a single
+            parquet file is scanned by ranges of row groups
+        """
+        from duckingit._config import DuckConfig
+
+        splits: list[tuple[list[str], tuple[int, int] | None]] = []
+        if query.format == "parquet":
+            # Balance the invokations by the compressed size of the files
+            files = sample_systematically(query.list_of_files, self.sample, seed=query.source)
+
+            bytes_per_invokation = DuckConfig().session.bytes_per_invokation
+            total_bytes = sum(size for _, size in files)
+            if isinstance(invokations, int):
+                bytes_per_invokation = max(
+                    bytes_per_invokation, math.ceil(total_bytes / invokations)
+                )
+
+            # Files too large for a single invokation are scanned by ranges of row groups
+            large_files = set(file for file, size in files if size > bytes_per_invokation)
+            for file in sorted(large_files):
+                row_groups = [
+                    (num_rows, size)
+                    for file_name, _, num_rows, size in query.list_of_row_groups
+                    if file_name == file
+                ]
+                for rows in split_row_groups_in_ranges(row_groups, max_bytes=bytes_per_invokation):
+                    splits.append(([file], rows))
+
+            files = [(file, size) for file, size in files if file not in large_files]
+            number_of_invokations = math.ceil(sum(size for _, size in files) / bytes_per_invokation)
+
+            for chunk in split_list_in_bins(files, number_of_bins=number_of_invokations):
+                splits.append((chunk, None))
+
+        else:
+            prefixes = sample_systematically(query.list_of_prefixes, self.sample, seed=query.source)
 
             if isinstance(invokations, str):
-                invokations = len(files)
+                invokations = len(prefixes)
+
+            chunks_of_prefixes = split_list_in_chunks(prefixes, number_of_invokations=invokations)
 
-            # TODO: Heuristic to divide the workload between the invokations based on size
-            # of prefixes / number of files etc. Or based on some deeper analysis of the query?
-            chunks_of_files = split_list_in_chunks(files, number_of_invokations=invokations)
+            for chunk in chunks_of_prefixes:
+                splits.append((chunk, None))
 
-            for chunk in chunks_of_files:
-                self.tasks.add(Task.create(query=query, files=chunk))
+        return splits
 
     def add_dependency(self, dependency: "Stage") -> None:
         self.dependencies.add(dependency)
@@ -281,13 +512,331 @@ class Union(Stage):
     def __init__(self):
         super().__init__()
 
+        # The types the columns of the branches are cast to, if they're known, see `union_types`
+        self.types: list[exp.DataType] = []
+
+    @classmethod
+    def from_union(cls, ast: exp.Union, cte_stages: dict = {}) -> Stage:
+        """Plans each branch of a UNION as a stage of its own
+
+        The output of a UNION ALL is the output of its branches concatenated, unless the
+        columns of the branches cannot be matched, i.e. they are neither all `*` of the same
+        columns nor all lists of columns of the same length. As the output is read without the
+        coercion of the types of a union, the lists of columns are cast to the types of the
+        union, see `union_types`. The branches of a UNION deduplicate their rows in each task,
+        before the union deduplicates the rows of all branches.
+
+        Args:
+            ast, exp.Union: The union
+            cte_stages, dict: The stages of the CTEs in scope
+
+        Returns:
+            The stage of the union, or a sort of the union on top of it
+        """
+        if type(ast) is not exp.Union:
+            raise NotImplementedError("Cannot handle INTERSECT or EXCEPT yet")
+
+        distinct = bool(ast.args.get("distinct"))
+
+        # An ORDER BY or LIMIT of the last branch, unless in parentheses, applies to the union
+        last = ast.right
+        while isinstance(last, exp.Union):
+            last = last.right
+        if isinstance(last, exp.Select):
+            for arg in ("order", "limit", "offset"):
+                if last.args.get(arg):
+                    ast.set(arg, last.args[arg])
+                    last.set(arg, None)
+
+        def flatten(node: exp.Expression) -> list[exp.Expression]:
+            if isinstance(node, exp.Subquery):
+                node = node.this
+            if (
+                type(node) is exp.Union
+                and bool(node.args.get("distinct")) == distinct
+                and not any(node.args.get(arg) for arg in ("order", "limit", "offset"))
+            ):
+                return flatten(node.left) + flatten(node.right)
+            return [node]
+
+        branches = flatten(ast.left) + flatten(ast.right)
+
+        selects = [branch for branch in branches if isinstance(branch, exp.Select)]
+        stars = len(selects) == len(branches) and all(
+            isinstance(expression, exp.Star) for s in selects for expression in s.expressions
+        )
+        names = [expression.alias_or_name for expression in branches[0].expressions]
+        columns = (
+            len(selects) == len(branches)
+            and all(names)
+            and not any(s.find(exp.Star) for s in selects)
+            and all(len(s.expressions) == len(names) for s in selects)
+        )
+
+        # The output of the branches is read as is, i.e. by the types and names of the columns
+        # of each branch rather than the types of the union and the positions of the columns
+        types = union_types(branches) if columns else None
+        if stars:
+            schemas = [
+                describe(f"SELECT * FROM ({branch.sql(dialect='duckdb')})") for branch in branches
+            ]
+            stars = schemas[0] is not None and all(schema == schemas[0] for schema in schemas)
+
+        for branch in selects if columns else []:
+            # The columns of the branches are matched by position in SQL
+            expressions = [expression.unalias() for expression in branch.expressions]
+            if types:
+                expressions = [exp.cast(e, type_) for e, type_ in zip(expressions, types)]
+            branch.set(
+                "expressions",
+                [exp.alias_(expression, name) for expression, name in zip(expressions, names)],
+            )
+
+        stages = [Stage.from_ast(branch, cte_stages=cte_stages) for branch in branches]
+
+        # Each task of a branch deduplicates its own rows, thus the branch is still a scan
+        for branch, branch_stage in zip(branches, stages) if distinct else []:
+            if isinstance(branch, exp.Select) and isinstance(branch_stage.ast, exp.Select):
+                branch_stage.ast.set("distinct", exp.Distinct())
+
+        stage = cls()
+        operator = " UNION " if distinct else " UNION ALL "
+        stage.ast = sqlglot.parse_one(operator.join(f"SELECT * FROM {s.id}" for s in stages))
+        stage.id = create_hash_string(ast.sql(), digits=6, first_char="$")
+        stage.types = types or []
+        for branch_stage in stages:
+            stage.add_dependency(branch_stage)
+
+        if not distinct and (stars or types):
+            stage.branches = [branch_stage.id for branch_stage in stages]
+
+        if not any(ast.args.get(arg) for arg in ("order", "limit", "offset")):
+            return stage
+
+        top = Sort()
+        top.ast = exp.Select(expressions=[exp.Star()]).from_(stage.id)
+        for arg in ("order", "limit", "offset"):
+            top.ast.set(arg, ast.args.get(arg))
+        top.id = create_hash_string(top.sql, digits=6, first_char="$")
+        top.add_dependency(stage)
+        return top
+
+
+class Metadata(Stage):
+    """Answers an aggregation of a parquet source from the statistics in the footers of its
+    files, i.e. in the session without invoking any serverless function
+
+    The aggregation must consist of COUNT, MIN and MAX of the columns of a single parquet
+    source without any filters, e.g. SELECT COUNT(*), MAX(ts) FROM READ_PARQUET([...]). The
+    answer is a single task of constants, or no task at all if the statistics are incomplete,
+    in which case the plan is executed as usual.
+    """
+
+    stage_type = Stages.METADATA
+
+    def __init__(self):
+        super().__init__()
+
+    @classmethod
+    def from_select(cls, ast: exp.Expression) -> "Metadata | None":
+        """Returns a stage answering the aggregation, or None if the statistics cannot"""
+        if not isinstance(ast, exp.Select) or not ast.args.get("from"):
+            return None
+
+        if any(
+            ast.args.get(arg)
+            for arg in (
+                "joins",
+                "where",
+                "group",
+                "having",
+                "qualify",
+                "distinct",
+                "order",
+                "limit",
+                "offset",
+                "with",
+            )
+        ) or ast.find(exp.Window, exp.Subquery):
+            return None
+
+        froms = ast.args["from"].expressions
+        if len(froms) != 1 or not isinstance(froms[0], exp.Table):
+            return None
+        table = froms[0]
+        if not isinstance(table.this, exp.Func) or Query.parse(ast.sql()).format != "parquet":
+            return None
+
+        aggregates = [
+            agg for expression in ast.expressions for agg in expression.find_all(exp.AggFunc)
+        ]
+        if len(aggregates) == 0:
+            return None
+
+        for agg in aggregates:
+            arg = agg.this
+            if isinstance(agg, exp.Count) and (
+                isinstance(arg, exp.Star)
+                or isinstance(arg, exp.Literal)
+                or isinstance(arg, exp.Column)
+            ):
+                pass
+            elif isinstance(agg, (exp.Min, exp.Max)) and isinstance(arg, exp.Column):
+                pass
+            else:
+                return None
+
+            if isinstance(arg, exp.Column) and arg.table not in ("", table.alias):
+                return None
+
+        # Columns outside of the aggregates are unknown
+        for expression in ast.expressions:
+            for column in expression.find_all(exp.Column):
+                if not column.find_ancestor(exp.AggFunc):
+                    return None
+
+        stage = cls()
+        stage.ast = ast.copy()
+        stage.id = create_hash_string(stage.sql, digits=6, first_char="$")
+        return stage
+
+    def create_tasks(self, dependencies: dict[str, list[str]] = {}) -> None:
+        answer = self.answer()
+        if answer is not None:
+            self.tasks.add(Task.create(query=Query.parse(answer)))
+
+    def answer(self) -> str | None:
+        """Returns a query of the answer as constants, or None if it cannot be answered by the
+        statistics of the row groups, e.g. as some of them lack min/max values"""
+        table = self.ast.args["from"].expressions[0]  # type: ignore
+        source = self.parse(f"SELECT * FROM {table.sql()}")
+        statistics = source.list_of_statistics
+
+        row_groups: dict[tuple[str, int], dict[str, tuple]] = {}
+        for row in statistics:
+            file, row_group_id, _, column = row[:4]
+            row_groups.setdefault((file, row_group_id), {})[column.lower()] = row
+
+        num_rows = {key: row[2] for key, columns in row_groups.items() for row in columns.values()}
+        types: dict[str, str] = {}
+        if statistics:
+            types = {
+                name.lower(): type_
+                for name, type_ in scan_source_schema(source=str([statistics[0][0]])).items()
+            }
+
+        def constant(agg: exp.AggFunc) -> str | None:
+            if isinstance(agg, exp.Count) and not isinstance(agg.this, exp.Column):
+                return f"CAST({sum(num_rows.values())} AS BIGINT)"
+
+            column = agg.this.name.lower()
+            values, physical = [], None
+            for key, columns in row_groups.items():
+                row = columns.get(column)
+                if row is None or row[7] is None:
+                    return None  # E.g. a column of a hive partition, or a nested column
+
+                physical = row[4]
+                if isinstance(agg, exp.Count):
+                    values.append(num_rows[key] - row[7])
+                elif row[7] < num_rows[key]:
+                    values.append(row[5] if isinstance(agg, exp.Min) else row[6])
+
+            if isinstance(agg, exp.Count):
+                return f"CAST({sum(values)} AS BIGINT)"
+
+            # Min/max values of strings and floats may be truncated or leave out NaNs, and
+            # only the ones of integers, decimals, dates and timestamps are exact
+            type_ = types.get(column)
+            if type_ is None or any(value is None for value in values):
+                return None
+            if len(values) == 0:
+                return f"CAST(NULL AS {type_})"
+            if physical not in ("INT32", "INT64", "FIXED_LEN_BYTE_ARRAY", "BOOLEAN") or (
+                physical == "FIXED_LEN_BYTE_ARRAY" and not type_.startswith("DECIMAL")
+            ):
+                return None
+
+            pick = min if isinstance(agg, exp.Min) else max
+            value = pick(values, key=ordered)
+            return f"CAST('{value}' AS {type_})"
+
+        answers: dict[exp.AggFunc, exp.Expression] = {}
+        for expression in self.ast.expressions:  # type: ignore
+            for agg in expression.find_all(exp.AggFunc):
+                answer = constant(agg)
+                if answer is None:
+                    return None
+                answers[agg] = sqlglot.parse_one(answer)
+
+        expressions = []
+        for expression in self.ast.expressions:  # type: ignore
+            if not isinstance(expression, exp.Alias):
+                # Keep the name of the column in the output
+                expression = exp.alias_(expression.copy(), expression.sql(), quoted=True)
+            expressions.append(
+                expression.transform(
+                    lambda node: answers[node].copy() if node in answers else node  # type: ignore
+                )
+            )
+
+        return exp.Select(expressions=expressions).sql(dialect="duckdb")
+
+
+def describe(sql: str) -> list[tuple[str, str]] | None:
+    """Returns the names and DuckDB types of the columns a query outputs, or None if the query
+    cannot be described by itself, e.g. as it refers to a CTE"""
+    try:
+        return scan_query_schema(sql)
+    except duckdb.Error:
+        return None
+
+
+def union_types(branches: list[exp.Expression]) -> list[exp.DataType] | None:
+    """Returns the types the columns of the branches of a union are coerced to
+
+    Args:
+        branches, list[exp.Expression]: The branches of the union
+
+    Returns:
+        The types by position, or None if they're unknown, or nested types, which sqlglot
+        cannot cast to in DuckDB SQL
+    """
+    schema = describe(
+        " UNION ALL ".join(f"SELECT * FROM ({branch.sql(dialect='duckdb')})" for branch in branches)
+    )
+    if schema is None:
+        return None
+
+    try:
+        types = [exp.DataType.build(type_, dialect="duckdb") for _, type_ in schema]
+    except sqlglot.errors.ParseError:
+        return None
+    if any(type_.args.get("nested") for type_ in types):
+        return None
+    return types
+
+
+def ordered(value: str) -> t.Any:
+    """Returns a min/max value of the statistics of a row group in a form that orders like in
+    DuckDB, i.e. numbers as numbers, while dates, timestamps and booleans order as strings"""
+    try:
+        return decimal.Decimal(value)
+    except decimal.InvalidOperation:
+        return value
+
 
 def select_stage_type(ast: exp.Expression):
     group = ast.args.get("group")
-    agg = list(i for i in ast.expressions if isinstance(i, exp.AggFunc))
+    agg = list(i for i in ast.expressions if i.find(exp.AggFunc))
     if group or agg:
         return Aggregate()
 
+    # Deduplicating rows and windows need all the rows at once, just like aggregates
+    window = list(i for i in ast.expressions if i.find(exp.Window))
+    if ast.args.get("distinct") or ast.args.get("qualify") or window:
+        return Aggregate()
+
     sort = ast.args.get("order")
     if sort:
         return Sort()
@@ -295,6 +844,1155 @@ def select_stage_type(ast: exp.Expression):
     return Scan()
 
 
+def references(stage: Stage, dependency: Stage) -> t.Set[str]:
+    """Returns the names a stage refers to a dependency by, i.e. its alias or its id"""
+    names = set()
+    for node in stage.ast.find_all(exp.Column, exp.Table) if stage.ast else []:
+        if node.name == dependency.id:
+            alias = node.parent.alias if isinstance(node.parent, exp.Alias) else node.alias
+            names.add(alias or dependency.id)
+    return names
+
+
+def is_read_more_than_once(stage: Stage, dependency: Stage) -> bool:
+    """Tells whether a stage reads a dependency more than once, e.g. under two aliases"""
+    tables = [
+        node
+        for node in (stage.ast.find_all(exp.Table) if stage.ast else [])
+        if node.name == dependency.id
+    ]
+    return len(tables) > 1 or len(references(stage, dependency)) > 1
+
+
+def columns_of(stage: Stage, dependency: Stage) -> list[exp.Column] | None:
+    """Returns the columns of a dependency a stage refers to
+
+    Args:
+        stage, Stage: The stage
+        dependency, Stage: A dependency of the stage
+
+    Returns:
+        The columns, or None if the stage refers to all columns of the dependency, or the
+        columns cannot be told apart from the columns of other sources without a schema
+    """
+    ast = stage.ast
+    if not isinstance(ast, exp.Select) or len(list(ast.find_all(exp.Select))) > 1:
+        return None
+
+    names = references(stage, dependency)
+    single = not ast.args.get("joins")
+
+    for expression in ast.expressions:
+        if isinstance(expression, exp.Star):
+            return None
+        if isinstance(expression.this, exp.Star) and (single or expression.table in names):
+            return None  # E.g. alias.*
+
+    # Columns of the output of the stage can be referred to by their alias
+    aliases = {e.alias: e.this for e in ast.expressions if isinstance(e, exp.Alias)}
+
+    columns = []
+    for column in ast.find_all(exp.Column):
+        if column.name.startswith("$") or isinstance(column.this, exp.Star):
+            continue  # The id of a dependency
+
+        if column.table:
+            if column.table in names:
+                columns.append(column)
+        elif not single:
+            return None
+        elif column.name in aliases and aliases[column.name] != exp.column(column.name):
+            return None
+        else:
+            columns.append(column)
+    return columns
+
+
+def push_down_predicates_and_projections(root: Stage) -> None:
+    """Pushes filters and the columns referred to down into scan stages
+
+    The conditions of a WHERE clause that only refer to the columns of a scan stage are
+    moved to the scan, unless the scan is on the side of an outer join that is filled with
+    NULLs. The columns of a scan that no stage refers to are left out of the output of the
+    scan, e.g. a `SELECT *` of a CTE only outputs the columns the query refers to. Either
+    way, the output of the scan stages is smaller.
+
+    Note that the optimizer of sqlglot needs the schema of the sources to do the same.
+
+    Args:
+        root, Stage: The root of the stages to optimize
+    """
+    # The dependents of a stage are visited before the stage itself
+    stages: list[Stage] = []
+    nodes = [root]
+    while nodes:
+        stage = nodes.pop(0)
+        if stage in stages:
+            stages.remove(stage)
+        stages.append(stage)
+        nodes.extend(stage.dependencies)
+
+    for stage in stages:
+        scan = stage.ast
+        if stage.stage_type != Stages.SCAN or not isinstance(scan, exp.Select):
+            continue
+        if any(scan.args.get(arg) for arg in ("limit", "offset", "distinct", "qualify")):
+            continue
+        if scan.find(exp.Window) or not stage.dependents:
+            continue
+        if any(is_read_more_than_once(dependent, stage) for dependent in stage.dependents):
+            continue  # E.g. a self-join of a CTE, whose sides share the output of the scan
+
+        # The output columns of the scan by name, where `*` passes on any column by name
+        star = any(isinstance(expression, exp.Star) for expression in scan.expressions)
+        outputs = {e.alias_or_name: e.unalias() for e in scan.expressions if e.alias_or_name}
+
+        if len(stage.dependents) == 1:
+            dependent = next(iter(stage.dependents))
+            predicates = push_down_predicates(dependent, stage, star=star, outputs=outputs)
+            if predicates is not None:
+                stage.ast = scan = scan.where(predicates)
+
+        needed: list[str] = []
+        for dependent in stage.dependents:
+            columns = columns_of(dependent, stage)
+            if columns is None:
+                break
+            for column in columns:
+                if column.name not in needed:
+                    needed.append(column.name)
+        else:
+            if len(needed) == 0:
+                continue
+
+            expressions = [
+                expression
+                for expression in scan.expressions
+                if not isinstance(expression, exp.Star)
+                and (expression.alias_or_name in needed or not expression.alias_or_name)
+            ]
+            if star:
+                names = set(expression.alias_or_name for expression in expressions)
+                expressions += [exp.column(name) for name in needed if name not in names]
+            if expressions:
+                scan.set("expressions", expressions)
+
+
+def push_down_predicates(
+    stage: Stage, dependency: Stage, star: bool, outputs: dict[str, exp.Expression]
+) -> exp.Expression | None:
+    """Removes the conditions of the WHERE clause of a stage that can be applied by a scan
+
+    Args:
+        stage, Stage: The stage to remove the conditions of
+        dependency, Stage: The scan the stage depends on
+        star, bool: Whether the scan outputs all columns of its source
+        outputs, dict[str, exp.Expression]: The expressions of the output columns of the scan
+
+    Returns:
+        The conditions in terms of the scan, or None if no conditions can be pushed down
+    """
+    ast = stage.ast
+    if not isinstance(ast, exp.Select) or not ast.args.get("where"):
+        return None
+
+    names = references(stage, dependency)
+    joins = ast.args.get("joins") or []
+    if len(joins) > 1:
+        return None
+    if joins:
+        # The rows of a side filled with NULLs by an outer join cannot be filtered in advance
+        join = joins[0]
+        is_left = ast.args["from"].expressions[0].unalias().name == dependency.id
+        if join.side == "FULL" or join.side == ("RIGHT" if is_left else "LEFT"):
+            return None
+
+    aliases = {e.alias for e in ast.expressions if isinstance(e, exp.Alias)}
+
+    condition = ast.args["where"].this
+    conditions = list(condition.flatten()) if isinstance(condition, exp.And) else [condition]
+
+    pushed, kept = [], []
+    for condition in conditions:
+        columns = list(condition.find_all(exp.Column))
+        if (
+            len(columns) == 0
+            or condition.find(exp.AggFunc, exp.Window, exp.Subquery, exp.Select)
+            or not all(
+                (column.table in names if column.table else not joins)
+                and column.name not in aliases
+                and (star or column.name in outputs)
+                for column in columns
+            )
+        ):
+            kept.append(condition)
+            continue
+
+        pushed.append(
+            condition.transform(
+                lambda node: (
+                    outputs.get(node.name, exp.column(node.name)).copy()
+                    if isinstance(node, exp.Column)
+                    else node
+                )
+            )
+        )
+
+    if len(pushed) == 0:
+        return None
+
+    ast.set("where", exp.Where(this=exp.and_(*kept)) if kept else None)
+    return exp.and_(*pushed)
+
+
+# Aggregates that can be computed from partial aggregates of parts of the data
+DECOMPOSABLE_AGGREGATES = (
+    exp.Sum,
+    exp.Count,
+    exp.Min,
+    exp.Max,
+    exp.Avg,
+    exp.AnyValue,
+    exp.LogicalAnd,
+    exp.LogicalOr,
+)
+
+
+def split_aggregation(ast: exp.Expression) -> tuple[exp.Select, exp.Select] | None:
+    """Splits an aggregation into a partial and a final aggregation
+
+    The partial aggregation keeps the FROM and WHERE clause of the aggregation, and outputs
+    the group keys as `__key_<i>` and the partial aggregates as `__agg_<i>`. The final
+    aggregation merges the partial aggregates per group, e.g. an AVG is the SUM of partial
+    sums divided by the SUM of partial counts. Its FROM clause is left to the caller.
+
+    Args:
+        ast, exp.Expression: The aggregation to split
+
+    Returns:
+        The partial and final aggregation, or None if the aggregation isn't decomposable
+    """
+    if not isinstance(ast, exp.Select):
+        return None
+
+    if any(ast.args.get(arg) for arg in ("joins", "distinct", "qualify")) or ast.find(exp.Window):
+        return None
+
+    group = ast.args.get("group")
+    if group and any(group.args.get(arg) for arg in ("rollup", "cube", "grouping_sets")):
+        return None
+
+    keys = group.expressions if group else []
+    if any(isinstance(key, exp.Literal) for key in keys):
+        return None  # Positional references, e.g. GROUP BY 1
+
+    having = ast.args.get("having")
+    order = ast.args.get("order")
+    clauses = [*ast.expressions, *([having] if having else []), *([order] if order else [])]
+
+    aggregates = [agg for clause in clauses for agg in clause.find_all(exp.AggFunc)]
+    if len(aggregates) == 0 and len(keys) == 0:
+        return None
+
+    for agg in aggregates:
+        if not isinstance(agg, DECOMPOSABLE_AGGREGATES) or agg.find(exp.Distinct):
+            return None
+        if any(isinstance(node, exp.AggFunc) for node, *_ in agg.this.walk()):
+            return None  # Nested aggregates
+
+    partial_expressions = [exp.alias_(key.copy(), f"__key_{i}") for i, key in enumerate(keys)]
+    partials: dict[str, str] = {}
+
+    def partial(func: str, arg: exp.Expression) -> str:
+        sql = f"{func}({arg.sql()})"
+        if sql not in partials:
+            partials[sql] = f"__agg_{len(partials)}"
+            partial_expressions.append(exp.alias_(sqlglot.parse_one(sql), partials[sql]))
+        return partials[sql]
+
+    def merge(agg: exp.AggFunc) -> exp.Expression:
+        arg = agg.this
+        if isinstance(agg, exp.Avg):
+            merged = f"SUM({partial('SUM', arg)}) / SUM({partial('COUNT', arg)})"
+        elif isinstance(agg, exp.Count):
+            merged = f"CAST(SUM({partial('COUNT', arg)}) AS BIGINT)"
+        elif isinstance(agg, exp.Sum):
+            merged = f"SUM({partial('SUM', arg)})"
+        else:
+            func = agg.sql().split("(")[0]
+            merged = f"{func}({partial(func, arg)})"
+        return sqlglot.parse_one(merged)
+
+    def finalize(node: exp.Expression) -> exp.Expression:
+        for i, key in enumerate(keys):
+            if node == key:
+                return exp.column(f"__key_{i}")
+        if isinstance(node, exp.AggFunc):
+            return merge(node)
+        return node
+
+    final_expressions = []
+    for expression in ast.expressions:
+        if not isinstance(expression, exp.Alias):
+            # Keep the name of the column in the output
+            name = expression.name if isinstance(expression, exp.Column) else expression.sql()
+            expression = exp.alias_(expression.copy(), name, quoted=True)
+        final_expressions.append(expression.transform(finalize))
+
+    # Columns left outside of the partial aggregates, e.g. of functions unknown to sqlglot
+    # like MEDIAN, cannot be merged
+    having = having.transform(finalize) if having else None
+    order = order.transform(finalize) if order else None
+
+    names = set(expression.alias for expression in final_expressions)
+    for clause in [*final_expressions, having, order]:
+        for column in clause.find_all(exp.Column) if clause else []:
+            if not column.name.startswith("__") and column.name not in names:
+                return None
+
+    final = exp.Select(expressions=final_expressions)
+    if keys:
+        final.set(
+            "group", exp.Group(expressions=[exp.column(f"__key_{i}") for i in range(len(keys))])
+        )
+    final.set("having", having)
+    final.set("order", order)
+    for arg in ("limit", "offset"):
+        if ast.args.get(arg):
+            final.set(arg, ast.args[arg].copy())
+
+    partial_ast = ast.copy()
+    partial_ast.set("expressions", partial_expressions)
+    for arg in ("having", "order", "limit", "offset"):
+        partial_ast.set(arg, None)
+
+    return partial_ast, final
+
+
+def shuffle_aggregation(stage: Stage, scan: Stage, partitions: int) -> Stage:
+    """Shuffles the partial aggregates of a scan by hash partitions of the group keys
+
+    Each task of the scan writes its partial aggregates to a file per partition, and the
+    aggregation merges each partition in a task of its own. An ORDER BY or LIMIT of the
+    aggregation is applied by a sort stage on top of the partitions, which takes over the id
+    and the dependents of the aggregation.
+
+    Args:
+        stage, Stage: The final aggregation
+        scan, Stage: The partial aggregation of the final aggregation
+        partitions, int: The number of partitions to shuffle the partial aggregates into
+
+    Returns:
+        The stage to take the place of the aggregation in the plan
+    """
+    final = stage.ast
+    if not isinstance(final, exp.Select) or not isinstance(scan.ast, exp.Select):
+        return stage
+
+    keys = final.args["group"].expressions
+
+    top = stage
+    if any(final.args.get(arg) for arg in ("order", "limit", "offset")):
+        # The sort stage can only refer to the output of the aggregation
+        names = {expression.alias: expression.this for expression in final.expressions}
+        order = final.args.get("order")
+        for ordered in order.expressions if order else []:
+            if isinstance(ordered.this, exp.Column) and ordered.this.name in names:
+                name = ordered.this.name
+            else:
+                name = next((k for k, v in names.items() if v == ordered.this), "")
+            if name == "":
+                return stage
+            ordered.set("this", exp.column(name, quoted=True))
+
+        top = Sort()
+        top.id, stage.id = stage.id, create_hash_string(final.sql(), digits=6, first_char="$")
+        top.ast = exp.Select(expressions=[exp.Star()]).from_(stage.id)
+        for arg in ("order", "limit", "offset"):
+            top.ast.set(arg, final.args.get(arg))
+            final.set(arg, None)
+
+        for dependent in stage.dependents:
+            dependent.dependencies.remove(stage)
+            dependent.add_dependency(top)
+        stage.dependents = set()
+        top.add_dependency(stage)
+
+    # The partial aggregates of the scan refer to the group keys of the source
+    partial_keys = scan.ast.expressions[: len(keys)]
+    hashed = sqlglot.parse_one(
+        f"HASH({', '.join(key.this.sql() for key in partial_keys)}) % {partitions}"
+    )
+    scan.ast.expressions.append(exp.alias_(hashed, "__partition"))
+    scan.partitions = partitions
+
+    return top
+
+
+def push_down_aggregations(root: Stage) -> Stage:
+    """Pushes partial aggregations down into the scans of decomposable aggregations
+
+    An aggregation scanning a source directly gets a new scan stage of partial aggregates,
+    while an aggregation of a scan stage, e.g. a CTE, that no other stage depends on merges
+    the partial aggregation into the scan stage, unless the scan limits or orders its rows.
+    Either way, the aggregation stage is left with merging the partial aggregates of each
+    task, i.e. a row per group per task. The partial aggregates of a GROUP BY are shuffled,
+    see `session.shuffle_partitions`.
+
+    Args:
+        root, Stage: The root of the stages to optimize
+
+    Returns:
+        The root of the optimized stages
+    """
+    from duckingit._config import DuckConfig
+
+    partitions = DuckConfig().session.shuffle_partitions
+
+    stages, nodes = set(), {root}
+    while nodes:
+        stage = nodes.pop()
+        stages.add(stage)
+        nodes.update(stage.dependencies - stages)
+
+    for stage in stages:
+        if stage.stage_type != Stages.AGGREGATE or stage.ast is None:
+            continue
+
+        if len(stage.dependencies) == 0:
+            split = split_aggregation(stage.ast)
+            if split is None:
+                continue
+
+            partial_ast, final = split
+            scan = Scan()
+            scan.ast = partial_ast
+            scan.id = create_hash_string(partial_ast.sql(), digits=6, first_char="$")
+
+            stage.ast = final.from_(scan.id)
+            stage.add_dependency(scan)
+
+        elif len(stage.dependencies) == 1:
+            scan = next(iter(stage.dependencies))
+            if scan.stage_type != Stages.SCAN or scan.dependencies or scan.dependents != {stage}:
+                continue
+            if not isinstance(scan.ast, exp.Select) or scan.ast.find(exp.Window):
+                continue
+            if any(
+                scan.ast.args.get(arg)
+                for arg in ("limit", "offset", "distinct", "order", "qualify")
+            ):
+                continue  # The rows of the scan are only known once all of it is scanned
+
+            split = split_aggregation(stage.ast)
+            if split is None:
+                continue
+
+            partial_ast, final = split
+            partial_sql = partial_ast.sql().replace(scan.id, f"({scan.sql})")
+
+            scan.ast = sqlglot.parse_one(partial_sql, read="duckdb")
+            stage.ast = final.from_(scan.id)
+
+        else:
+            continue
+
+        if partitions > 1 and stage.ast.args.get("group"):
+            top = shuffle_aggregation(stage, scan=scan, partitions=partitions)
+            if stage is root:
+                root = top
+
+    return root
+
+
+def estimate_bytes(stage: Stage) -> int | None:
+    """Estimates the size of the output of a stage by the compressed size of its sources
+
+    Filters, projections and aggregations only reduce the size of their input, so the size
+    of the sources is an upper bound, at least of the compressed size.
+
+    Args:
+        stage, Stage: The stage to estimate the size of the output of
+
+    Returns:
+        The estimated size in bytes, or None if the size of any source is unknown
+    """
+    if stage.ast is None:
+        return None
+
+    sizes = [estimate_bytes(dependency) for dependency in stage.dependencies]
+    sizes += [estimate_source_bytes(table) for table in stage.ast.find_all(exp.Table)]
+    if any(size is None for size in sizes):
+        return None
+    return sum(sizes)  # type: ignore
+
+
+def estimate_source_bytes(table: exp.Expression) -> int | None:
+    """Returns the compressed size of a parquet source, or None if the size is unknown"""
+    if not isinstance(table.this, exp.Func):
+        return None  # E.g. a table of DuckDB
+
+    query = Query.parse(f"SELECT * FROM {table.sql()}")
+    if query.format != "parquet":
+        return None
+    return sum(size for _, size in query.list_of_files)
+
+
+def join_keys(join: exp.Join, left: str, right: str) -> list[tuple[exp.Expression, exp.Expression]]:
+    """Returns the pairs of expressions of the left and the right side a join is equal on
+
+    Args:
+        join, exp.Join: The join
+        left, str: The alias or name of the left side of the join
+        right, str: The alias or name of the right side of the join
+    """
+    using = join.args.get("using")
+    if using:
+        return [(exp.column(key.name), exp.column(key.name)) for key in using]
+
+    on = join.args.get("on")
+    conditions = list(on.flatten()) if isinstance(on, exp.And) else [on] if on else []
+
+    keys = []
+    for condition in conditions:
+        if not isinstance(condition, exp.EQ):
+            continue
+
+        this, other = condition.this, condition.expression
+        tables = [set(column.table for column in e.find_all(exp.Column)) for e in (this, other)]
+        if tables == [{left}, {right}]:
+            keys.append((this, other))
+        elif tables == [{right}, {left}]:
+            keys.append((other, this))
+    return keys
+
+
+def split_join(stage: Stage) -> Stage | None:
+    """Splits the join of a stage that aggregates, sorts or limits the joined rows into a stage
+    of its own
+
+    The join keeps the FROM, JOIN and WHERE clause of the stage, and outputs the columns the
+    rest of the stage refers to as `__column_<i>`. The stage is left with the rest of its
+    clauses over the output of the join, which it depends on in place of the sides.
+
+    Args:
+        stage, Stage: The stage of the join
+
+    Returns:
+        The stage of the join, or None if the columns the stage refers to are unknown, e.g.
+        of a `*`
+    """
+    ast = stage.ast
+    if not isinstance(ast, exp.Select):
+        return None
+
+    clauses = [ast.args.get(arg) for arg in ("group", "having", "qualify", "order")]
+    for clause in [*ast.expressions, *clauses]:
+        if clause and clause.find(exp.Subquery, exp.Select):
+            return None
+        for star in clause.find_all(exp.Star) if clause else []:
+            if not isinstance(star.parent, exp.Count):
+                return None
+
+    # Clauses other than the columns of the stage may refer to the columns by their alias
+    aliases = {e.alias for e in ast.expressions if isinstance(e, exp.Alias)}
+    columns: dict[str, tuple[str, exp.Column]] = {}
+
+    def refer(node: exp.Expression, aliased: bool) -> exp.Expression:
+        if not isinstance(node, exp.Column) or (
+            aliased and not node.table and node.name in aliases
+        ):
+            return node
+        if node.sql() not in columns:
+            columns[node.sql()] = (f"__column_{len(columns)}", node.copy())
+        return exp.column(columns[node.sql()][0])
+
+    expressions = []
+    for expression in ast.expressions:
+        if not isinstance(expression, exp.Alias):
+            # Keep the name of the column in the output
+            name = expression.name if isinstance(expression, exp.Column) else expression.sql()
+            expression = exp.alias_(expression.copy(), name, quoted=True)
+        expressions.append(expression.transform(lambda node: refer(node, aliased=False)))
+
+    top = ast.copy()
+    top.set("expressions", expressions)
+    for arg in ("group", "having", "qualify", "order"):
+        if top.args.get(arg):
+            top.set(arg, top.args[arg].transform(lambda node: refer(node, aliased=True)))
+
+    join = Join()
+    join.ast = exp.Select(
+        expressions=[exp.alias_(column, name) for name, column in columns.values()]
+        or [exp.alias_(exp.Literal.number(1), "__row")]
+    )
+    for arg in ("from", "joins", "where"):
+        join.ast.set(arg, ast.args[arg].copy() if ast.args.get(arg) else None)
+        top.set(arg, None)
+    join.id = create_hash_string(join.sql, digits=6, first_char="$")
+
+    for dependency in stage.dependencies:
+        dependency.dependents.remove(stage)
+        join.add_dependency(dependency)
+    stage.dependencies = set()
+
+    stage.ast = top.from_(join.id)
+    stage.stage_type = select_stage_type(stage.ast).stage_type
+    stage.add_dependency(join)
+    return join
+
+
+def plan_joins(root: Stage) -> None:
+    """Chooses the strategy of joins by the estimated size of their sides
+
+    A broadcast join splits the larger side, the probe side, across tasks, while every task
+    reads the smaller side, the build side, in full. It's chosen if the build side is no
+    larger than `session.broadcast_threshold_bytes`, and the type of the join preserves the
+    rows of the probe side only. Otherwise, a shuffle join hash partitions both sides by
+    the join keys and joins each pair of partitions in a task of its own, see
+    `session.shuffle_partitions`. Joins of more than two sides run in a single task.
+
+    Only the joined rows are split across tasks, thus a join that aggregates, sorts or limits
+    them is split into a stage of its own, see `split_join`, and the stage on top of it runs
+    in a single task.
+
+    Args:
+        root, Stage: The root of the stages to plan the joins of
+    """
+    from duckingit._config import DuckConfig
+
+    conf = DuckConfig().session
+
+    stages, nodes = set(), {root}
+    while nodes:
+        stage = nodes.pop()
+        stages.add(stage)
+        nodes.update(stage.dependencies - stages)
+
+    for stage in stages:
+        joins = stage.ast.args.get("joins") if isinstance(stage.ast, exp.Select) else None
+        if stage.stage_type != Stages.JOIN or not joins or len(joins) > 1:
+            continue
+
+        join = joins[0]
+        sides = [stage.ast.args["from"].expressions[0], join.this]  # type: ignore
+
+        # The sides are either sources or stages, e.g. CTEs, replaced by their id
+        dependencies = {dependency.id: dependency for dependency in stage.dependencies}
+        ids = [side.unalias().name if side.unalias().name in dependencies else "" for side in sides]
+        if ids[0] and ids[0] == ids[1]:
+            # A self-join of a stage, whose output is read as a whole by both sides
+            continue
+
+        sizes = [
+            estimate_bytes(dependencies[_id]) if _id else estimate_source_bytes(side)
+            for _id, side in zip(ids, sides)
+        ]
+
+        # Only the side of which the rows aren't preserved can be broadcast
+        builds = {"": [0, 1], "LEFT": [1], "RIGHT": [0]}.get(join.side, [])
+        builds = [
+            build
+            for build in builds
+            if sizes[build] is not None
+            and sizes[build] <= conf.broadcast_threshold_bytes  # type: ignore
+            and not (ids[1 - build] and dependencies[ids[1 - build]].partitions)
+        ]
+        probe, keys, partitions = "", [], 0
+        if builds:
+            build = min(builds, key=lambda build: sizes[build])  # type: ignore
+            probe = ids[1 - build] or sides[1 - build].sql()
+        else:
+            keys = join_keys(join, left=sides[0].alias_or_name, right=sides[1].alias_or_name)
+            partitions = conf.shuffle_partitions
+            if partitions < 2 and all(size is not None for size in sizes):
+                partitions = math.ceil(sum(sizes) / conf.bytes_per_invokation)  # type: ignore
+            if not keys or partitions < 2:
+                continue
+
+        if any(
+            stage.ast.args.get(arg)  # type: ignore
+            for arg in ("group", "having", "qualify", "distinct", "order", "limit", "offset")
+        ) or any(
+            e.find(exp.AggFunc, exp.Window) for e in stage.ast.expressions
+        ):  # type: ignore
+            split = split_join(stage)
+            if split is None:
+                continue
+            stage = split
+            join = stage.ast.args["joins"][0]  # type: ignore
+            sides = [stage.ast.args["from"].expressions[0], join.this]  # type: ignore
+
+        if probe:
+            stage.probe = probe
+            continue
+
+        for _id, side, side_keys in zip(ids, sides, zip(*keys)):
+            # The keys of a side are unqualified within the stage that partitions the side
+            side_keys = [
+                key.transform(
+                    lambda node: exp.column(node.name) if isinstance(node, exp.Column) else node
+                )
+                for key in side_keys
+            ]
+            hashed = ", ".join(f"CAST({key.sql()} AS VARCHAR)" for key in side_keys)
+            hashed = f"HASH({hashed}) % {partitions} AS __partition"
+
+            if _id:
+                dependency = dependencies[_id]
+                if (
+                    dependency.stage_type == Stages.SCAN
+                    and not dependency.dependencies
+                    and not dependency.partitions
+                    and dependency.dependents == {stage}
+                ):
+                    dependency.ast = sqlglot.parse_one(
+                        f"SELECT *, {hashed} FROM ({dependency.sql})"
+                    )
+                    dependency.partitions = partitions
+                    continue
+
+            scan = Scan()
+            scan.ast = sqlglot.parse_one(f"SELECT *, {hashed} FROM {side.sql()}")
+            scan.id = create_hash_string(scan.sql, digits=6, first_char="$")
+            scan.partitions = partitions
+
+            if _id:
+                stage.dependencies.remove(dependencies[_id])
+                dependencies[_id].dependents.remove(stage)
+                scan.add_dependency(dependencies[_id])
+
+            stage.replace_child_with_id(child=side, id=scan.id, alias=side.alias)
+            stage.add_dependency(scan)
+
+
+# The number of rows each task samples of the first key of a sort to pick the ranges of keys
+SAMPLE_ROWS_PER_TASK = 1000
+
+
+def split_sort(ast: exp.Expression) -> tuple[exp.Select, exp.Select] | None:
+    """Splits a sort into a local sort and a merge of the locally sorted rows
+
+    The local sort keeps the FROM and WHERE clause of the sort, and outputs the keys of the
+    ORDER BY as `__order_<i>` next to the columns of the sort. A LIMIT is applied to each
+    task, including the rows of an OFFSET. The merge sorts the output of the local sorts by
+    the keys, applies the LIMIT and OFFSET, and leaves out the keys. Its FROM clause is left
+    to the caller.
+
+    Args:
+        ast, exp.Expression: The sort to split
+
+    Returns:
+        The local sort and the merge, or None if the sort cannot be split
+    """
+    if not isinstance(ast, exp.Select) or not ast.args.get("order"):
+        return None
+
+    if any(ast.args.get(arg) for arg in ("joins", "distinct", "group", "having", "qualify")):
+        return None
+    if ast.find(exp.Window) or any(e.find(exp.AggFunc) for e in ast.expressions):
+        return None
+
+    limit, offset = ast.args.get("limit"), ast.args.get("offset")
+    if any(arg and not arg.expression.is_int for arg in (limit, offset)):
+        return None
+    if offset and not limit:
+        return None
+
+    # Keys referring to the columns of the sort, by alias or position, are replaced by the
+    # expressions of the columns
+    aliases = {e.alias: e.this for e in ast.expressions if isinstance(e, exp.Alias)}
+    keys = []
+    for ordered in ast.args["order"].expressions:
+        key = ordered.this
+        if isinstance(key, exp.Literal) and key.is_int:
+            key = ast.expressions[int(key.name) - 1].unalias()
+        elif isinstance(key, exp.Column) and not key.table and key.name in aliases:
+            key = aliases[key.name]
+        keys.append(key.copy())
+
+    local = ast.copy()
+    for i, key in enumerate(keys):
+        local.expressions.append(exp.alias_(key, f"__order_{i}"))
+    if limit:
+        rows = int(limit.expression.name) + (int(offset.expression.name) if offset else 0)
+        local.set("limit", exp.Limit(expression=exp.Literal.number(rows)))
+        local.set("offset", None)
+
+    columns = ", ".join(f"__order_{i}" for i in range(len(keys)))
+    merge = sqlglot.parse_one(f"SELECT * EXCLUDE ({columns})", read="duckdb")
+    order = ast.args["order"].copy()
+    for i, ordered in enumerate(order.expressions):
+        ordered.set("this", exp.column(f"__order_{i}"))
+    merge.set("order", order)
+    for arg in ("limit", "offset"):
+        merge.set(arg, ast.args[arg].copy() if ast.args.get(arg) else None)
+
+    return local, merge  # type: ignore
+
+
+def partition_by_range(local: exp.Select, partitions: int) -> Stage | None:
+    """Partitions the output of a local sort by ranges of the first key of the sort
+
+    A stage samples the first key of the sort, another picks the boundaries of the ranges
+    as quantiles of the sample, and the last one scans the source, and writes the rows of
+    each range of keys to a partition of its own. Thus, the partitions are sorted one by one,
+    and the sorted partitions are in order.
+
+    Args:
+        local, exp.Select: The local sort, see `split_sort`
+        partitions, int: The number of ranges of keys
+
+    Returns:
+        The stage that partitions the source, or None if the sort scans more than one source
+    """
+    sources = [table for table in local.find_all(exp.Table) if isinstance(table.this, exp.Func)]
+    if len(sources) != 1:
+        return None
+
+    ordered = local.args["order"].expressions[0]
+    key = local.expressions[-len(local.args["order"].expressions)].this
+
+    sample = Scan()
+    sample.ast = local.copy()
+    sample.ast.set("expressions", [exp.alias_(key.copy(), "__key")])
+    for arg in ("order", "limit", "offset"):
+        sample.ast.set(arg, None)
+    sample.ast = sqlglot.parse_one(
+        f"SELECT * FROM ({sample.sql}) USING SAMPLE ({SAMPLE_ROWS_PER_TASK} ROWS)"
+    )
+    sample.id = create_hash_string(sample.sql, digits=6, first_char="$")
+
+    bounds = Aggregate()
+    quantiles = ", ".join(
+        f"QUANTILE_DISC(__key, {i / partitions}) AS __bound_{i}" for i in range(1, partitions)
+    )
+    bounds.ast = sqlglot.parse_one(f"SELECT {quantiles} FROM {sample.id}")
+    bounds.id = create_hash_string(bounds.sql, digits=6, first_char="$")
+    bounds.add_dependency(sample)
+
+    # The partitions of a descending sort are numbered from the largest keys, and NULLs are
+    # last unless stated otherwise, see DuckDB
+    desc = bool(ordered.args.get("desc"))
+    nulls = 0 if "NULLS FIRST" in ordered.sql() else partitions - 1
+    cases = " ".join(
+        f"WHEN {key.sql()} < (SELECT __bound_{i} FROM {bounds.id}) "
+        f"THEN {partitions - i if desc else i - 1}"
+        for i in range(1, partitions)
+    )
+    partition = (
+        f"CASE WHEN {key.sql()} IS NULL THEN {nulls} {cases} "
+        f"ELSE {0 if desc else partitions - 1} END"
+    )
+
+    scan = Scan()
+    scan.ast = local.copy()
+    scan.ast.expressions.append(exp.alias_(sqlglot.parse_one(partition), "__partition"))
+    for arg in ("order", "limit", "offset"):
+        scan.ast.set(arg, None)
+    scan.id = create_hash_string(scan.sql, digits=6, first_char="$")
+    scan.partitions = partitions
+    scan.probe = sources[0].sql()
+    scan.add_dependency(bounds)
+
+    return scan
+
+
+def merge_scan_dependency(stage: Stage) -> exp.Expression | None:
+    """Returns the AST of a stage that scans the source, either by itself or through a scan of
+    a subquery or CTE only the stage depends on, which is merged into the stage
+
+    Args:
+        stage, Stage: The stage to merge the dependency of
+
+    Returns:
+        The AST of the stage, or None if it depends on anything else
+    """
+    if not stage.dependencies:
+        return stage.ast
+
+    dependency = next(iter(stage.dependencies))
+    if (
+        len(stage.dependencies) > 1
+        or dependency.stage_type != Stages.SCAN
+        or dependency.dependencies
+        or dependency.partitions
+        or dependency.dependents != {stage}
+    ):
+        return None
+    return sqlglot.parse_one(stage.sql.replace(dependency.id, f"({dependency.sql})"))
+
+
+def plan_sorts(root: Stage) -> None:
+    """Distributes sorts across tasks
+
+    An ORDER BY with a LIMIT is applied to each task scanning the source, i.e. a local Top-N,
+    and a final sort merges the rows of each task. A full ORDER BY partitions the source by
+    ranges of the first key, see `partition_by_range`, and a task per partition sorts it.
+    The output of the sort is then the parts of the sort in order, see `Stage.parts`.
+
+    Args:
+        root, Stage: The root of the stages to plan the sorts of
+    """
+    from duckingit._config import DuckConfig
+
+    conf = DuckConfig().session
+
+    stages, nodes = set(), {root}
+    while nodes:
+        stage = nodes.pop()
+        stages.add(stage)
+        nodes.update(stage.dependencies - stages)
+
+    for stage in stages:
+        if stage.stage_type != Stages.SORT or stage.ast is None:
+            continue
+
+        ast = merge_scan_dependency(stage)
+        if ast is None:
+            continue
+
+        split = split_sort(ast)
+        if split is None:
+            continue
+
+        local, merge = split
+        if ast.args.get("limit"):
+            scan = Scan()
+            scan.ast = local
+            scan.id = create_hash_string(scan.sql, digits=6, first_char="$")
+        else:
+            partitions = conf.shuffle_partitions
+            if partitions < 2:
+                size = estimate_bytes(stage)
+                partitions = math.ceil(size / conf.bytes_per_invokation) if size else 0
+            if partitions < 2:
+                continue
+
+            scan = partition_by_range(local, partitions=partitions)  # type: ignore
+            if scan is None:
+                continue
+
+        for dependency in stage.dependencies:
+            dependency.dependents.remove(stage)
+        stage.dependencies = set()
+
+        stage.ast = merge.from_(scan.id)
+        stage.add_dependency(scan)
+
+
+def plan_limits(root: Stage) -> None:
+    """Distributes a LIMIT without an ORDER BY across tasks
+
+    The LIMIT, including the rows of an OFFSET, is applied to each task scanning the source,
+    and a final task applies the LIMIT and OFFSET to the output of the tasks. The scan is
+    limited, see `Stage.limit`, i.e. the controller invokes its tasks in waves and skips the
+    rest of them once the tasks invoked so far have output enough rows.
+
+    Args:
+        root, Stage: The root of the stages to plan the limits of
+    """
+    stages, nodes = set(), {root}
+    while nodes:
+        stage = nodes.pop()
+        stages.add(stage)
+        nodes.update(stage.dependencies - stages)
+
+    for stage in stages:
+        if stage.stage_type != Stages.SCAN or stage.ast is None or stage.branches:
+            continue
+
+        ast = merge_scan_dependency(stage)
+        if not isinstance(ast, exp.Select) or not ast.args.get("from"):
+            continue
+
+        limit, offset = ast.args.get("limit"), ast.args.get("offset")
+        if limit is None or any(arg and not arg.expression.is_int for arg in (limit, offset)):
+            continue
+        if any(
+            ast.args.get(arg)
+            for arg in ("joins", "distinct", "group", "having", "qualify", "order")
+        ):
+            continue
+        if ast.find(exp.Window) or any(e.find(exp.AggFunc) for e in ast.expressions):
+            continue
+
+        rows = int(limit.expression.name) + (int(offset.expression.name) if offset else 0)
+        scan = Scan()
+        scan.ast = ast.copy()
+        scan.ast.set("limit", exp.Limit(expression=exp.Literal.number(rows)))
+        scan.ast.set("offset", None)
+        scan.id = create_hash_string(scan.sql, digits=6, first_char="$")
+        scan.limit = rows
+
+        for dependency in stage.dependencies:
+            dependency.dependents.remove(stage)
+        stage.dependencies = set()
+
+        merge = sqlglot.parse_one(f"SELECT * FROM {scan.id}")
+        for arg in ("limit", "offset"):
+            merge.set(arg, ast.args[arg].copy() if ast.args.get(arg) else None)
+        stage.ast = merge
+        stage.add_dependency(scan)
+
+
+def plan_unions(root: Stage) -> None:
+    """Distributes the deduplication of a UNION across tasks
+
+    The branches of a UNION hash partition their deduplicated rows by all of their columns,
+    and a task per partition deduplicates the rows of the partition of each branch, see
+    `session.shuffle_partitions`. Only branches that scan lists of columns cast to the types of
+    the union are partitioned.
+
+    Args:
+        root, Stage: The root of the stages to plan the unions of
+    """
+    from duckingit._config import DuckConfig
+
+    conf = DuckConfig().session
+
+    stages, nodes = set(), {root}
+    while nodes:
+        stage = nodes.pop()
+        stages.add(stage)
+        nodes.update(stage.dependencies - stages)
+
+    for stage in stages:
+        if not isinstance(stage, Union) or not isinstance(stage.ast, exp.Union):
+            continue
+        if stage.branches or not stage.ast.args.get("distinct"):
+            continue
+        if not stage.types:
+            continue  # Equal rows of the branches are hashed alike once cast to the same types
+
+        branches = stage.dependencies
+        if not all(
+            branch.stage_type == Stages.SCAN
+            and isinstance(branch.ast, exp.Select)
+            and not branch.ast.find(exp.Star)
+            and not branch.partitions
+            and branch.dependents == {stage}
+            for branch in branches
+        ):
+            continue
+
+        partitions = conf.shuffle_partitions
+        if partitions < 2:
+            sizes = [estimate_bytes(branch) for branch in branches]
+            if any(size is None for size in sizes):
+                continue
+            partitions = math.ceil(sum(sizes) / conf.bytes_per_invokation)  # type: ignore
+        if partitions < 2:
+            continue
+
+        for branch in branches:
+            columns = ", ".join(
+                f"CAST({expression.unalias().sql()} AS VARCHAR)"
+                for expression in branch.ast.expressions
+            )
+            hashed = sqlglot.parse_one(f"HASH({columns}) % {partitions}")
+            branch.ast.expressions.append(exp.alias_(hashed, "__partition"))
+            branch.partitions = partitions
+
+
+# The quantile of the standard normal distribution of a 95% confidence interval
+CONFIDENCE_Z = 1.96
+
+
+def plan_sample(root: Stage, sample: float) -> None:
+    """Scans a sample of the sources, and scales up the SUM and COUNT of aggregations
+
+    Stages scanning a source without a join scan a systematic sample of its files or
+    prefixes, see `sample_systematically`. A decomposable aggregation of a sampled scan
+    scales its SUM and COUNT by the inverse of the sample, and outputs a 95% confidence
+    interval of each as `<column>_ci_low` and `<column>_ci_high`. The interval treats the
+    partial aggregates of each task as a sample of clusters of files, i.e. it is undefined,
+    or NULL, if a single task scans the sample. Other aggregates, and ratios of sums such as
+    an AVG, are computed over the sample as is.
+
+    Args:
+        root, Stage: The root of the stages to sample
+        sample, float: The share of the files or prefixes of the sources to scan
+    """
+    stages, nodes = set(), {root}
+    while nodes:
+        stage = nodes.pop()
+        stages.add(stage)
+        nodes.update(stage.dependencies - stages)
+
+    for stage in stages:
+        if (
+            stage.stage_type in (Stages.SCAN, Stages.SORT)
+            and isinstance(stage.ast, exp.Select)
+            and stage.ast.args.get("from")
+            and not stage.ast.args.get("joins")
+            and not stage.dependencies
+        ):
+            stage.sample = sample
+
+    scale = 1 / sample
+    for stage in stages:
+        if stage.stage_type != Stages.AGGREGATE or not isinstance(stage.ast, exp.Select):
+            continue
+
+        scan = next(iter(stage.dependencies), None)
+        if len(stage.dependencies) != 1 or scan.sample == 1 or not isinstance(scan.ast, exp.Select):
+            continue
+
+        # The partial sums and counts of the scan, see `split_aggregation`
+        partials = set(
+            expression.alias
+            for expression in scan.ast.expressions
+            if expression.alias.startswith("__agg_")
+            and isinstance(expression.this, (exp.Sum, exp.Count))
+        )
+
+        def partial_of(node: exp.Expression) -> str:
+            if isinstance(node, exp.Cast):
+                node = node.this
+            if isinstance(node, exp.Sum) and isinstance(node.this, exp.Column):
+                return node.this.name if node.this.name in partials else ""
+            return ""
+
+        intervals = []
+        for expression in stage.ast.expressions:
+            name = partial_of(expression.unalias())
+            if name and expression.alias:
+                estimate = f"SUM({name}) * {scale}"
+                error = (
+                    f"{CONFIDENCE_Z} * {scale} "
+                    f"* SQRT(COUNT({name}) * {1 - sample} * VAR_SAMP({name}))"
+                )
+                for bound, sign in (("low", "-"), ("high", "+")):
+                    intervals.append(
+                        exp.alias_(
+                            sqlglot.parse_one(f"{estimate} {sign} {error}"),
+                            f"{expression.alias}_ci_{bound}",
+                            quoted=True,
+                        )
+                    )
+
+        # The scale of a ratio of partial sums cancels out, e.g. of an AVG, thus it's kept as is
+        ratios = set()
+        for div in stage.ast.find_all(exp.Div):
+            sides = [
+                [node for node in side.find_all(exp.Sum) if partial_of(node)]
+                for side in (div.this, div.expression)
+            ]
+            if all(sides):
+                ratios.update(id(node) for node in flatten_list(sides))
+
+        stage.ast = stage.ast.transform(
+            lambda node: (
+                exp.Paren(this=sqlglot.parse_one(f"SUM({partial_of(node)}) * {scale}"))
+                if isinstance(node, exp.Sum) and partial_of(node) and id(node) not in ratios
+                else node
+            ),
+            copy=False,
+        )
+        stage.ast.expressions.extend(intervals)
+
+
 class Plan:
     """The execution plan
 
@@ -307,15 +2005,28 @@ class Plan:
         root, Stage: The root operation, ie. last operation, in the DAG
         dag, dict[Stage, Set(Stage)]: A DAG that represents the execution plan in nodes
         leaves, list[Stage]: The leaves of stages in the DAG
+        metadata, Metadata | None: Answers the query without invoking anything, if the
+            statistics of the source allow it, see `Metadata`
+        sample, float: The share of the sources scanned, see `plan_sample`
 
     Methods:
         from_query: Creates an execution plan from a query parsed in the Query class
+        fork: Returns a copy of the plan for another execution
     """
 
-    def __init__(self, query: Query, root: Stage, dag: dict[Stage, t.Set[Stage]]) -> None:
+    def __init__(
+        self,
+        query: Query,
+        root: Stage,
+        dag: dict[Stage, t.Set[Stage]],
+        metadata: Metadata | None = None,
+        sample: float = 1.0,
+    ) -> None:
         self.query = query
         self.root = root
         self.dag = dag
+        self.metadata = metadata
+        self.sample = sample
 
         self._length: int | None = None
 
@@ -325,8 +2036,30 @@ class Plan:
         return self._length
 
     @classmethod
-    def from_query(cls, query: Query):
+    def from_query(cls, query: Query, sample: float = 1.0):
+        """Plans the execution of a query
+
+        Args:
+            query, Query: The query to plan
+            sample, float: The share of the files or prefixes of the sources to scan, where
+                the SUM and COUNT of aggregations are estimates, see `plan_sample`.
+                Defaults to the entire sources
+
+        Raises:
+            ValueError: If the sample isn't a share between 0 and 1
+        """
+        if not 0 < sample <= 1:
+            raise ValueError("`sample` must be a share larger than 0 and at most 1")
+
         root = Stage.from_ast(ast=query.ast)
+        push_down_predicates_and_projections(root)
+        root = push_down_aggregations(root)
+        plan_joins(root)
+        plan_sorts(root)
+        plan_limits(root)
+        plan_unions(root)
+        if sample < 1:
+            plan_sample(root, sample=sample)
 
         dag: dict[Stage, t.Set[Stage]] = {root: set()}
         nodes = {root}
@@ -338,11 +2071,97 @@ class Plan:
                 dag[node].add(dep)
                 nodes.add(dep)
 
-        return cls(query=query, root=root, dag=dag)
+        # The statistics of the source answer exactly, i.e. without an interval
+        metadata = Metadata.from_select(query.ast) if sample == 1 else None
+        return cls(query=query, root=root, dag=dag, metadata=metadata, sample=sample)
 
     def __repr__(self) -> str:
         return f"{self.dag}"
 
+    @property
+    def stages(self) -> list[Stage]:
+        """Returns the stages of the DAG, and the stage answering from metadata if any"""
+        return [*self.dag, *([self.metadata] if self.metadata is not None else [])]
+
+    @property
+    def speculative_copies(self) -> int:
+        """The number of speculative copies of tasks invoked in the last execution"""
+        return sum(stage.speculative_copies for stage in self.dag)
+
     def copy(self):
         """Returns a deep copy of the object itself"""
         return copy.deepcopy(self)
+
+    def fork(self):
+        """Returns a copy of the plan for another execution, which shares the query and the
+        parsed queries of the stages with the plan, i.e. their listing, see `PlanCache`"""
+        memo: dict[int, t.Any] = {id(stage._queries): stage._queries for stage in self.stages}
+        memo[id(self.query)] = self.query
+        return copy.deepcopy(self, memo)
+
+
+class PlanCache:
+    """A least recently used cache of execution plans, keyed by the hash of their parsed query
+
+    Repeated queries are only parsed, to be normalized, and skip planning, as a fork of the
+    cached plan is handed out. The forks share the parsed queries of their stages, and thus
+    the listing of the sources, which is reused for `session.listing_ttl_seconds` before the
+    sources are listed again. The key includes the session configurations, as they take part
+    in planning.
+
+    Methods:
+        get: Returns a plan of the query, planned only if it isn't cached
+        clear: Removes all plans from the cache
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._plans: OrderedDict[str, tuple[Plan, float]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._plans)
+
+    def get(self, query: str, sample: float = 1.0) -> Plan:
+        """Returns a plan of the query
+
+        Args:
+            query, str: DuckDB SQL query to plan
+            sample, float: The share of the sources to scan, see `Plan.from_query`
+
+        Returns:
+            A fork of the cached plan, or a new plan if it isn't cached
+        """
+        from duckingit._config import DuckConfig
+
+        conf = DuckConfig().session
+        parsed = Query.parse(query)
+        if conf.plan_cache_size == 0:
+            return Plan.from_query(parsed, sample=sample)
+
+        # The query is normalized by parsing it, which keeps the whitespace of its literals
+        key = create_hash_string(parsed.hashed + repr(conf) + str(sample))
+        with self._lock:
+            entry = self._plans.get(key)
+            if entry is not None:
+                self._plans.move_to_end(key)
+
+        now = time.monotonic()
+        if entry is None:
+            entry = (Plan.from_query(parsed, sample=sample), now)
+        elif now - entry[1] > conf.listing_ttl_seconds:
+            # The listing of the sources has expired, while forks that may still be executing
+            # keep the parsed queries they share
+            for stage in entry[0].stages:
+                stage._queries = {}
+            entry = (entry[0], now)
+
+        with self._lock:
+            self._plans[key] = entry
+            while len(self._plans) > conf.plan_cache_size:
+                self._plans.popitem(last=False)
+
+        return entry[0].fork()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._plans.clear()
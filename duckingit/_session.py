@@ -1,11 +1,10 @@
-import datetime
-
 import duckdb
 
+from duckingit._cache import Cache
+from duckingit._collector import Collector
 from duckingit._config import DuckConfig
 from duckingit._dataset import Dataset
-from duckingit._parser import Query
-from duckingit._planner import Plan
+from duckingit._planner import PlanCache
 from duckingit.providers import Providers
 
 
@@ -19,6 +18,10 @@ class DuckSession:
 
     Attributes:
         conn, duckdb.DuckDBPyConnection: The initialized DuckDB connection
+        provider, Provider: The provider of serverless functions, which holds the clients
+        collector, Collector: Collects the completions of invokations across datasets
+        plans, PlanCache: The plans of the queries issued lately, see `session.plan_cache_size`
+        cache, Cache: The cached output of tasks, see `session.cache_max_bytes`
         metadata, dict: Metadata on temporary tables created using the DuckSession
 
     Methods: TODO: Switch the methods logic? Perhaps more logical
@@ -31,6 +34,9 @@ class DuckSession:
         >>> resp.show()
 
         >>> session.execute(query="SELECT * FROM scan_parquet(['s3::/<BUCKET_NAME>/*'])")
+
+        >>> query = "SELECT COUNT(*) AS n FROM scan_parquet(['s3::/<BUCKET_NAME>/*'])"
+        >>> session.execute(query=query, sample=0.05)  # n, n_ci_low and n_ci_high
     """
 
     def __init__(
@@ -49,13 +55,17 @@ class DuckSession:
             conf.update()  # Update configuration settings
 
         self._kwargs = kwargs
+        self._set_provider()
 
         self._conn = duckdb.connect(**self.conf.duckdb.__dict__)
         self._load_httpfs()
         self._set_credentials()
 
         self.metadata: dict[str, str] = dict()
-        self.metadata_cached: dict[str, datetime.datetime] = {}
+        self.plans = PlanCache()
+        self.cache = Cache(provider=self.provider)
+
+        self._set_collector()
 
     @property
     def conn(self) -> duckdb.DuckDBPyConnection:
@@ -69,20 +79,38 @@ class DuckSession:
     def conf(self) -> DuckConfig:
         return DuckConfig()
 
+    def _set_provider(self) -> None:
+        self.provider = Providers.get_or_raise(self.conf.session.provider)
+
     def _load_httpfs(self) -> None:
         self._conn.execute("INSTALL httpfs; LOAD httpfs;")
 
     def _set_credentials(self) -> None:
-        self._conn.execute(Providers.get_or_raise(self.conf.session.provider).duckdb_settings())
+        self._conn.execute(self.provider.duckdb_settings())
+
+    def _set_collector(self) -> None:
+        self.collector = Collector(
+            provider=self.provider,
+            success_queue=self.conf.aws_sqs.QueueSuccess,
+            failure_queue=self.conf.aws_sqs.QueueFailure,
+            receivers=self.conf.aws_sqs.NumberOfReceivers,
+            wait_time_seconds=self.conf.aws_sqs.WaitTimeSeconds,
+        )
 
-    def sql(self, query: str) -> Dataset:
+    def sql(self, query: str, sample: float = 1.0) -> Dataset:
         """Creates a Dataset to execute against DuckDB instances
 
         The Dataset can also be configured to save to a specific path or temporary table
         using the write method of the Dataset class.
 
+        A sample scans a share of the files of the sources only, for a cheap first look at
+        a large dataset. SUM and COUNT of aggregations are then estimates, scaled up by
+        the sample, next to a 95% confidence interval of each, see `plan_sample`.
+
         Args:
             query, str: DuckDB SQL query to run
+            sample, float: The share of the files or prefixes of the sources to scan.
+                Defaults to the entire sources
 
         Returns:
             Dataset or duckdb.DuckDBPyRelation if the data already exists in memeory
@@ -90,23 +118,23 @@ class DuckSession:
 
         # First try DuckDB to see if it can used from there? Will this be confusing?
 
-        parsed_query = Query.parse(query)
-        execution_plan = Plan.from_query(query=parsed_query)
+        execution_plan = self.plans.get(query, sample=sample)
 
         return Dataset(
             execution_plan=execution_plan,
             session=self,
         )
 
-    def execute(self, query: str) -> duckdb.DuckDBPyRelation:
+    def execute(self, query: str, sample: float = 1.0) -> duckdb.DuckDBPyRelation:
         """Execute the query using DuckDB instances
 
         Args:
             query, str: DuckDB SQL query to run
+            sample, float: The share of the sources to scan, see `sql`
 
         Returns:
             A duckdb.DuckDBPyRelation showing the queried data
         """
-        dataset = self.sql(query=query)
+        dataset = self.sql(query=query, sample=sample)
 
         return dataset.show()
@@ -0,0 +1,232 @@
+import math
+import os
+import typing as t
+
+from duckingit._listing import LISTINGS
+from duckingit._utils import (
+    create_conn_with_httpfs_loaded,
+    create_hash_string,
+    scan_source_for_versions,
+)
+
+STATISTICS_SCHEMA = """
+    file VARCHAR,
+    row_group_id BIGINT,
+    num_rows BIGINT,
+    column_name VARCHAR,
+    type VARCHAR,
+    min VARCHAR,
+    max VARCHAR,
+    null_count BIGINT,
+    bytes BIGINT,
+    version VARCHAR
+"""
+
+# Whether a row group with values between a min and a max may hold a value passing a filter
+RANGE_OPERATORS: dict[str, t.Callable[[t.Any, t.Any, t.Any], bool]] = {
+    "=": lambda low, high, value: low <= value <= high,
+    "IN": lambda low, high, value: low <= value <= high,
+    "!=": lambda low, high, value: not (low == high == value),
+    "<": lambda low, high, value: low < value,
+    "<=": lambda low, high, value: low <= value,
+    ">": lambda low, high, value: high > value,
+    ">=": lambda low, high, value: high >= value,
+}
+
+
+class StatisticsIndex:
+    """An index of the statistics of the row groups of the parquet files of a source
+
+    The index holds the min and max value, null count and compressed size of each column of
+    each row group, as read from the footers of the files by PARQUET_METADATA. It's stored as
+    a parquet file per source at `path`, either locally or at a prefix of a bucket, e.g.
+    s3://BUCKET_NAME/.cache/duckingit/statistics, and refreshed incrementally, i.e. only the
+    footers of files not indexed yet, or overwritten since by their version, are read, while
+    files no longer at the source are dropped from the index.
+
+    Attributes:
+        path, str: The directory or prefix the index is stored at
+        source, str: The source of the parquet files, e.g. 's3://BUCKET_NAME/2023/*'
+
+    Methods:
+        refresh: Indexes the files added to the source and drops the ones removed
+        row_groups: The row groups of the files, like `scan_source_parquet_metadata`
+        match: Tells which files may hold rows passing a number of filters
+    """
+
+    def __init__(self, path: str, source: str) -> None:
+        self.path = path.rstrip("/")
+        self.source = source
+
+        self._statistics: list[tuple] | None = None
+
+    @property
+    def location(self) -> str:
+        return f"{self.path}/{create_hash_string(self.source, digits=16)}.parquet"
+
+    @property
+    def statistics(self) -> list[tuple]:
+        """Returns the statistics of each column of each row group, see `STATISTICS_SCHEMA`"""
+        if self._statistics is None:
+            self.refresh()
+        return self._statistics  # type: ignore
+
+    def refresh(self) -> None:
+        conn = create_conn_with_httpfs_loaded()
+
+        conn.execute(f"CREATE TABLE statistics ({STATISTICS_SCHEMA})")
+        # The index is rewritten, thus it's read without the caches of the shared connection
+        if conn.sql(f"SELECT file FROM GLOB('{self.location}')").fetchall():
+            conn.execute(
+                f"INSERT INTO statistics BY NAME SELECT * FROM READ_PARQUET('{self.location}')"
+            )
+
+        indexed = dict(conn.sql("SELECT DISTINCT file, version FROM statistics").fetchall())
+        paths = LISTINGS.paths(source=self.source)
+        versions = dict(scan_source_for_versions(source=str(paths))) if paths else {}
+
+        # Files overwritten since they were indexed, see `scan_source_for_versions`, are
+        # indexed again, as well as files indexed without a version
+        added = [path for path in paths if path in versions and indexed.get(path) != versions[path]]
+        removed = sorted(set(indexed).difference(paths))
+
+        stale = removed + [path for path in added if path in indexed]
+        if stale:
+            conn.execute("DELETE FROM statistics WHERE list_contains(?, file)", [stale])
+
+        if added:
+            conn.execute("CREATE TABLE versions (file VARCHAR, version VARCHAR)")
+            conn.executemany(
+                "INSERT INTO versions VALUES (?, ?)", [(path, versions[path]) for path in added]
+            )
+            conn.execute(f"""
+                INSERT INTO statistics
+                SELECT
+                    file_name,
+                    row_group_id,
+                    row_group_num_rows,
+                    path_in_schema,
+                    type,
+                    stats_min_value,
+                    stats_max_value,
+                    stats_null_count,
+                    total_compressed_size,
+                    versions.version
+                FROM PARQUET_METADATA({added})
+                JOIN versions ON file_name = versions.file
+                """)
+
+        if added or removed:
+            if "://" not in self.path:
+                os.makedirs(self.path, exist_ok=True)
+            conn.execute(f"COPY statistics TO '{self.location}' (FORMAT PARQUET)")
+
+        self._statistics = conn.sql(
+            "SELECT * EXCLUDE (version) FROM statistics ORDER BY file, row_group_id, column_name"
+        ).fetchall()
+
+    def row_groups(self, files: t.Iterable[str] | None = None) -> list[tuple[str, int, int, int]]:
+        """Returns the row groups of the files of the source
+
+        Args:
+            files, Iterable[str] | None: The files to return the row groups of, or None for all
+
+        Returns:
+            A list of files, row group ids, number of rows and compressed size in bytes of each
+            row group
+        """
+        files = set(files) if files is not None else None
+
+        row_groups: dict[tuple[str, int], tuple[int, int]] = {}
+        for file, row_group_id, num_rows, _, _, _, _, _, size in self.statistics:
+            if files is not None and file not in files:
+                continue
+
+            _, total = row_groups.get((file, row_group_id), (0, 0))
+            row_groups[(file, row_group_id)] = (num_rows, total + size)
+
+        return [(file, i, num_rows, size) for (file, i), (num_rows, size) in row_groups.items()]
+
+    def match(self, filters: list[tuple[str, str, list[str | float]]]) -> list[str]:
+        """Returns the files with a row group that may hold rows passing all of the filters
+
+        Args:
+            filters, list[tuple[str, str, list[str | float]]]: The column, operator and
+                values of each filter, e.g. ('amount', '>', [100.0])
+
+        Returns:
+            The files that cannot be skipped, in order
+        """
+        row_groups: dict[tuple[str, int], dict[str, tuple]] = {}
+        for statistics in self.statistics:
+            file, row_group_id, _, column = statistics[:4]
+            row_groups.setdefault((file, row_group_id), {})[column.lower()] = statistics
+
+        files: dict[str, None] = {}
+        for (file, _), columns in row_groups.items():
+            if file not in files and all(
+                may_pass(columns.get(column.lower()), operator, values)
+                for column, operator, values in filters
+            ):
+                files[file] = None
+
+        return list(files)
+
+
+def may_pass(statistics: tuple | None, operator: str, values: list[str | float]) -> bool:
+    """Tells whether a column of a row group may hold a value passing a filter
+
+    Only comparisons that agree with DuckDB can rule out a row group, i.e. numbers are compared
+    to the values of numeric columns, strings to those of string columns or to dates and
+    timestamps of the same format. Anything else may pass.
+
+    Args:
+        statistics, tuple | None: The statistics of the column, or None if unknown
+        operator, str: The operator of the filter, e.g. '>='
+        values, list[str | float]: The values of the filter
+
+    Returns:
+        False if no value of the column passes the filter, otherwise True
+
+    Examples:
+        >>> may_pass(("a.parquet", 0, 10, "x", "INT64", "1", "5", 0, 80), ">", [5.0])
+        False
+    """
+    if statistics is None:
+        return True
+
+    _, _, num_rows, _, type_, low, high, null_count, _ = statistics
+    if operator in ("IS NULL", "IS NOT NULL"):
+        if null_count is None:
+            return True
+        return null_count > 0 if operator == "IS NULL" else null_count < num_rows
+
+    if low is None or high is None:
+        # A column of NULLs only never passes a comparison
+        return null_count is None or null_count < num_rows
+    if operator not in RANGE_OPERATORS:
+        return True
+
+    for value in values:
+        bounds = comparable(type_, low, high, value)
+        if bounds is None or RANGE_OPERATORS[operator](*bounds):
+            return True
+
+    return False
+
+
+def comparable(type_: str, low: str, high: str, value: str | float) -> tuple | None:
+    """Returns the min, max and value of a filter in a form they compare like in DuckDB, or
+    None if they cannot be compared safely"""
+    if type_ != "BYTE_ARRAY":
+        try:
+            bounds = float(low), float(high), float(value)
+            if all(math.isfinite(bound) for bound in bounds):
+                return bounds
+        except ValueError:
+            pass
+
+    if isinstance(value, str) and (type_ == "BYTE_ARRAY" or len(low) == len(high) == len(value)):
+        return low, high, value
+
+    return None
@@ -1,5 +1,9 @@
 import hashlib
+import heapq
 import itertools
+import random
+import threading
+import time
 import typing as t
 import uuid
 from collections.abc import Iterable
@@ -8,6 +12,10 @@ import duckdb
 
 T = t.TypeVar("T")
 
+# The scans of listings and metadata share a connection, see `create_conn_for_metadata`
+_metadata_lock = threading.Lock()
+_metadata_conn: tuple[duckdb.DuckDBPyConnection, float, int] | None = None
+
 
 def flatten_list(_list: list[list[T]]) -> list[T]:
     """Flats a list of lists
@@ -54,6 +62,101 @@ def split_list_in_chunks(_list: list[str], number_of_invokations: int) -> list[l
     ]
 
 
+def split_list_in_bins(_list: list[tuple[T, int]], number_of_bins: int) -> list[list[T]]:
+    """Divides the items among the bins, such that the bins are balanced by size
+
+    The items are placed from largest to smallest, each in the bin that is smallest so far.
+
+    Args:
+        _list, list[tuple[T, int]]: A list of items and their sizes, e.g. bytes of files
+        number_of_bins, int: The number of bins
+
+    Returns:
+        A list of bins of items, but no more bins than the length of the supplied list
+
+    Examples:
+        >>> split_list_in_bins([("a", 10), ("b", 2), ("c", 7), ("d", 1)], 2)
+        [["a"], ["b", "c", "d"]]
+    """
+    number_of_bins = max(min(number_of_bins, len(_list)), 1)
+
+    bins: list[tuple[int, int, list[T]]] = [(0, i, []) for i in range(number_of_bins)]
+    for item, size in sorted(_list, key=lambda x: (-x[1], str(x[0]))):
+        total, i, items = heapq.heappop(bins)
+        items.append(item)
+        heapq.heappush(bins, (total + size, i, items))
+
+    return [sorted(items, key=str) for _, _, items in sorted(bins, key=lambda x: x[1]) if items]
+
+
+def split_row_groups_in_ranges(
+    row_groups: list[tuple[int, int]], max_bytes: int
+) -> list[tuple[int, int]]:
+    """Divides consecutive row groups of a file into ranges of rows of a maximum size
+
+    A row group larger than the maximum size gets a range of its own.
+
+    Args:
+        row_groups, list[tuple[int, int]]: The number of rows and size of each row group
+        max_bytes, int: The maximum size of a range in bytes
+
+    Returns:
+        A list of the first and last row number of each range
+
+    Examples:
+        >>> split_row_groups_in_ranges([(100, 10), (100, 10), (50, 5)], 20)
+        [(0, 199), (200, 249)]
+    """
+    ranges = []
+
+    start, row, size = 0, 0, 0
+    for num_rows, num_bytes in row_groups:
+        if size > 0 and size + num_bytes > max_bytes:
+            ranges.append((start, row - 1))
+            start, size = row, 0
+
+        row += num_rows
+        size += num_bytes
+
+    if row > start:
+        ranges.append((start, row - 1))
+
+    return ranges
+
+
+def sample_systematically(_list: list[T], fraction: float, seed: str) -> list[T]:
+    """Samples a share of the items at a fixed step from a random start
+
+    Items next to each other in order, e.g. files of the same hive partition or day, are
+    sampled evenly, i.e. the sample is stratified by the order of the items. Every item is
+    sampled with a probability of `fraction`, and an item is kept even if none is sampled.
+
+    Args:
+        _list, list[T]: The items to sample, in order
+        fraction, float: The share of the items to sample, between 0 and 1
+        seed, str: The seed of the random start, such that a sample is repeatable
+
+    Returns:
+        The sampled items, in order
+
+    Examples:
+        >>> len(sample_systematically(list(range(100)), 0.1, seed="source"))
+        10
+    """
+    if fraction >= 1 or len(_list) == 0:
+        return list(_list)
+
+    step = 1 / fraction
+    position = random.Random(seed).uniform(0, step)
+
+    sample = []
+    while position < len(_list):
+        sample.append(_list[int(position)])
+        position += step
+
+    return sample or [_list[0]]
+
+
 def create_hash_string(
     string: str, algorithm: str = "md5", digits: int | None = None, first_char: str = ""
 ) -> str:
@@ -106,6 +209,50 @@ def create_conn_with_httpfs_loaded() -> duckdb.DuckDBPyConnection:
     return conn
 
 
+def create_conn_for_metadata() -> duckdb.DuckDBPyConnection:
+    """Returns a cursor of an in memory DuckDB connection with httpfs loaded, which is shared
+    by the scans of listings and metadata of sources
+
+    Thereby httpfs is loaded and the credentials are applied once, rather than on every scan.
+    If `session.listing_ttl_seconds` is set, the HTTP metadata cache and the object cache,
+    e.g. of parquet footers, are enabled as well, such that repeated scans of the same files
+    hit the cache. The connection, and thus its caches, is renewed once it's older than the
+    TTL, i.e. sources are as stale as their listing in the plan cache at most. Files that are
+    rewritten by duckingit, e.g. a cache catalog, must not be read through the connection.
+
+    Each cursor can be used by a thread of its own, while it shares the caches of the others.
+    """
+    global _metadata_conn
+
+    from duckingit._config import DuckConfig
+
+    ttl = DuckConfig().session.listing_ttl_seconds
+    now = time.monotonic()
+    with _metadata_lock:
+        if _metadata_conn is not None:
+            _, created_at, conn_ttl = _metadata_conn
+            if conn_ttl != ttl or (ttl and now - created_at > ttl):
+                _metadata_conn = None
+
+        if _metadata_conn is None:
+            conn = create_conn_with_httpfs_loaded()
+            if ttl:
+                conn.execute("SET enable_http_metadata_cache = true;")
+                conn.execute("SET enable_object_cache = true;")
+            _metadata_conn = (conn, now, ttl)
+
+        return _metadata_conn[0].cursor()
+
+
+def clear_conn_for_metadata() -> None:
+    """Drops the shared connection of `create_conn_for_metadata`, e.g. to apply new
+    credentials, while the cursors in use remain valid"""
+    global _metadata_conn
+
+    with _metadata_lock:
+        _metadata_conn = None
+
+
 def scan_source_for_files(source: str) -> list[str]:
     """Scans the source for files using DuckDB
 
@@ -113,7 +260,7 @@ def scan_source_for_files(source: str) -> list[str]:
         source, str: The source to scan, e.g. s3://BUCKET_NAME/
 
     """
-    conn = create_conn_with_httpfs_loaded()
+    conn = create_conn_for_metadata()
 
     if source[-1] == "/":
         source = source[:-1]
@@ -124,48 +271,186 @@ def scan_source_for_files(source: str) -> list[str]:
     return flatten_list(files)
 
 
-def scan_source_for_prefixes(source: str) -> list[str]:
-    """Scans the a source for prefixes using DuckDB
+def match_hive_partitions(path: str, filters: list[tuple[str, str, list[str | float]]]) -> bool:
+    """Tells whether a path may hold rows that pass the filters of hive partitions
+
+    The filters are matched against the `key=value` segments of the directories of the path.
+    A filter of a key the path doesn't have, or a comparison that is ambiguous, is passed.
 
     Args:
-        source, str: The source to scan, e.g. s3://source_NAME/
-    """
-    conn = create_conn_with_httpfs_loaded()
+        path, str: A file or prefix, e.g. s3://BUCKET_NAME/year=2023/month=05/file.parquet
+        filters, list[tuple[str, str, list[str | float]]]: The column, operator and values
+            of each filter, e.g. ('year', '=', [2023.0])
+
+    Returns:
+        False if the path cannot hold any rows passing the filters, otherwise True
 
-    # TODO: Count the number of files / size in each prefix to divide the workload better
-    glob_query = f"""
-        SELECT DISTINCT
-            CONCAT(REGEXP_REPLACE(file, '/[^/]+$', ''), '/*') AS prefix
-        FROM GLOB({source})
-        """
+    Examples:
+        >>> match_hive_partitions("s3://BUCKET_NAME/year=2023/a.parquet", [("year", "=", [2022.0])])
+        False
+        >>> match_hive_partitions("s3://BUCKET_NAME/2023/a.parquet", [("year", "=", [2022.0])])
+        True
+    """
+    compare: dict[str, t.Callable[[t.Any, t.Any], bool]] = {
+        "=": lambda a, b: a == b,
+        "IN": lambda a, b: a == b,
+        "!=": lambda a, b: a != b,
+        "<": lambda a, b: a < b,
+        "<=": lambda a, b: a <= b,
+        ">": lambda a, b: a > b,
+        ">=": lambda a, b: a >= b,
+    }
+
+    partitions = {}
+    for segment in path.split("/")[:-1]:
+        key, sep, value = segment.partition("=")
+        if sep:
+            partitions[key.lower()] = value
+
+    for column, operator, values in filters:
+        value = partitions.get(column.lower())
+        if value is None or value == "__HIVE_DEFAULT_PARTITION__" or operator not in compare:
+            continue
+
+        try:
+            number = float(value)
+        except ValueError:
+            number = None
+
+        matches = False
+        for literal in values:
+            # The type of a partition is inferred by DuckDB, so a string literal is compared
+            # both as a string and as a number, while a number is only compared as a number
+            if isinstance(literal, str):
+                matches |= compare[operator](value, literal)
+                try:
+                    literal = float(literal)
+                except ValueError:
+                    continue
+
+            matches |= number is None or compare[operator](number, literal)
+
+        if not matches:
+            return False
+
+    return True
+
+
+def scan_source_for_paths(source: str) -> list[str]:
+    """Scans the source for the paths of its files using DuckDB
 
-    prefixes = conn.sql(glob_query).fetchall()
+    Args:
+        source, str: The source to scan, e.g. 's3://BUCKET_NAME/year=*/*'
+    """
+    conn = create_conn_for_metadata()
 
-    return flatten_list(prefixes)
+    paths = conn.sql(f"SELECT file FROM GLOB({source}) ORDER BY file").fetchall()
+    return flatten_list(paths)
 
 
-def scan_source_parquet_metadata(source: str) -> list[tuple[str, int]]:
-    """Scans metadata of parquet files at source using DuckDB
+def scan_source_for_versions(source: str) -> list[tuple[str, str]]:
+    """Scans the files of a source for their versions using DuckDB, i.e. their size and time
+    of last modification, which change once a file is overwritten
 
     Args:
-        source, str: The source to scan, e.g. s3://BUCKET_NAME/
+        source, str: The source to scan, e.g. "['s3://BUCKET_NAME/2023/01.parquet']"
 
+    Returns:
+        A list of files and their versions, e.g. ('s3://BUCKET_NAME/2023/01.parquet',
+        '1024@2023-01-01 00:00:00+00')
     """
-    conn = create_conn_with_httpfs_loaded()
+    conn = create_conn_for_metadata()
 
-    if source[-1] == "/":
-        source = source[:-1]
+    query = f"""
+        SELECT filename, CONCAT(size, '@', CAST(last_modified AS VARCHAR))
+        FROM READ_BLOB({source})
+        ORDER BY filename
+    """
+
+    return conn.sql(query).fetchall()
+
+
+def scan_source_parquet_metadata(source: str) -> list[tuple[str, int, int, int]]:
+    """Scans the row groups of parquet files at source using DuckDB
+
+    Args:
+        source, str: The source to scan, e.g. 's3://BUCKET_NAME/2023/*'
+
+    Returns:
+        A list of files, row group ids, number of rows and compressed size in bytes of each
+        row group
+    """
+    conn = create_conn_for_metadata()
 
     query = f"""
-        SELECT file_name, SUM(total_compressed_size) AS bytes
-        FROM  PARQUET_METADATA('{source}/*')
-        GROUP BY file_name
+        SELECT
+            file_name,
+            row_group_id,
+            MAX(row_group_num_rows) AS num_rows,
+            SUM(total_compressed_size) AS bytes
+        FROM PARQUET_METADATA({source})
+        GROUP BY file_name, row_group_id
+        ORDER BY file_name, row_group_id
     """
 
     files = conn.sql(query).fetchall()
     return files
 
 
+def scan_source_parquet_statistics(source: str) -> list[tuple]:
+    """Scans the statistics of the columns of the row groups of parquet files using DuckDB
+
+    Args:
+        source, str: The source to scan, e.g. 's3://BUCKET_NAME/2023/*'
+
+    Returns:
+        A list of files, row group ids, number of rows, column names, physical types, min and
+        max values, null counts and compressed sizes in bytes of each column of each row group
+    """
+    conn = create_conn_for_metadata()
+
+    query = f"""
+        SELECT
+            file_name,
+            row_group_id,
+            row_group_num_rows,
+            path_in_schema,
+            type,
+            stats_min_value,
+            stats_max_value,
+            stats_null_count,
+            total_compressed_size
+        FROM PARQUET_METADATA({source})
+        ORDER BY file_name, row_group_id, path_in_schema
+    """
+
+    return conn.sql(query).fetchall()
+
+
+def scan_source_schema(source: str) -> dict[str, str]:
+    """Scans the names and DuckDB types of the columns of a source using DuckDB
+
+    Args:
+        source, str: The source to scan, e.g. 's3://BUCKET_NAME/2023/file.parquet'
+    """
+    conn = create_conn_for_metadata()
+
+    columns = conn.sql(f"DESCRIBE SELECT * FROM READ_PARQUET({source})").fetchall()
+    return {column[0]: column[1] for column in columns}
+
+
+def scan_query_schema(query: str) -> list[tuple[str, str]]:
+    """Scans the names and DuckDB types of the columns a query outputs using DuckDB, in order
+
+    Args:
+        query, str: The query to scan, e.g. "SELECT * FROM READ_PARQUET(['s3://BUCKET_NAME/*'])"
+    """
+    conn = create_conn_for_metadata()
+
+    columns = conn.sql(f"DESCRIBE {query}").fetchall()
+    return [(column[0], column[1]) for column in columns]
+
+
 def cast_mapping_to_string_with_newlines(service_name: str, mapping: dict[str, t.Any]):
     map_key_with_value = list(
         ".".join([service_name, k]) + ":" + str(v) for k, v in mapping.items()
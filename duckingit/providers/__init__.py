@@ -1,7 +1,13 @@
+import threading
 from enum import Enum
 
+from duckingit._utils import clear_conn_for_metadata
 from duckingit.providers.aws import AWS
 
+# Providers are shared, as they hold the clients and thereby the pools of connections
+_lock = threading.Lock()
+_providers: dict = {}
+
 
 class Providers(Enum):
     AWS = "aws"
@@ -13,6 +19,17 @@ class Providers(Enum):
         providers = {cls.AWS: AWS}
 
         try:
-            return providers[cls(name.lower())]()
+            provider = cls(name.lower())
+            with _lock:
+                if provider not in _providers:
+                    _providers[provider] = providers[provider]()
+                return _providers[provider]
         except ValueError as e:
             raise ValueError(f"Unknown provider `{name}`") from e
+
+    @classmethod
+    def clear(cls) -> None:
+        """Clears the shared providers, e.g. to apply new credentials"""
+        with _lock:
+            _providers.clear()
+        clear_conn_for_metadata()
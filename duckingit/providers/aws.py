@@ -1,14 +1,19 @@
 import json
 import os
+import threading
 import typing as t
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dataclasses import dataclass
 
 import boto3  # type: ignore
+from botocore.config import Config  # type: ignore
 
-from duckingit._exceptions import ConfigurationError
+from duckingit._exceptions import ConfigurationError, FailedInvokations
 from duckingit._planner import Task
 from duckingit.providers.provider import Provider
 
+MAX_DELETE_OBJECTS = 1000  # Limit of S3
+
 
 @dataclass
 class SQSMessage:
@@ -16,6 +21,7 @@ class SQSMessage:
     message_id: str
     receipt_handle: str
     response_payload: str
+    rows: int | None = None  # The number of rows output by a successful invokation
 
     def __repr__(self) -> str:
         return self.response_payload
@@ -39,6 +45,11 @@ class AWS(Provider):
 
             setattr(self, key, val)
 
+        self._lock = threading.Lock()
+        self._lambda: t.Optional["AWSLambda"] = None
+        self._sqs: t.Optional["AWSSQS"] = None
+        self._s3: t.Optional["AWSS3"] = None
+
     def duckdb_settings(self) -> str:
         return f"""
             SET s3_region='{self.aws_region}';
@@ -47,12 +58,49 @@ class AWS(Provider):
         """
 
     @property
-    def lambda_(self):
-        return AWSLambda()
+    def lambda_(self) -> "AWSLambda":
+        with self._lock:
+            if self._lambda is None:
+                self._lambda = AWSLambda()
+            return self._lambda
 
     @property
-    def sqs(self):
-        return AWSSQS()
+    def sqs(self) -> "AWSSQS":
+        with self._lock:
+            if self._sqs is None:
+                self._sqs = AWSSQS()
+            return self._sqs
+
+    @property
+    def s3(self) -> "AWSS3":
+        with self._lock:
+            if self._s3 is None:
+                self._s3 = AWSS3()
+            return self._s3
+
+    def _create_client(self, service_name: str, max_pool_connections: int = 0):
+        """Creates a client, which is thread safe and keeps its connections alive
+
+        Args:
+            service_name, str: The name of the AWS service, e.g. lambda
+            max_pool_connections, int: The minimum size of the pool of connections, which
+                otherwise follows `aws_config.max_pool_connections`
+        """
+        from duckingit._config import DuckConfig
+
+        config = Config(
+            max_pool_connections=max(
+                DuckConfig().aws_config.max_pool_connections, max_pool_connections
+            ),
+            tcp_keepalive=True,
+        )
+        return boto3.client(
+            service_name,
+            aws_access_key_id=self.aws_access_key_id,
+            aws_secret_access_key=self.aws_secret_access_key,
+            region_name=self.aws_region,
+            config=config,
+        )
 
     def _collect_field_from_response(self, response: dict[str, dict], field: str):
         unwrap = response.get("ResponseMetadata", None)
@@ -82,12 +130,7 @@ class AWSSQS(AWS):
     def __init__(self):
         super(AWSSQS, self).__init__()
 
-        self.sqs_client = boto3.client(
-            "sqs",
-            aws_access_key_id=self.aws_access_key_id,
-            aws_secret_access_key=self.aws_secret_access_key,
-            region_name=self.aws_region,
-        )
+        self.sqs_client = self._create_client("sqs")
 
     def update_sqs_configurations(self, name: str, configs: dict) -> None:
         response = self.sqs_client.set_queue_attributes(QueueUrl=name, Attributes=configs)
@@ -102,12 +145,13 @@ class AWSSQS(AWS):
         request_id = body.get("requestContext").get("requestId")
         message_id = message.get("MessageId", "")
         request_handle = message.get("ReceiptHandle", "")
-        response_payload = body.get("responsePayload").get("errorMessage", "")
+        response_payload = body.get("responsePayload") or {}
         return SQSMessage(
             request_id=request_id,
             message_id=message_id,
             receipt_handle=request_handle,
-            response_payload=response_payload,
+            response_payload=response_payload.get("errorMessage", ""),
+            rows=response_payload.get("rows"),
         )
 
     def delete_messages_from_queue(self, name: str, entries: list[dict[str, str]]) -> None:
@@ -143,15 +187,74 @@ class AWSSQS(AWS):
         self.sqs_client.purge_queue(QueueUrl=name)
 
 
+class AWSS3(AWS):
+    def __init__(self):
+        super(AWSS3, self).__init__()
+
+        self.s3_client = self._create_client("s3")
+
+    def list_prefixes(self, prefix: str, start_after: str = "") -> list[str]:
+        """Lists the prefixes directly under a prefix, page by page
+
+        Args:
+            prefix, str: The prefix to list, ending with a slash, e.g. s3://BUCKET_NAME/2023/
+            start_after, str: A prefix to list from, e.g. s3://BUCKET_NAME/2023/05/, or '' to
+                list all
+
+        Returns:
+            The prefixes ending with a slash in order, e.g. ['s3://BUCKET_NAME/2023/05/']
+        """
+        bucket, _, name = prefix.split("://", 1)[-1].partition("/")
+        options = {"Bucket": bucket, "Prefix": name, "Delimiter": "/"}
+        if start_after:
+            # Keys under the prefix to start after are listed as well, and so is the prefix
+            options["StartAfter"] = start_after.split("://", 1)[-1].partition("/")[2]
+
+        prefixes = []
+        paginator = self.s3_client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(**options):
+            prefixes.extend(f"s3://{bucket}/{p['Prefix']}" for p in page.get("CommonPrefixes", []))
+
+        return sorted(prefixes)
+
+    def delete_objects(self, keys: list[str]) -> None:
+        """Deletes objects, or the objects under a key of a directory
+
+        Args:
+            keys, list[str]: The keys to delete, e.g. s3://BUCKET_NAME/.cache/duckingit/x.parquet
+        """
+        objects: dict[str, list[str]] = {}
+        for key in keys:
+            bucket, _, name = key.split("://", 1)[-1].partition("/")
+            if name.endswith(".parquet"):
+                objects.setdefault(bucket, []).append(name)
+                continue
+
+            paginator = self.s3_client.get_paginator("list_objects_v2")
+            for page in paginator.paginate(Bucket=bucket, Prefix=f"{name}/"):
+                objects.setdefault(bucket, []).extend(o["Key"] for o in page.get("Contents", []))
+
+        for bucket, names in objects.items():
+            for i in range(0, len(names), MAX_DELETE_OBJECTS):
+                response = self.s3_client.delete_objects(
+                    Bucket=bucket,
+                    Delete={
+                        "Objects": [{"Key": name} for name in names[i : i + MAX_DELETE_OBJECTS]],
+                        "Quiet": True,
+                    },
+                )
+                self._validate_response(response=response)
+
+
 class AWSLambda(AWS):
     def __init__(self):
+        from duckingit._config import DuckConfig
+
         super(AWSLambda, self).__init__()
 
-        self.lambda_client = boto3.client(
-            "lambda",
-            aws_access_key_id=self.aws_access_key_id,
-            aws_secret_access_key=self.aws_secret_access_key,
-            region_name=self.aws_region,
+        # Room for a connection per concurrent invokation
+        self.lambda_client = self._create_client(
+            "lambda", max_pool_connections=DuckConfig().aws_lambda.MaxConcurrentInvokes
         )
 
     def warm_up_lambda_function(self) -> None:
@@ -164,14 +267,65 @@ class AWSLambda(AWS):
             InvocationType="RequestResponse",
         )
 
-    def invoke(self, execution_tasks: t.Set[Task], prefix: str) -> dict[str, Task]:
-        request_ids = {}
-        for step in execution_tasks:
-            key = f"{prefix}/{step.subquery_hashed}.parquet"
-            request_payload = json.dumps({"query": step.subquery, "key": key})
+    def invoke(
+        self,
+        execution_tasks: t.Set[Task],
+        prefix: str,
+        callback: t.Callable[[str, Task], None] | None = None,
+    ) -> dict[str, Task]:
+        """Invokes a Lambda function per task
+
+        The tasks are invoked concurrently, though no more than `MaxConcurrentInvokes` at a
+        time.
+
+        Args:
+            execution_tasks, Set[Task]: The tasks to invoke
+            prefix, str: The prefix to store the output of the tasks
+            callback, Callable[[str, Task], None]: Called with the request id and the task
+                as soon as a task is invoked, e.g. to start collecting its completion
+
+        Returns:
+            A mapping of request ids to tasks
+
+        Raises:
+            FailedInvokations: If any task couldn't be invoked, once all of them have been
+                tried, with the request ids of the tasks that were invoked
+        """
+        from duckingit._config import DuckConfig
+
+        def invoke_task(task: Task) -> tuple[str, Task]:
+            payload = {"query": task.subquery, "key": task.key(prefix)}
+            if task.partitions:
+                payload["partitions"] = task.partitions
+
+            request_payload = json.dumps(payload)
             request_id = self._invoke_lambda(request_payload=request_payload)
 
-            request_ids[request_id] = step
+            if callback is not None:
+                callback(request_id, task)
+            return request_id, task
+
+        max_workers = min(DuckConfig().aws_lambda.MaxConcurrentInvokes, len(execution_tasks))
+
+        request_ids: dict[str, Task] = {}
+        failed: dict[Task, Exception] = {}
+        with ThreadPoolExecutor(max_workers=max(max_workers, 1)) as executor:
+            futures = {executor.submit(invoke_task, task): task for task in execution_tasks}
+            for future in as_completed(futures):
+                try:
+                    request_id, task = future.result()
+                except Exception as e:
+                    failed[futures[future]] = e
+                    continue
+                request_ids[request_id] = task
+
+        if failed:
+            error = next(iter(failed.values()))
+            raise FailedInvokations(
+                f"{len(failed)} of {len(execution_tasks)} invokations failed: {error}",
+                request_ids=request_ids,
+                failed=failed,
+            ) from error
         return request_ids
 
     def _invoke_lambda(self, request_payload: str):
@@ -24,5 +24,22 @@ def lambda_handler(event, context):
 
     key = event["key"]  # key to S3
     query = event["query"]
-    con.sql("COPY ({query}) TO '{key}' (FORMAT 'PARQUET')".format(key=key, query=query))
-    return {"statusCode": 200}
+    partitions = event.get("partitions", 0)
+
+    rows = None
+    if partitions:
+        # Shuffle: A file per hash partition, even when empty, under the key as a directory
+        con.sql("CREATE OR REPLACE TEMP TABLE __output AS {query}".format(query=query))
+        for partition in range(partitions):
+            con.sql(
+                "COPY (SELECT * EXCLUDE (__partition) FROM __output WHERE __partition = {p}) "
+                "TO '{key}/{p}.parquet' (FORMAT 'PARQUET')".format(key=key, p=partition)
+            )
+        con.sql("DROP TABLE __output")
+    else:
+        # The number of rows written, which lets the controller stop invoking the tasks of a
+        # LIMIT once enough rows are output
+        (rows,) = con.execute(
+            "COPY ({query}) TO '{key}' (FORMAT 'PARQUET')".format(key=key, query=query)
+        ).fetchone()
+    return {"statusCode": 200, "rows": rows}
@@ -1,55 +1,165 @@
+import os
+import threading
 import typing as t
 
+import duckdb
 import pytest
 
+from duckingit._cache import Cache, CacheCatalog, CacheEntry
+from duckingit._collector import Collector
 from duckingit._config import DuckConfig
 from duckingit._controller import Controller
 from duckingit._dataset import Dataset
+from duckingit._exceptions import FailedInvokations
+from duckingit._listing import LISTINGS
 from duckingit._parser import Query
-from duckingit._planner import Plan, Task
+from duckingit._planner import Plan, Stage, Task
 from duckingit._session import DuckSession
-from duckingit._utils import create_hash_string
+from duckingit._utils import clear_conn_for_metadata
 from duckingit.providers.aws import AWS, SQSMessage
 
 
 class _MockAWS(AWS):
+    """Mocks both Lambda and SQS, where an invokation finishes once it's polled for
+
+    Invokations of subqueries containing a key of `failing` fail as many times as its value,
+    while the ones containing a key of `straggling` never finish as many times as its value,
+    and the ones containing a key of `unreachable` can't be invoked as many times as its value.
+    Successful invokations report `rows` as the number of rows output.
+    """
+
+    def __init__(
+        self,
+        failing: dict[str, int] = {},
+        straggling: dict[str, int] = {},
+        unreachable: dict[str, int] = {},
+        rows: int | None = None,
+    ) -> None:
+        super().__init__()
+        self.failing = dict(failing)
+        self.straggling = dict(straggling)
+        self.unreachable = dict(unreachable)
+        self.rows = rows
+        self.invoked: list[Task] = []
+        self.deleted: list[dict] = []
+
+        self._outstanding: dict[str, list[SQSMessage]] = {}
+        self._condition = threading.Condition()
+
+    @property
+    def lambda_(self):
+        return self
+
+    @property
+    def sqs(self):
+        return self
+
     def poll_messages_from_queue(self, name: str, wait_time_seconds: int) -> list[SQSMessage]:
-        return [
-            SQSMessage(
-                request_id="123", message_id="ABC", receipt_handle="ABC", response_payload=""
-            ),
-            SQSMessage(
-                request_id="345", message_id="ABC", receipt_handle="ABC", response_payload=""
-            ),
-            SQSMessage(
-                request_id="678", message_id="ABC", receipt_handle="ABC", response_payload=""
-            ),
-        ]
+        with self._condition:
+            self._condition.wait_for(lambda: self._outstanding.get(name), timeout=0.05)
+            return self._outstanding.pop(name, [])
 
     def delete_messages_from_queue(self, name: str, entries: list[dict]) -> None:
-        pass
+        self.deleted.extend(entries)
+
+    def finish(self, request_id: str, queue: str) -> None:
+        message = SQSMessage(
+            request_id=request_id,
+            message_id=f"message-{request_id}",
+            receipt_handle=f"handle-{request_id}",
+            response_payload="",
+            rows=self.rows if queue == DuckConfig().aws_sqs.QueueSuccess else None,
+        )
+        with self._condition:
+            self._outstanding.setdefault(queue, []).append(message)
+            self._condition.notify_all()
+
+    def invoke(
+        self,
+        execution_tasks: t.Set[Task],
+        prefix: str,
+        callback: t.Callable[[str, Task], None] | None = None,
+    ) -> dict[str, Task]:
+        request_ids = {}
+        failed: dict[Task, Exception] = {}
+        for task in execution_tasks:
+            for name, times in self.unreachable.items():
+                if name in task.subquery and times > 0:
+                    self.unreachable[name] -= 1
+                    failed[task] = ConnectionError(f"Couldn't invoke {name}")
+            if task in failed:
+                continue
+
+            request_id = f"request-{len(self.invoked)}"
+            self.invoked.append(task)
+            request_ids[request_id] = task
+
+            queue = DuckConfig().aws_sqs.QueueSuccess
+            for failing, times in self.failing.items():
+                if failing in task.subquery and times > 0:
+                    self.failing[failing] -= 1
+                    queue = DuckConfig().aws_sqs.QueueFailure
+            for straggling, times in self.straggling.items():
+                if straggling in task.subquery and times > 0:
+                    self.straggling[straggling] -= 1
+                    queue = ""
+            if queue:
+                self.finish(request_id=request_id, queue=queue)
+
+            if callback is not None:
+                callback(request_id, task)
+
+        if failed:
+            raise FailedInvokations("Couldn't invoke", request_ids=request_ids, failed=failed)
+        return request_ids
+
+
+class _MockCacheCatalog(CacheCatalog):
+    """Keeps the catalog in memory, as if the output of every task was stored but at the
+    locations of `missing`, where the files of the sources have the versions of `listed`"""
+
+    def __init__(self, path: str) -> None:
+        super().__init__(path)
+        self.stored: list[CacheEntry] = []
+        self.listed: dict[str, str] = {}
+        self.missing: t.Set[str] = set()
+
+    def versions(self, paths: list[str]) -> dict[str, str]:
+        return dict(self.listed)
+
+    def exists(self, locations: list[str]) -> t.Set[str]:
+        return set(locations) - self.missing
+
+    def load(self) -> dict[str, CacheEntry]:
+        return {entry.location: entry for entry in self.stored}
+
+    def measure(self, locations: list[str]) -> dict[str, int]:
+        return dict.fromkeys(locations, 1)
+
+    def write(self, entries: list[CacheEntry]) -> None:
+        self.stored = list(entries)
+
+
+class _MockCache(Cache):
+    """Keeps the catalogs in memory, and the keys of the deleted output"""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.catalogs: dict[str, _MockCacheCatalog] = {}
+        self.deleted: list[str] = []
+
+    def open(self, prefix: str) -> CacheCatalog:
+        super().open(prefix)
+        catalog = self.catalogs.setdefault(prefix, _MockCacheCatalog(prefix))
+        catalog._entries = None  # Read the stored catalog once per execution
+        return catalog
 
-    def invoke(self, execution_steps: t.Set[Task], prefix: str) -> dict[str, Task]:
-        return {
-            "123": Task(subquery="mock", subquery_hashed="hashed"),
-            "345": Task(subquery="mock", subquery_hashed="hashed"),
-            "678": Task(subquery="mock", subquery_hashed="hashed"),
-        }
+    def delete(self, keys: list[str]) -> None:
+        self.deleted.extend(keys)
 
 
 class _MockController(Controller):
-    def _set_provider(self):
-        self.provider = _MockAWS()
-
-    def scan_cache_data(self, source: str) -> list[str]:
-        return list(
-            create_hash_string(subquery, algorithm="md5")
-            for subquery in [
-                "SELECT * FROM READ_PARQUET(['s3://BUCKET_NAME/2023/01/*'])",
-                "SELECT * FROM READ_PARQUET(['s3://BUCKET_NAME/2023/02/*'])",
-                "SELECT * FROM READ_PARQUET(['s3://BUCKET_NAME/2023/03/*'])",
-            ]
-        )
+    pass
 
 
 class _MockDataset(Dataset):
@@ -68,11 +178,73 @@ class _MockDuckConfig(DuckConfig):
     pass
 
 
+class _MockSession:
+    """Holds the state of a session the Controller depends on without connecting to DuckDB"""
+
+    def __init__(
+        self,
+        failing: dict[str, int] = {},
+        straggling: dict[str, int] = {},
+        unreachable: dict[str, int] = {},
+        rows: int | None = None,
+    ) -> None:
+        self.cache = _MockCache()
+        self.provider = _MockAWS(
+            failing=failing, straggling=straggling, unreachable=unreachable, rows=rows
+        )
+        self.collector = Collector(
+            provider=self.provider,
+            success_queue=self.conf.aws_sqs.QueueSuccess,
+            failure_queue=self.conf.aws_sqs.QueueFailure,
+        )
+
+    @property
+    def conf(self) -> DuckConfig:
+        return DuckConfig()
+
+
 class _MockDuckSession(DuckSession):
     def _set_conf(self) -> None:
         self._conf = _MockDuckConfig()
 
 
+def _execute_plan_locally(plan: Plan, path: str) -> list[tuple]:
+    """Executes the stages of a plan with DuckDB in place of Lambda, storing the output of
+    each task at path, and returns the output of the root stage"""
+    context: dict[str, list[str]] = {}
+
+    def execute(stage: Stage) -> None:
+        if stage.id in context:
+            return
+
+        for dependency in stage.dependencies:
+            execute(dependency)
+
+        if stage.branches:
+            context[stage.id] = [key for branch in stage.branches for key in context[branch]]
+            return
+
+        stage.tasks.clear()
+        stage.create_tasks(dependencies={d.id: context[d.id] for d in stage.dependencies})
+        context[stage.id] = []
+        for task in stage.parts:
+            output = task.key(path)
+            if task.partitions:
+                os.makedirs(output, exist_ok=True)
+                duckdb.sql(f"CREATE OR REPLACE TEMP TABLE __output AS {task.subquery}")
+                for i in range(task.partitions):
+                    duckdb.sql(
+                        "COPY (SELECT * EXCLUDE (__partition) FROM __output "
+                        f"WHERE __partition = {i}) TO '{output}/{i}.parquet' (FORMAT 'PARQUET')"
+                    )
+            else:
+                duckdb.sql(f"COPY ({task.subquery}) TO '{output}' (FORMAT 'PARQUET')")
+            context[stage.id].append(output)
+
+    execute(plan.root)
+    return duckdb.sql(f"SELECT * FROM READ_PARQUET({context[plan.root.id]})").fetchall()
+
+
 @pytest.fixture()
 def MockQuery():
     query = Query.parse("SELECT * FROM READ_PARQUET(['s3://BUCKET_NAME/2023/*'])")
@@ -84,12 +256,35 @@ def MockQuery():
     yield query
 
 
+@pytest.fixture(autouse=True)
+def fresh_conn_for_metadata():
+    # The shared connection is created anew, such that each test patches how it's created
+    clear_conn_for_metadata()
+    yield
+    clear_conn_for_metadata()
+
+
+@pytest.fixture(autouse=True)
+def fresh_listings():
+    # Listings are shared by the sessions, thus a test mustn't see those of another
+    LISTINGS.clear()
+    yield
+    LISTINGS.clear()
+
+
 @pytest.fixture
 def MockPlan(MockQuery):
     plan = Plan.from_query(MockQuery)
     yield plan
 
 
+@pytest.fixture
+def ExecutePlanLocally(tmp_path, monkeypatch):
+    monkeypatch.setattr("duckingit._utils.create_conn_with_httpfs_loaded", duckdb.connect)
+    monkeypatch.setattr("duckingit._statistics.create_conn_with_httpfs_loaded", duckdb.connect)
+    yield lambda plan: _execute_plan_locally(plan, path=str(tmp_path))
+
+
 @pytest.fixture
 def MockAWS():
     yield _MockAWS
@@ -100,6 +295,11 @@ def MockDuckSession():
     yield _MockDuckSession
 
 
+@pytest.fixture
+def MockSession():
+    yield _MockSession
+
+
 @pytest.fixture
 def MockController():
     yield _MockController
@@ -0,0 +1,243 @@
+import datetime
+import os
+
+import duckdb
+import pytest
+
+from duckingit._cache import Cache, CacheCatalog
+from duckingit._config import DuckConfig
+from duckingit._planner import Task
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr("duckingit._utils.create_conn_with_httpfs_loaded", duckdb.connect)
+    monkeypatch.setattr("duckingit._cache.create_conn_with_httpfs_loaded", duckdb.connect)
+
+    path = tmp_path / "cache"
+    path.mkdir()
+    yield str(path)
+
+
+def execute(task: Task, prefix: str) -> str:
+    key = task.key(prefix)
+    duckdb.sql(f"COPY ({task.subquery}) TO '{key}' (FORMAT PARQUET)")
+    return key
+
+
+def test_save_and_load(cache):
+    task = Task(subquery="SELECT range FROM range(1000)", subquery_hashed="a", fingerprint="x")
+    key = execute(task, prefix=cache)
+
+    catalog = CacheCatalog(path=cache)
+    catalog.add(task, key=key, created_at=datetime.datetime.now())
+    # Output stored outside of the prefix isn't managed by the catalog
+    catalog.add(
+        task.copy(), key="s3://BUCKET_NAME/out/a.parquet", created_at=datetime.datetime.now()
+    )
+    catalog.save()
+
+    entries = CacheCatalog(path=cache).entries
+    assert list(entries) == [key]
+    assert entries[key].subquery_hashed == "a"
+    # The output is measured on eviction rather than on save
+    assert entries[key].bytes is None
+
+
+@pytest.mark.parametrize(
+    "fingerprint, key, age_minutes, expected",
+    [
+        ("x", "{cache}/a.parquet", 1, True),
+        ("y", "{cache}/a.parquet", 1, False),
+        ("x", "s3://BUCKET_NAME/out/a.parquet", 1, False),
+        ("x", "{cache}/a.parquet", 20, False),
+    ],
+)
+def test_lookup(cache, fingerprint, key, age_minutes, expected):
+    task = Task(subquery="SELECT 1", subquery_hashed="a", fingerprint="x")
+    execute(task, prefix=cache)
+
+    catalog = CacheCatalog(path=cache)
+    created_at = datetime.datetime.now() - datetime.timedelta(minutes=age_minutes)
+    catalog.add(task, key=task.key(cache), created_at=created_at)
+    catalog.save()
+
+    task.fingerprint = fingerprint
+    got = CacheCatalog(path=cache).lookup(
+        task, key=key.format(cache=cache), max_age_seconds=15 * 60
+    )
+
+    assert (got is not None) == expected
+
+
+def test_save_merges_entries_of_others(cache):
+    first, second = CacheCatalog(path=cache), CacheCatalog(path=cache)
+    assert first.entries == second.entries == {}
+
+    for catalog, name in [(first, "a"), (second, "b")]:
+        task = Task(subquery=f"SELECT '{name}'", subquery_hashed=name)
+        catalog.add(task, key=execute(task, prefix=cache), created_at=datetime.datetime.now())
+        catalog.save()
+
+    assert sorted(e.subquery_hashed for e in CacheCatalog(path=cache).entries.values()) == [
+        "a",
+        "b",
+    ]
+
+
+def test_fingerprint_changes_with_files(cache, tmp_path):
+    (tmp_path / "source").mkdir()
+    for name in ["a", "b"]:
+        duckdb.sql(f"COPY (SELECT '{name}') TO '{tmp_path}/source/{name}.parquet'")
+
+    def fingerprint(files: list[str]) -> str:
+        task = Task(subquery="SELECT 1", subquery_hashed="a", files=files)
+        CacheCatalog(path=cache).fingerprint([task])
+        return task.fingerprint
+
+    files, prefix = [f"{tmp_path}/source/a.parquet"], [f"{tmp_path}/source/*"]
+    before = fingerprint(files), fingerprint(prefix)
+    assert before == (fingerprint(files), fingerprint(prefix))
+
+    # Files are overwritten or added
+    duckdb.sql(f"COPY (SELECT 'aa') TO '{tmp_path}/source/a.parquet'")
+    assert fingerprint(files) != before[0]
+
+    after = fingerprint(prefix)
+    duckdb.sql(f"COPY (SELECT 'c') TO '{tmp_path}/source/c.parquet'")
+    assert fingerprint(prefix) not in (before[1], after)
+
+
+@pytest.fixture
+def cached(cache):
+    """Output of tasks of 3 days, in the order they were last accessed"""
+    catalog = CacheCatalog(path=cache)
+    for i, name in enumerate(["a", "b", "c"]):
+        task = Task(subquery=f"SELECT range FROM range({(i + 1) * 1000})", subquery_hashed=name)
+        accessed_at = datetime.datetime.now() - datetime.timedelta(days=3 - i)
+        catalog.add(task, key=execute(task, prefix=cache), created_at=accessed_at)
+    catalog.save()
+
+    sizes = catalog.measure(list(catalog.entries))
+    for location, entry in catalog.entries.items():
+        entry.bytes = sizes[location]
+    yield {entry.subquery_hashed: entry for entry in catalog.entries.values()}
+
+
+@pytest.mark.parametrize(
+    "max_bytes, max_age_days, expected",
+    [
+        (0, 0, []),
+        (1, 0, ["a", "b", "c"]),
+        (0, 2.5, ["a"]),
+        ("b+c", 0, ["a"]),
+        ("c", 2.5, ["a", "b"]),
+    ],
+)
+def test_vacuum(cached, cache, max_bytes, max_age_days, expected, monkeypatch):
+    if isinstance(max_bytes, str):
+        max_bytes = sum(cached[name].bytes for name in max_bytes.split("+"))
+    monkeypatch.setattr(DuckConfig().session, "cache_max_bytes", max_bytes)
+    monkeypatch.setattr(DuckConfig().session, "cache_max_age_seconds", int(max_age_days * 86400))
+
+    got = Cache().vacuum(prefix=cache)
+
+    assert got == [cached[name].location for name in expected]
+    entries = CacheCatalog(path=cache).entries.values()
+    assert sorted(entry.subquery_hashed for entry in entries) == sorted(set("abc") - set(expected))
+    assert [os.path.exists(entry.location) for entry in cached.values()] == [
+        name not in expected for name in "abc"
+    ]
+
+
+def test_vacuum_keeps_referenced_and_recent_output(cached, cache, monkeypatch):
+    monkeypatch.setattr(DuckConfig().session, "cache_max_bytes", 1)
+
+    # Output accessed lately is kept as well
+    catalog = CacheCatalog(path=cache)
+    catalog.access(
+        [catalog.lookup(Task(subquery="", subquery_hashed="c"), cached["c"].location, 0)]
+    )
+
+    manager = Cache()
+    manager.reference([cached["a"].location])
+    assert manager.vacuum(prefix=cache) == [cached["b"].location]
+
+    manager.release([cached["a"].location])
+    assert manager.vacuum(prefix=cache) == [cached["a"].location]
+
+
+def test_output_is_cached_per_location(cache):
+    task = Task(subquery="SELECT 1", subquery_hashed="a")
+    os.makedirs(f"{cache}/other")
+    catalog = CacheCatalog(path=cache)
+    for prefix in [cache, f"{cache}/other"]:
+        catalog.add(task, key=execute(task, prefix=prefix), created_at=datetime.datetime.now())
+    catalog.save()
+
+    # The output of a task under either prefix is kept track of, e.g. to evict it
+    entries = CacheCatalog(path=cache).entries
+    assert sorted(entries) == [f"{cache}/a.parquet", f"{cache}/other/a.parquet"]
+
+
+def test_exists(cache):
+    task = Task(subquery="SELECT 1", subquery_hashed="a")
+    key = execute(task, prefix=cache)
+    partitioned = f"{cache}/b"
+    os.makedirs(partitioned)
+    duckdb.sql(f"COPY (SELECT 1) TO '{partitioned}/0.parquet' (FORMAT PARQUET)")
+
+    got = CacheCatalog(path=cache).exists([key, partitioned, f"{cache}/c.parquet", f"{cache}/d"])
+
+    assert got == {key, partitioned}
+
+
+def test_access_is_stored_right_away(cached, cache, monkeypatch):
+    monkeypatch.setattr(DuckConfig().session, "cache_max_bytes", 1)
+    catalog = CacheCatalog(path=cache)
+    found = [
+        catalog.lookup(Task(subquery="", subquery_hashed=n), cached[n].location, 0) for n in "ab"
+    ]
+
+    # Another process evicts the output of "b" before it's accessed, but not the output of "a"
+    max_bytes = cached["a"].bytes + cached["c"].bytes
+    CacheCatalog(path=cache).evict(max_bytes=max_bytes, keep=[cached["a"].location])
+    accessed = catalog.access(found)
+
+    assert [entry.subquery_hashed for entry in accessed] == ["a"]
+    assert Cache().vacuum(prefix=cache) == [cached["c"].location]
+
+
+def test_output_is_measured_once_on_eviction(cached, cache, monkeypatch):
+    measured = []
+    measure = CacheCatalog.measure
+
+    def spy(self, locations):
+        measured.append(locations)
+        return measure(self, locations)
+
+    monkeypatch.setattr(CacheCatalog, "measure", spy)
+    os.remove(cached["b"].location)
+
+    # Output is only measured when evicting by bytes, and output deleted in the meantime is empty
+    CacheCatalog(path=cache).evict(max_age_seconds=86400 * 7)
+    assert measured == []
+    CacheCatalog(path=cache).evict(max_bytes=10 * 1024**3)
+    CacheCatalog(path=cache).evict(max_bytes=10 * 1024**3)
+
+    assert measured == [sorted([cached["a"].location, cached["c"].location])]
+    entries = {e.subquery_hashed: e.bytes for e in CacheCatalog(path=cache).entries.values()}
+    assert entries == {"a": cached["a"].bytes, "b": 0, "c": cached["c"].bytes}
+
+
+def test_save_doesnt_add_back_evicted_entries(cached, cache):
+    catalog = CacheCatalog(path=cache)
+    catalog.lookup(Task(subquery="", subquery_hashed="a"), cached["a"].location, 0)
+
+    CacheCatalog(path=cache).evict(max_age_seconds=1)
+    task = Task(subquery="SELECT 'd'", subquery_hashed="d")
+    catalog.add(task, key=execute(task, prefix=cache), created_at=datetime.datetime.now())
+    catalog.save()
+
+    entries = CacheCatalog(path=cache).entries.values()
+    assert [entry.subquery_hashed for entry in entries] == ["d"]
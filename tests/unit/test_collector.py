@@ -0,0 +1,122 @@
+import pytest
+
+from duckingit._collector import Collector
+from duckingit._config import DuckConfig
+
+
+def create_collector(MockAWS) -> Collector:
+    return Collector(
+        provider=MockAWS(),
+        success_queue=DuckConfig().aws_sqs.QueueSuccess,
+        failure_queue=DuckConfig().aws_sqs.QueueFailure,
+        receivers=2,
+    )
+
+
+def collect(collector: Collector, n: int) -> list:
+    completions: list = []
+    while len(completions) < n:
+        completions.extend(collector.collect(timeout=1))
+    return completions
+
+
+def test_collect_success_and_failure(MockAWS):
+    collector = create_collector(MockAWS)
+    collector.watch(["1", "2"])
+
+    collector.provider.finish("1", queue=collector.success_queue)
+    collector.provider.finish("2", queue=collector.failure_queue)
+
+    completions = {c.request_id: c.succeeded for c in collect(collector, 2)}
+    collector.close()
+
+    assert completions == {"1": True, "2": False}
+
+
+def test_collect_completion_before_watch(MockAWS):
+    collector = create_collector(MockAWS)
+    collector.watch(["1"])
+
+    collector.provider.finish("2", queue=collector.success_queue)
+    collector.provider.finish("1", queue=collector.success_queue)
+    assert [c.request_id for c in collect(collector, 1)] == ["1"]
+
+    # The message of 2 arrived before its request id was watched
+    collector.watch(["2"])
+    assert [c.request_id for c in collector.collect(timeout=0)] == ["2"]
+    collector.close()
+
+
+def test_collect_deletes_messages_in_batches(MockAWS):
+    collector = create_collector(MockAWS)
+    request_ids = [str(i) for i in range(25)]
+    collector.watch(request_ids)
+
+    for request_id in request_ids:
+        collector.provider.finish(request_id, queue=collector.success_queue)
+
+    collect(collector, 25)
+    collector.close()
+    for thread in collector._threads:
+        thread.join(timeout=2)
+
+    assert len(collector.provider.deleted) == 25
+
+
+def test_collect_timeout(MockAWS):
+    collector = create_collector(MockAWS)
+    collector.watch(["1"])
+
+    assert collector.collect(timeout=0.1) == []
+    collector.close()
+
+
+def fail_calls(collector: Collector, name: str, times: int) -> None:
+    """Makes the next calls of a method of the mocked SQS fail"""
+    call = getattr(collector.provider, name)
+    failures = [times]
+
+    def failing(*args, **kwargs):
+        if failures[0] > 0:
+            failures[0] -= 1
+            raise ConnectionError("SQS is unavailable")
+        return call(*args, **kwargs)
+
+    setattr(collector.provider, name, failing)
+
+
+@pytest.mark.parametrize("name", ["poll_messages_from_queue", "delete_messages_from_queue"])
+def test_collect_retries_failed_calls(MockAWS, name, monkeypatch):
+    monkeypatch.setattr("duckingit._collector.RETRY_BACKOFF_SECONDS", 0.01)
+    collector = create_collector(MockAWS)
+    fail_calls(collector, name, times=3)
+    collector.watch(["1", "2"])
+
+    collector.provider.finish("1", queue=collector.success_queue)
+    collector.provider.finish("2", queue=collector.success_queue)
+    assert sorted(c.request_id for c in collect(collector, 2)) == ["1", "2"]
+
+    collector.close()
+    for thread in collector._threads:
+        thread.join(timeout=2)
+    assert len(collector.provider.deleted) == 2
+
+
+def test_collect_restarts_after_error(MockAWS, monkeypatch):
+    monkeypatch.setattr("duckingit._collector.RETRY_BACKOFF_SECONDS", 0.01)
+    monkeypatch.setattr("duckingit._collector.MAX_RETRIES", 1)
+    collector = create_collector(MockAWS)
+    fail_calls(collector, "poll_messages_from_queue", times=100)
+    collector.watch(["1"])
+
+    with pytest.raises(ConnectionError):
+        collect(collector, 1)
+
+    # The threads have stopped, and are started anew by the next request ids watched
+    del collector.provider.poll_messages_from_queue
+    collector.forget(["1"])
+    collector.watch(["2"])
+    collector.provider.finish("2", queue=collector.success_queue)
+
+    assert [c.request_id for c in collect(collector, 1)] == ["2"]
+    collector.close()
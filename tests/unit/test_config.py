@@ -23,16 +23,33 @@ def test_DuckConfig_set_multiple():
         ("aws_lambda.Timeout", 30, 90),
         ("aws_lambda.FunctionName", "DuckExecutor", "TestFunc"),
         ("aws_lambda.WarmUp", False, True),
+        ("aws_lambda.MaxConcurrentInvokes", 64, 32),
+        ("aws_config.max_pool_connections", 50, 60),
         ("aws_sqs.QueueSuccess", "DuckSuccess", "TestSuccess"),
         ("aws_sqs.QueueFailure", "DuckFailure", "TestFailure"),
         ("aws_sqs.MaxNumberOfMessages", 10, 9),
         ("aws_sqs.VisibilityTimeout", 5, 4),
         ("aws_sqs.WaitTimeSeconds", 5, 4),
+        ("aws_sqs.NumberOfReceivers", 2, 3),
         ("aws_sqs.DelaySeconds", 0, 1),
         ("aws_sqs.MaximumMessageSize", 2056, 2057),
         ("aws_sqs.MessageRetentionPeriod", 900, 1000),
-        ("session.cache_expiration_time", 15, 14),
+        ("session.cache_expiration_time", 0, 15),
+        ("session.cache_max_bytes", 0, 0),
+        ("session.cache_max_age_seconds", 0, 0),
         ("session.max_invokations", "auto", 15),
+        ("session.bytes_per_invokation", 128 * 1024**2, 64 * 1024**2),
+        ("session.max_retries", 2, 3),
+        ("session.retry_backoff", 1.0, 0.5),
+        ("session.speculation", False, True),
+        ("session.speculation_multiplier", 1.5, 2.0),
+        ("session.shuffle_partitions", 0, 8),
+        ("session.broadcast_threshold_bytes", 64 * 1024**2, 1024),
+        ("session.statistics_path", "", ""),
+        ("session.plan_cache_size", 64, 64),
+        ("session.listing_ttl_seconds", 0, 0),
+        ("session.listing_concurrency", 16, 16),
+        ("session.listing_incremental", False, False),
         ("session.provider", "aws", "aws"),
         ("session.verbose", False, True),
         ("duckdb.database", ":memory:", ":memory:"),
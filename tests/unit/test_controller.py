@@ -1,3 +1,15 @@
+import json
+
+import pytest
+
+from duckingit._config import DuckConfig
+from duckingit._exceptions import FailedInvokations, FailedLambdaFunctions
+from duckingit._parser import Query
+from duckingit._planner import Plan
+from duckingit.providers.aws import AWSLambda
+
+MB = 1024**2
+
 # import datetime
 # from unittest.mock import MagicMock
 
@@ -64,3 +76,270 @@
 #     controller.execute_plan(MockPlan, prefix="SourceIsMocked", default_prefix="Mocked")
 
 #     assert len(session.metadata_cached) == 3
+
+
+@pytest.fixture
+def join_plan(monkeypatch):
+    # The sides of the join are shuffled in 4 partitions by their size
+    monkeypatch.setattr(DuckConfig().session, "max_invokations", "auto")
+    monkeypatch.setattr(DuckConfig().session, "bytes_per_invokation", 128 * MB)
+    monkeypatch.setattr(DuckConfig().session, "shuffle_partitions", 0)
+    monkeypatch.setattr(
+        "duckingit._parser.scan_source_parquet_metadata",
+        lambda source: [
+            (f"{source[1:-2]}01.parquet", 0, 100, 100 * MB),
+            (f"{source[1:-2]}02.parquet", 0, 100, 100 * MB),
+        ],
+    )
+    query = Query.parse("""
+        WITH a AS (SELECT * FROM READ_PARQUET(['s3://BUCKET_NAME/a/*'])),
+        b AS (SELECT * FROM READ_PARQUET(['s3://BUCKET_NAME/b/*']))
+        SELECT * FROM a JOIN b USING (id)
+        """)
+    yield Plan.from_query(query)
+
+
+def test_execute_plan_runs_independent_stages_together(join_plan, MockController, MockSession):
+    controller = MockController(session=MockSession())
+    controller.execute_plan(join_plan, prefix="", default_prefix="s3://BUCKET_NAME/.cache")
+
+    invoked = controller.provider.invoked
+    assert len(invoked) == 8
+    # Both sides of the join are invoked before the join itself, shuffled in 4 partitions
+    assert all("READ_PARQUET(['s3://BUCKET_NAME/" in task.subquery for task in invoked[:4])
+    assert all("JOIN" in task.subquery for task in invoked[4:])
+
+
+def test_execute_plan_updates_cache_catalog(join_plan, MockController, MockSession):
+    session = MockSession()
+    controller = MockController(session=session)
+    controller.execute_plan(join_plan, prefix="", default_prefix="s3://BUCKET_NAME/.cache")
+
+    assert len(session.cache.catalogs["s3://BUCKET_NAME/.cache"].stored) == 8
+
+
+def test_execute_plan_skips_cached_tasks(join_plan, MockController, MockSession):
+    session = MockSession()
+    MockController(session=session).execute_plan(
+        join_plan.copy(), prefix="", default_prefix="s3://BUCKET_NAME/.cache"
+    )
+
+    # Another session of the same cache prefix, whose catalog has been stored
+    controller = MockController(session=MockSession())
+    controller.session.cache = session.cache
+    plan = join_plan.copy()
+    controller.execute_plan(plan, prefix="", default_prefix="s3://BUCKET_NAME/.cache")
+
+    assert len(controller.provider.invoked) == 0
+    assert all(len(stage.tasks) > 0 for stage in plan.dag)
+
+
+def test_execute_plan_invokes_tasks_of_deleted_output(join_plan, MockController, MockSession):
+    session = MockSession()
+    controller = MockController(session=session)
+    controller.execute_plan(join_plan.copy(), prefix="", default_prefix="s3://BUCKET_NAME/.cache")
+
+    # The output of a task has been deleted by anything but the catalog
+    catalog = session.cache.catalogs["s3://BUCKET_NAME/.cache"]
+    deleted = sorted(entry.location for entry in catalog.stored)[0]
+    catalog.missing.add(deleted)
+    controller.execute_plan(join_plan.copy(), prefix="", default_prefix="s3://BUCKET_NAME/.cache")
+
+    invoked = controller.provider.invoked[8:]
+    assert [task.key("s3://BUCKET_NAME/.cache") for task in invoked] == [deleted]
+
+
+def test_execute_plan_invokes_tasks_of_changed_input(
+    join_plan, MockController, MockSession, monkeypatch
+):
+    session = MockSession()
+    controller = MockController(session=session)
+    controller.execute_plan(join_plan.copy(), prefix="", default_prefix="s3://BUCKET_NAME/.cache")
+
+    # A file of a side of the join has grown, i.e. its scan and the join are invoked again
+    monkeypatch.setattr(
+        "duckingit._parser.scan_source_parquet_metadata",
+        lambda source: [
+            (f"{source[1:-2]}01.parquet", 0, 100, 100 * MB),
+            (f"{source[1:-2]}02.parquet", 0, 100, (100 if "/a/" in source else 101) * MB),
+        ],
+    )
+    plan = Plan.from_query(Query.parse(join_plan.query.sql))
+    controller.execute_plan(plan, prefix="", default_prefix="s3://BUCKET_NAME/.cache")
+
+    invoked = controller.provider.invoked[8:]
+    assert len(invoked) == 5
+    assert "BUCKET_NAME/b/02" in invoked[0].subquery
+    assert all("JOIN" in task.subquery for task in invoked[1:])
+
+
+def test_execute_plan_invokes_tasks_of_overwritten_files(join_plan, MockController, MockSession):
+    session = MockSession()
+    controller = MockController(session=session)
+    catalog = controller.open_catalog("s3://BUCKET_NAME/.cache")
+    catalog.listed = {f"s3://BUCKET_NAME/{side}/0{i}.parquet": "1" for side in "ab" for i in (1, 2)}
+    controller.execute_plan(join_plan.copy(), prefix="", default_prefix="s3://BUCKET_NAME/.cache")
+
+    # A file is overwritten with another of the same size
+    catalog.listed["s3://BUCKET_NAME/a/01.parquet"] = "2"
+    controller.execute_plan(join_plan.copy(), prefix="", default_prefix="s3://BUCKET_NAME/.cache")
+
+    invoked = controller.provider.invoked[8:]
+    assert len(invoked) == 5
+    assert "BUCKET_NAME/a/01" in invoked[0].subquery
+    assert all("JOIN" in task.subquery for task in invoked[1:])
+
+
+def test_execute_plan_retries_failed_task(join_plan, MockController, MockSession, monkeypatch):
+    monkeypatch.setattr(DuckConfig().session, "retry_backoff", 0)
+    session = MockSession(failing={"BUCKET_NAME/b/01": 1})
+    controller = MockController(session=session)
+    controller.execute_plan(join_plan, prefix="", default_prefix="s3://BUCKET_NAME/.cache")
+
+    invoked = controller.provider.invoked
+    # Only the failed task is invoked again
+    assert len(invoked) == 9
+    assert "BUCKET_NAME/b/01" in invoked[4].subquery
+    assert len(session.cache.catalogs["s3://BUCKET_NAME/.cache"].stored) == 8
+
+
+def test_execute_plan_failed_invokation(join_plan, MockController, MockSession, monkeypatch):
+    monkeypatch.setattr(DuckConfig().session, "retry_backoff", 0)
+    monkeypatch.setattr(DuckConfig().session, "max_retries", 2)
+    controller = MockController(session=MockSession(failing={"BUCKET_NAME/b/01": 10}))
+
+    with pytest.raises(FailedLambdaFunctions):
+        controller.execute_plan(join_plan, prefix="", default_prefix="s3://BUCKET_NAME/.cache")
+
+    # The failed task is invoked three times in total, while the join is never invoked
+    assert len(controller.provider.invoked) == 6
+    assert not any("JOIN" in task.subquery for task in controller.provider.invoked)
+
+
+def test_execute_plan_retries_task_that_couldnt_be_invoked(
+    join_plan, MockController, MockSession, monkeypatch
+):
+    monkeypatch.setattr(DuckConfig().session, "retry_backoff", 0)
+    session = MockSession(unreachable={"BUCKET_NAME/b/01": 1})
+    controller = MockController(session=session)
+    controller.execute_plan(join_plan, prefix="", default_prefix="s3://BUCKET_NAME/.cache")
+
+    # The tasks invoked alongside it are tracked, thus none of them is invoked again
+    invoked = controller.provider.invoked
+    assert len(invoked) == 8
+    assert len(set(invoked)) == 8
+    assert len(session.cache.catalogs["s3://BUCKET_NAME/.cache"].stored) == 8
+
+
+def test_lambda_invoke_keeps_request_ids_of_invoked_tasks(join_plan, monkeypatch):
+    stage = next(iter(join_plan.root.dependencies))
+    stage.create_tasks()
+    tasks = set(stage.parts)
+    failing = next(iter(tasks))
+
+    def invoke_lambda(self, request_payload: str) -> str:
+        if json.loads(request_payload)["query"] == failing.subquery:
+            raise ConnectionError("Couldn't invoke")
+        return json.loads(request_payload)["key"]
+
+    monkeypatch.setattr(AWSLambda, "_invoke_lambda", invoke_lambda)
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "eu-west-1")
+
+    with pytest.raises(FailedInvokations) as e:
+        AWSLambda().invoke(execution_tasks=tasks, prefix="s3://BUCKET_NAME/.cache")
+
+    assert set(e.value.failed) == {failing}
+    assert set(e.value.request_ids.values()) == tasks - {failing}
+
+
+def test_execute_plan_speculates_on_stragglers(MockController, MockSession, monkeypatch):
+    monkeypatch.setattr("duckingit._controller.COLLECT_TIMEOUT_SECONDS", 0.01)
+    monkeypatch.setattr("duckingit._controller.SPECULATION_MIN_SECONDS", 0.05)
+    monkeypatch.setattr(DuckConfig().session, "speculation", True)
+    monkeypatch.setattr(
+        "duckingit._parser.scan_source_parquet_metadata",
+        lambda source: [
+            (f"s3://BUCKET_NAME/2023/0{i}.parquet", 0, 100, 100 * MB) for i in range(1, 5)
+        ],
+    )
+    plan = Plan.from_query(Query.parse("SELECT * FROM READ_PARQUET(['s3://BUCKET_NAME/2023/*'])"))
+
+    controller = MockController(session=MockSession(straggling={"2023/04": 1}))
+    controller.execute_plan(plan, prefix="", default_prefix="s3://BUCKET_NAME/.cache")
+
+    invoked = controller.provider.invoked
+    assert len(invoked) == 5
+    assert "2023/04" in invoked[4].subquery
+    assert plan.speculative_copies == 1
+
+
+def test_execute_plan_concatenates_union_all(join_plan, MockController, MockSession, monkeypatch):
+    # Both branches output the same columns
+    monkeypatch.setattr(
+        "duckingit._planner.scan_query_schema", lambda query: [("id", "BIGINT"), ("v", "DOUBLE")]
+    )
+    query = Query.parse("""
+        SELECT * FROM READ_PARQUET(['s3://BUCKET_NAME/a/*'])
+        UNION ALL SELECT * FROM READ_PARQUET(['s3://BUCKET_NAME/b/*'])
+        """)
+    plan = Plan.from_query(query)
+
+    controller = MockController(session=MockSession())
+    controller.execute_plan(plan, prefix="s3://BUCKET_NAME/out", default_prefix="")
+
+    # Only the branches are invoked, and their output is the output of the union
+    invoked = controller.provider.invoked
+    assert len(invoked) == 4
+    assert "UNION" not in "".join(task.subquery for task in invoked)
+    assert sorted(plan.root.keys("s3://BUCKET_NAME/out")) == sorted(
+        f"s3://BUCKET_NAME/out/{task.subquery_hashed}.parquet" for task in invoked
+    )
+
+
+@pytest.mark.parametrize(
+    "rows, expected",
+    [
+        (8, 4),  # Waves of 1, 1 and 2 tasks output 32 rows
+        (100, 1),
+        (0, 8),
+        (None, 8),  # Every task is invoked if a task didn't report its rows
+    ],
+)
+def test_execute_plan_stops_limit_once_enough_rows(
+    rows, expected, MockController, MockSession, monkeypatch
+):
+    monkeypatch.setattr(DuckConfig().session, "max_invokations", "auto")
+    monkeypatch.setattr(DuckConfig().session, "bytes_per_invokation", 100 * MB)
+    monkeypatch.setattr(
+        "duckingit._parser.scan_source_parquet_metadata",
+        lambda source: [
+            (f"s3://BUCKET_NAME/2023/0{i}.parquet", 0, 100, 100 * MB) for i in range(8)
+        ],
+    )
+    plan = Plan.from_query(
+        Query.parse("SELECT * FROM READ_PARQUET(['s3://BUCKET_NAME/2023/*']) LIMIT 20")
+    )
+
+    controller = MockController(session=MockSession(rows=rows))
+    controller.execute_plan(plan, prefix="", default_prefix="s3://BUCKET_NAME/.cache")
+
+    # The tasks left are skipped, and the final task limits the output of the ones invoked
+    scan = next(iter(plan.root.dependencies))
+    invoked = controller.provider.invoked
+    assert len(invoked) == expected + 1
+    assert len(scan.tasks) == expected
+    assert invoked[-1].subquery.count(".cache/") == expected
+
+
+def test_execute_plan_vacuums_cache(join_plan, MockController, MockSession, monkeypatch):
+    monkeypatch.setattr("duckingit._cache.MIN_IDLE_SECONDS", 0)
+    monkeypatch.setattr(DuckConfig().session, "cache_max_bytes", 1)
+    session = MockSession()
+    controller = MockController(session=session)
+    controller.execute_plan(join_plan, prefix="", default_prefix="s3://BUCKET_NAME/.cache")
+
+    # The output is no longer referenced once the execution is done
+    session.cache._vacuums["s3://BUCKET_NAME/.cache"].join()
+    assert session.cache._references == {}
+    # Each output is measured as 1 byte, thus the most recently used output fits the budget
+    assert len(session.cache.deleted) == 7
@@ -0,0 +1,40 @@
+import os
+
+import duckdb
+import pytest
+
+from duckingit._config import CACHE_PREFIX
+from duckingit._dataset import Dataset
+from duckingit._parser import Query
+from duckingit._planner import Plan
+
+
+@pytest.fixture
+def dataset(tmp_path, MockSession, ExecutePlanLocally, monkeypatch):
+    monkeypatch.setattr(Query, "bucket", property(lambda _: str(tmp_path)))
+    os.makedirs(f"{tmp_path}/{CACHE_PREFIX}")
+
+    duckdb.sql(f"COPY (SELECT range AS v FROM range(10)) TO '{tmp_path}/v.parquet'")
+    query = Query.parse(f"SELECT COUNT(*) AS n, MAX(v) FROM READ_PARQUET(['{tmp_path}/v.parquet'])")
+
+    session = MockSession()
+    session.conn = duckdb.connect()
+    session.metadata = {}
+    yield Dataset(execution_plan=Plan.from_query(query), session=session)
+
+
+def test_show_answers_from_metadata(dataset):
+    got = dataset.show().fetchall()
+
+    assert got == [(10, 9)]
+    assert len(dataset._session.provider.invoked) == 0
+
+
+def test_create_temp_table_answers_from_metadata(dataset):
+    dataset.createTempTable("answer")
+
+    got = dataset._session.conn.sql("SELECT * FROM answer").fetchall()
+
+    assert got == [(10, 9)]
+    assert len(dataset._session.provider.invoked) == 0
+    assert all(os.path.exists(key) for key in dataset.stored_objects)
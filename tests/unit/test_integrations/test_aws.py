@@ -0,0 +1,84 @@
+import json
+import threading
+import time
+
+import pytest
+
+from duckingit._config import DuckConfig
+from duckingit._planner import Task
+from duckingit.providers import Providers
+from duckingit.providers.aws import AWSSQS, AWSLambda
+
+
+class _MockLambdaClient:
+    def __init__(self) -> None:
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def invoke(self, FunctionName: str, Payload: str, InvocationType: str) -> dict:
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+        time.sleep(0.01)
+
+        with self._lock:
+            self.in_flight -= 1
+        return {"ResponseMetadata": {"HTTPStatusCode": 202, "RequestId": f"request-{Payload}"}}
+
+
+@pytest.fixture
+def aws_lambda(monkeypatch):
+    monkeypatch.setenv("AWS_REGION", "eu-west-1")
+    aws_lambda = AWSLambda()
+    aws_lambda.lambda_client = _MockLambdaClient()
+    yield aws_lambda
+
+
+def test_invoke_concurrently(aws_lambda, monkeypatch):
+    monkeypatch.setattr(DuckConfig().aws_lambda, "MaxConcurrentInvokes", 4)
+    tasks = {Task(subquery=f"SELECT {i}", subquery_hashed=str(i)) for i in range(20)}
+
+    streamed = []
+    request_ids = aws_lambda.invoke(
+        execution_tasks=tasks,
+        prefix="s3://BUCKET_NAME",
+        callback=lambda request_id, task: streamed.append(request_id),
+    )
+
+    assert set(request_ids.values()) == tasks
+    assert sorted(streamed) == sorted(request_ids)
+    assert 1 < aws_lambda.lambda_client.max_in_flight <= 4
+
+
+def test_invoke_partitioned_task(aws_lambda):
+    task = Task(subquery="SELECT 1 AS __partition", subquery_hashed="abc", partitions=4)
+
+    request_ids = aws_lambda.invoke(execution_tasks={task}, prefix="s3://BUCKET_NAME")
+
+    payload = json.loads(next(iter(request_ids)).removeprefix("request-"))
+    assert payload["key"] == "s3://BUCKET_NAME/abc"
+    assert payload["partitions"] == 4
+
+
+def test_provider_is_reused(monkeypatch):
+    monkeypatch.setenv("AWS_REGION", "eu-west-1")
+    Providers.clear()
+
+    provider = Providers.get_or_raise("aws")
+    assert Providers.get_or_raise("AWS") is provider
+    assert provider.lambda_ is provider.lambda_
+    assert provider.sqs.sqs_client is provider.sqs.sqs_client
+
+    Providers.clear()
+    assert Providers.get_or_raise("aws") is not provider
+
+
+def test_client_pool_size(monkeypatch):
+    monkeypatch.setenv("AWS_REGION", "eu-west-1")
+    monkeypatch.setattr(DuckConfig().aws_config, "max_pool_connections", 20)
+    monkeypatch.setattr(DuckConfig().aws_lambda, "MaxConcurrentInvokes", 100)
+
+    assert AWSSQS().sqs_client.meta.config.max_pool_connections == 20
+    assert AWSLambda().lambda_client.meta.config.max_pool_connections == 100
@@ -0,0 +1,98 @@
+import duckdb
+import pytest
+
+from duckingit._config import DuckConfig
+from duckingit._listing import ListingCache, split_glob
+from duckingit._utils import scan_source_for_paths
+
+
+@pytest.fixture
+def scanned(monkeypatch):
+    monkeypatch.setattr("duckingit._utils.create_conn_with_httpfs_loaded", duckdb.connect)
+
+    sources: list[str] = []
+
+    def scan(source: str) -> list[str]:
+        sources.append(source)
+        return scan_source_for_paths(source)
+
+    monkeypatch.setattr("duckingit._listing.scan_source_for_paths", scan)
+    yield sources
+
+
+@pytest.fixture
+def days(tmp_path):
+    for day in ["01", "02", "03"]:
+        write_event(tmp_path, day=day, name="a")
+    yield f"{tmp_path}/day=*/*.parquet"
+
+
+def write_event(path, day: str, name: str) -> None:
+    (path / f"day={day}").mkdir(exist_ok=True)
+    duckdb.sql(f"COPY (SELECT '{day}' AS v) TO '{path}/day={day}/{name}.parquet' (FORMAT PARQUET)")
+
+
+@pytest.mark.parametrize(
+    "pattern, expected",
+    [
+        ("s3://BUCKET_NAME/year=*/month=*/*", ("s3://BUCKET_NAME/", "year=*", "month=*/*")),
+        ("s3://BUCKET_NAME/2023/*", ("s3://BUCKET_NAME/2023/", "*", "")),
+        ("s3://BUCKET_NAME/2023/0[1-3]/*", ("s3://BUCKET_NAME/2023/", "0[1-3]", "*")),
+        ("s3://BUCKET_NAME/2023/a.parquet", ("s3://BUCKET_NAME/2023/a.parquet", "", "")),
+    ],
+)
+def test_split_glob(pattern, expected):
+    assert split_glob(pattern) == expected
+
+
+def test_paths_are_listed_by_subprefix(days, scanned, tmp_path):
+    got = ListingCache().paths(source=f"['{days}']")
+
+    assert got == scan_source_for_paths(source=f"'{days}'")
+    assert len(got) == 3
+    assert sorted(scanned) == [f"'{tmp_path}/day={day}/*.parquet'" for day in ["01", "02", "03"]]
+
+
+@pytest.mark.parametrize("listing_ttl_seconds, expected", [(0, 6), (3600, 3)])
+def test_listing_is_cached(days, scanned, listing_ttl_seconds, expected, monkeypatch):
+    monkeypatch.setattr(DuckConfig().session, "listing_ttl_seconds", listing_ttl_seconds)
+    listings = ListingCache()
+
+    assert listings.paths(source=days) == listings.paths(source=days)
+    assert len(scanned) == expected
+    assert len(listings) == (listing_ttl_seconds > 0)
+
+
+def test_listing_is_refreshed_incrementally(days, scanned, tmp_path, monkeypatch):
+    monkeypatch.setattr(DuckConfig().session, "listing_incremental", True)
+    listings = ListingCache()
+    listings.paths(source=days)
+
+    # Only the last day seen and the days after it are listed again
+    write_event(tmp_path, day="01", name="b")
+    write_event(tmp_path, day="03", name="b")
+    write_event(tmp_path, day="04", name="a")
+    scanned.clear()
+
+    got = [path[len(f"{tmp_path}/") :] for path in listings.paths(source=days)]
+
+    assert got == [
+        "day=01/a.parquet",
+        "day=02/a.parquet",
+        "day=03/a.parquet",
+        "day=03/b.parquet",
+        "day=04/a.parquet",
+    ]
+    assert len(scanned) == 2
+
+
+def test_paths_of_globs_and_files(days, scanned, tmp_path):
+    files = [f"{tmp_path}/day={day}/a.parquet" for day in ["01", "02", "03"]]
+    source = str([f"{tmp_path}/day=0[12]/*.parquet", f"{tmp_path}/day=03/*.parquet", *files])
+
+    got = ListingCache().paths(source=source)
+
+    # A glob per sub-prefix matching each glob, while the files are listed at once
+    assert got == files
+    assert len(scanned) == 4
+    assert str(files) in scanned
@@ -86,3 +86,38 @@ def test_remove_newlines_and_tabs(query, expected):
     got = Query.parse(query=query).sql
 
     assert got == expected
+
+
+@pytest.mark.parametrize(
+    "query, expected",
+    [
+        (
+            "SELECT * FROM read_parquet(['s3://BUCKET_NAME/*/*/*']) WHERE year=2023 AND month='05'",
+            [("year", "=", [2023.0]), ("month", "=", ["05"])],
+        ),
+        (
+            "SELECT * FROM read_parquet(['s3://BUCKET_NAME/*/*']) AS t "
+            "WHERE 2022 < t.year AND month IN (1, 2) AND x + 1 > 2 OR y = 1",
+            [],
+        ),
+        (
+            "SELECT * FROM read_parquet(['s3://BUCKET_NAME/*/*']) AS t "
+            "WHERE 2022 < t.year AND month IN (1, 2) AND x + 1 > 2 AND y IS NULL AND NOT z IS NULL",
+            [
+                ("year", ">", [2022.0]),
+                ("month", "IN", [1.0, 2.0]),
+                ("y", "IS NULL", []),
+                ("z", "IS NOT NULL", []),
+            ],
+        ),
+        (
+            "SELECT * FROM read_parquet(['s3://BUCKET_NAME/*/*']) AS t "
+            "JOIN read_parquet(['s3://BUCKET_NAME/b/*']) AS u ON t.id = u.id WHERE year = 2023",
+            [],
+        ),
+    ],
+)
+def test_source_filters(query, expected):
+    got = Query.parse(query).source_filters
+
+    assert got == expected
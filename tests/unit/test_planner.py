@@ -1,5 +1,856 @@
+import ast
+import os
+import re
+
+import duckdb
 import pytest
 
-from duckingit._exceptions import WrongInvokationType
+from duckingit._config import DuckConfig
 from duckingit._parser import Query
-from duckingit._planner import Plan, Task
+from duckingit._planner import Plan, PlanCache, Stages, Task
+
+MB = 1024**2
+
+
+@pytest.fixture
+def row_groups(monkeypatch):
+    row_groups = [("s3://BUCKET_NAME/2023/01/hot.parquet", i, 1000, 50 * MB) for i in range(6)]
+    row_groups += [(f"s3://BUCKET_NAME/2023/02/{i}.parquet", 0, 100, 10 * MB) for i in range(10)]
+    monkeypatch.setattr("duckingit._parser.scan_source_parquet_metadata", lambda source: row_groups)
+    yield row_groups
+
+
+@pytest.fixture
+def plan():
+    yield Plan.from_query(Query.parse("SELECT * FROM READ_PARQUET(['s3://BUCKET_NAME/2023/*'])"))
+
+
+@pytest.mark.parametrize("max_invokations, expected", [("auto", 4), (1, 1), (100, 4)])
+def test_create_tasks_balanced_by_size(row_groups, plan, max_invokations, expected, monkeypatch):
+    monkeypatch.setattr(DuckConfig().session, "max_invokations", max_invokations)
+    monkeypatch.setattr(DuckConfig().session, "bytes_per_invokation", 128 * MB)
+
+    plan.root.create_tasks()
+
+    assert len(plan.root.tasks) == expected
+    # The hot file is never scanned together with the other files
+    hot = [task for task in plan.root.tasks if "hot.parquet" in task.subquery]
+    assert all("02/0.parquet" not in task.subquery for task in hot) or expected == 1
+
+
+def test_create_tasks_splits_large_file_by_row_groups(row_groups, plan, monkeypatch):
+    monkeypatch.setattr(DuckConfig().session, "max_invokations", "auto")
+    monkeypatch.setattr(DuckConfig().session, "bytes_per_invokation", 128 * MB)
+
+    plan.root.create_tasks()
+
+    hot = sorted(task.subquery for task in plan.root.tasks if "hot.parquet" in task.subquery)
+    assert len(hot) == 3
+    assert "file_row_number BETWEEN 0 AND 1999" in hot[0]
+    assert "file_row_number BETWEEN 2000 AND 3999" in hot[1]
+    assert "file_row_number BETWEEN 4000 AND 5999" in hot[2]
+
+
+def test_create_tasks_by_prefix_for_json(monkeypatch):
+    monkeypatch.setattr(DuckConfig().session, "max_invokations", "auto")
+    monkeypatch.setattr(
+        "duckingit._parser.LISTINGS.prefixes",
+        lambda source: ["s3://BUCKET_NAME/2023/01/*", "s3://BUCKET_NAME/2023/02/*"],
+    )
+
+    query = Query.parse("SELECT * FROM READ_JSON_AUTO(['s3://BUCKET_NAME/2023/*'])")
+    plan = Plan.from_query(query)
+    plan.root.create_tasks()
+
+    assert query.format == "json"
+    assert len(plan.root.tasks) == 2
+    assert all("READ_JSON_AUTO" in task.subquery for task in plan.root.tasks)
+
+
+def test_task_scans_range_of_rows(tmp_path):
+    path = str(tmp_path / "data.parquet")
+    duckdb.sql(
+        f"COPY (SELECT range AS x FROM range(1000)) TO '{path}' (FORMAT PARQUET, ROW_GROUP_SIZE 100)"
+    )
+
+    query = Query.parse(f"SELECT x FROM READ_PARQUET(['{path}']) WHERE x % 2 = 0")
+    task = Task.create(query=query, files=[path], rows=(200, 399))
+
+    got = duckdb.sql(task.subquery).fetchall()
+    assert sorted(got) == [(x,) for x in range(200, 400, 2)]
+
+
+@pytest.fixture
+def sales(tmp_path):
+    for i in range(3):
+        duckdb.sql(f"""COPY (
+                SELECT range % 7 AS shop, range * {i + 1} AS amount, range % 3 = 0 AS returned
+                FROM range(100)
+            ) TO '{tmp_path}/sales_{i}.parquet' (FORMAT PARQUET)""")
+    yield f"{tmp_path}/sales_*.parquet"
+
+
+@pytest.mark.parametrize(
+    "sql",
+    [
+        "SELECT shop, SUM(amount) AS total, AVG(amount), COUNT(*) AS n FROM {source} GROUP BY shop",
+        "SELECT MIN(amount), MAX(amount), BOOL_OR(returned) AS any_returned FROM {source}",
+        "SELECT shop, COUNT(amount) AS n FROM {source} WHERE NOT returned GROUP BY shop "
+        "HAVING SUM(amount) > 1000 ORDER BY n DESC, shop LIMIT 3",
+        "WITH s AS (SELECT shop, amount FROM {source} WHERE amount > 50) "
+        "SELECT shop, SUM(amount) + 1 AS total FROM s GROUP BY shop",
+    ],
+)
+def test_two_phase_aggregation(sales, sql, ExecutePlanLocally, monkeypatch):
+    monkeypatch.setattr(DuckConfig().session, "max_invokations", "auto")
+    monkeypatch.setattr(DuckConfig().session, "bytes_per_invokation", 1)
+
+    sql = sql.format(source=f"READ_PARQUET(['{sales}'])")
+    plan = Plan.from_query(Query.parse(sql))
+
+    # The partial aggregation is scanned by an invokation per file
+    scans = [stage for stage in plan.dag if stage.stage_type == Stages.SCAN]
+    assert len(scans) == 1
+    assert "__agg_0" in scans[0].sql
+
+    got = ExecutePlanLocally(plan)
+    assert len(scans[0].tasks) == 3
+
+    expected = duckdb.sql(sql).fetchall()
+    if "ORDER BY" in sql:
+        assert got == expected
+    else:
+        assert sorted(got) == sorted(expected)
+
+
+@pytest.mark.parametrize(
+    "sql",
+    [
+        "SELECT COUNT(*) FROM (SELECT DISTINCT shop FROM {source})",
+        "SELECT COUNT(*) FROM (SELECT * FROM {source} LIMIT 10)",
+        "SELECT COUNT(*) FROM (SELECT * FROM {source} LIMIT 10 OFFSET 295)",
+        "SELECT SUM(amount) FROM (SELECT * FROM {source} ORDER BY amount DESC LIMIT 5)",
+        "SELECT MAX(n) FROM (SELECT ROW_NUMBER() OVER (PARTITION BY shop) AS n FROM {source})",
+        "SELECT COUNT(*) FROM (SELECT shop FROM {source} QUALIFY "
+        "ROW_NUMBER() OVER (PARTITION BY shop ORDER BY amount) = 1)",
+    ],
+)
+def test_aggregation_is_not_merged_into_scan_of_whole_source(
+    sales, sql, ExecutePlanLocally, monkeypatch
+):
+    monkeypatch.setattr(DuckConfig().session, "max_invokations", "auto")
+    monkeypatch.setattr(DuckConfig().session, "bytes_per_invokation", 1)
+
+    sql = sql.format(source=f"READ_PARQUET(['{sales}'])")
+    plan = Plan.from_query(Query.parse(sql))
+
+    assert not any("__agg_" in stage.sql for stage in plan.dag)
+    assert ExecutePlanLocally(plan) == duckdb.sql(sql).fetchall()
+
+
+@pytest.mark.parametrize(
+    "sql",
+    [
+        "SELECT shop, COUNT(DISTINCT amount) FROM READ_PARQUET(['s3://BUCKET_NAME/2023/*']) "
+        "GROUP BY shop",
+        "SELECT shop, MEDIAN(amount) FROM READ_PARQUET(['s3://BUCKET_NAME/2023/*']) GROUP BY shop",
+        "SELECT shop, SUM(amount) FROM READ_PARQUET(['s3://BUCKET_NAME/2023/*']) GROUP BY 1",
+    ],
+)
+def test_non_decomposable_aggregation_is_not_split(sql):
+    plan = Plan.from_query(Query.parse(sql))
+
+    assert len(plan.dag) == 1
+    assert plan.root.stage_type == Stages.AGGREGATE
+
+
+@pytest.mark.parametrize(
+    "sql",
+    [
+        "SELECT shop, SUM(amount) AS total, AVG(amount) FROM {source} GROUP BY shop",
+        "SELECT shop, returned, COUNT(*) AS n FROM {source} GROUP BY shop, returned "
+        "HAVING n > 10",
+        "SELECT shop, SUM(amount) AS total FROM {source} GROUP BY shop "
+        "ORDER BY total DESC LIMIT 3",
+        "WITH s AS (SELECT shop, MAX(amount) AS top FROM {source} GROUP BY shop) "
+        "SELECT MIN(top) FROM s",
+    ],
+)
+def test_shuffled_aggregation(sales, sql, ExecutePlanLocally, monkeypatch):
+    monkeypatch.setattr(DuckConfig().session, "max_invokations", "auto")
+    monkeypatch.setattr(DuckConfig().session, "bytes_per_invokation", 1)
+    monkeypatch.setattr(DuckConfig().session, "shuffle_partitions", 4)
+
+    sql = sql.format(source=f"READ_PARQUET(['{sales}'])")
+    plan = Plan.from_query(Query.parse(sql))
+
+    scans = [stage for stage in plan.dag if stage.partitions == 4]
+    assert len(scans) == 1
+
+    got = ExecutePlanLocally(plan)
+    # A reducer per partition merges the partial aggregates of every scan
+    reducers = [stage for stage in plan.dag if scans[0] in stage.dependencies]
+    assert len(reducers[0].tasks) == 4
+
+    expected = duckdb.sql(sql).fetchall()
+    if "ORDER BY" in sql:
+        assert got == expected
+    else:
+        assert sorted(got) == sorted(expected)
+
+
+@pytest.fixture
+def shops(tmp_path):
+    path = f"{tmp_path}/shops.parquet"
+    duckdb.sql(
+        f"COPY (SELECT range AS shop, 'shop-' || range AS name FROM range(5)) TO '{path}' "
+        "(FORMAT PARQUET)"
+    )
+    yield path
+
+
+@pytest.mark.parametrize(
+    "sql, probe",
+    [
+        (
+            "SELECT s.shop, s.amount, h.name FROM {sales} s JOIN {shops} h ON s.shop = h.shop",
+            "s",
+        ),
+        ("SELECT h.name, s.amount FROM {shops} h JOIN {sales} s ON h.shop = s.shop", "s"),
+        ("SELECT s.amount, h.name FROM {sales} s LEFT JOIN {shops} h ON s.shop = h.shop", "s"),
+    ],
+)
+def test_broadcast_join(sales, shops, sql, probe, ExecutePlanLocally, monkeypatch):
+    monkeypatch.setattr(DuckConfig().session, "max_invokations", "auto")
+    monkeypatch.setattr(DuckConfig().session, "bytes_per_invokation", 1)
+
+    sql = sql.format(sales=f"READ_PARQUET(['{sales}'])", shops=f"READ_PARQUET(['{shops}'])")
+    plan = Plan.from_query(Query.parse(sql))
+
+    assert len(plan.dag) == 1
+    assert plan.root.probe.endswith(f"AS {probe}")
+
+    got = ExecutePlanLocally(plan)
+    # The probe side is split by file, while every task reads the build side
+    assert len(plan.root.tasks) == 3
+    assert sorted(got, key=str) == sorted(duckdb.sql(sql).fetchall(), key=str)
+
+
+@pytest.mark.parametrize(
+    "sql",
+    [
+        "SELECT s.shop, s.amount, h.name FROM {sales} s JOIN {shops} h ON s.shop = h.shop",
+        "SELECT h.name, s.amount FROM {shops} h LEFT JOIN {sales} s "
+        "ON h.shop = s.shop AND s.amount > 100",
+        "WITH s AS (SELECT shop, amount FROM {sales} WHERE returned), h AS (SELECT * FROM {shops}) "
+        "SELECT * FROM s FULL OUTER JOIN h USING (shop)",
+    ],
+)
+def test_shuffle_join(sales, shops, sql, ExecutePlanLocally, monkeypatch):
+    monkeypatch.setattr(DuckConfig().session, "max_invokations", "auto")
+    monkeypatch.setattr(DuckConfig().session, "bytes_per_invokation", 1)
+    monkeypatch.setattr(DuckConfig().session, "broadcast_threshold_bytes", 0)
+    monkeypatch.setattr(DuckConfig().session, "shuffle_partitions", 3)
+
+    sql = sql.format(sales=f"READ_PARQUET(['{sales}'])", shops=f"READ_PARQUET(['{shops}'])")
+    plan = Plan.from_query(Query.parse(sql))
+
+    assert all(dependency.partitions == 3 for dependency in plan.root.dependencies)
+    assert len(plan.root.dependencies) == 2
+
+    got = ExecutePlanLocally(plan)
+    # A task per pair of partitions
+    assert len(plan.root.tasks) == 3
+    assert sorted(got, key=str) == sorted(duckdb.sql(sql).fetchall(), key=str)
+
+
+@pytest.mark.parametrize("broadcast", [True, False])
+@pytest.mark.parametrize(
+    "sql",
+    [
+        "SELECT COUNT(*) FROM {sales} s JOIN {shops} h ON s.shop = h.shop",
+        "SELECT h.name, COUNT(*) AS n, SUM(s.amount) FROM {sales} s JOIN {shops} h "
+        "ON s.shop = h.shop GROUP BY h.name",
+        "SELECT s.amount, h.name FROM {sales} s JOIN {shops} h ON s.shop = h.shop "
+        "ORDER BY s.amount DESC, h.name LIMIT 3",
+        "SELECT DISTINCT h.name FROM {sales} s JOIN {shops} h ON s.shop = h.shop",
+    ],
+)
+def test_join_is_split_from_aggregation_sort_and_limit(
+    sales, shops, sql, broadcast, ExecutePlanLocally, monkeypatch
+):
+    monkeypatch.setattr(DuckConfig().session, "max_invokations", "auto")
+    monkeypatch.setattr(DuckConfig().session, "bytes_per_invokation", 1)
+    monkeypatch.setattr(DuckConfig().session, "shuffle_partitions", 3)
+    if not broadcast:
+        monkeypatch.setattr(DuckConfig().session, "broadcast_threshold_bytes", 0)
+
+    sql = sql.format(sales=f"READ_PARQUET(['{sales}'])", shops=f"READ_PARQUET(['{shops}'])")
+    plan = Plan.from_query(Query.parse(sql))
+
+    join = next(iter(plan.root.dependencies))
+    assert join.stage_type == Stages.JOIN
+    assert join.probe != "" if broadcast else join.probe == ""
+
+    got = ExecutePlanLocally(plan)
+    # The joined rows are split across tasks, while a single task aggregates, sorts or limits
+    assert len(join.tasks) == 3
+    assert len(plan.root.tasks) == 1
+
+    expected = duckdb.sql(sql).fetchall()
+    if "ORDER BY" in sql:
+        assert got == expected
+    else:
+        assert sorted(got, key=str) == sorted(expected, key=str)
+
+
+def test_self_join_is_not_broadcast(sales, ExecutePlanLocally, monkeypatch):
+    monkeypatch.setattr(DuckConfig().session, "max_invokations", "auto")
+    monkeypatch.setattr(DuckConfig().session, "bytes_per_invokation", 1)
+
+    sql = (
+        f"WITH s AS (SELECT * FROM READ_PARQUET(['{sales}'])) "
+        "SELECT x.amount, y.amount FROM s x JOIN s y ON x.shop = y.shop AND x.amount = y.amount"
+    )
+    plan = Plan.from_query(Query.parse(sql))
+
+    # Both sides read the same stage, thus a task cannot join a part of it with itself
+    join = next(stage for stage in plan.dag if stage.stage_type == Stages.JOIN)
+    assert join.probe == ""
+
+    got = ExecutePlanLocally(plan)
+    assert sorted(got, key=str) == sorted(duckdb.sql(sql).fetchall(), key=str)
+
+
+@pytest.fixture
+def numbers(tmp_path):
+    for i in range(3):
+        duckdb.sql(f"""COPY (
+                SELECT CASE WHEN range % 10 = 0 THEN NULL ELSE (range * {i + 7}) % 101 END AS v,
+                    range % 5 AS w
+                FROM range(200)
+            ) TO '{tmp_path}/numbers_{i}.parquet' (FORMAT PARQUET)""")
+    yield f"READ_PARQUET(['{tmp_path}/numbers_*.parquet'])"
+
+
+@pytest.mark.parametrize(
+    "sql",
+    [
+        "SELECT v FROM {source} ORDER BY v DESC LIMIT 5",
+        "SELECT w, v FROM {source} WHERE v > 10 ORDER BY w, v LIMIT 7 OFFSET 3",
+        "SELECT v * 2 AS double FROM {source} ORDER BY double DESC NULLS FIRST LIMIT 4",
+        "SELECT v FROM (SELECT * FROM {source} WHERE w = 1) ORDER BY v LIMIT 5",
+    ],
+)
+def test_top_n_sort(numbers, sql, ExecutePlanLocally, monkeypatch):
+    monkeypatch.setattr(DuckConfig().session, "max_invokations", "auto")
+    monkeypatch.setattr(DuckConfig().session, "bytes_per_invokation", 1)
+
+    sql = sql.format(source=numbers)
+    plan = Plan.from_query(Query.parse(sql))
+
+    assert len(plan.dag) == 2
+    scan = next(iter(plan.root.dependencies))
+    assert "LIMIT" in scan.sql
+
+    got = ExecutePlanLocally(plan)
+    # Each task scans a file, and the final sort merges the rows of each task
+    assert len(scan.tasks) == 3
+    assert got == duckdb.sql(sql).fetchall()
+
+
+@pytest.mark.parametrize(
+    "sql",
+    [
+        "SELECT v FROM {source} ORDER BY v",
+        "SELECT v, w FROM {source} ORDER BY v DESC, w",
+        "SELECT w, v + 1 AS u FROM {source} WHERE w > 0 ORDER BY u DESC NULLS FIRST, 1",
+        "SELECT w FROM {source} ORDER BY v, w",
+    ],
+)
+def test_range_partitioned_sort(numbers, sql, ExecutePlanLocally, monkeypatch):
+    monkeypatch.setattr(DuckConfig().session, "max_invokations", "auto")
+    monkeypatch.setattr(DuckConfig().session, "bytes_per_invokation", 1)
+    monkeypatch.setattr(DuckConfig().session, "shuffle_partitions", 4)
+
+    sql = sql.format(source=numbers)
+    plan = Plan.from_query(Query.parse(sql))
+
+    # Sample, boundaries, partitions by range and a sort per partition
+    assert len(plan.dag) == 4
+    assert next(iter(plan.root.dependencies)).partitions == 4
+
+    got = ExecutePlanLocally(plan)
+    # The sorted partitions are in order, i.e. the parts of the output need no merge
+    assert len(plan.root.tasks) == 4
+    assert got == duckdb.sql(sql).fetchall()
+
+
+@pytest.mark.parametrize(
+    "sql, rows",
+    [
+        ("SELECT v FROM {source} LIMIT 20", 20),
+        ("SELECT w, v FROM {source} WHERE v > 10 LIMIT 7 OFFSET 3", 7),
+        ("SELECT v + 1 AS u FROM (SELECT * FROM {source} WHERE w = 1) LIMIT 5", 5),
+        ("SELECT v FROM {source} LIMIT 1000", 600),
+    ],
+)
+def test_limit(numbers, sql, rows, ExecutePlanLocally, monkeypatch):
+    monkeypatch.setattr(DuckConfig().session, "max_invokations", "auto")
+    monkeypatch.setattr(DuckConfig().session, "bytes_per_invokation", 1)
+
+    sql = sql.format(source=numbers)
+    plan = Plan.from_query(Query.parse(sql))
+
+    assert len(plan.dag) == 2
+    scan = next(iter(plan.root.dependencies))
+    assert scan.limit > 0 and f"LIMIT {scan.limit}" in scan.sql
+
+    got = ExecutePlanLocally(plan)
+    # Each task scans a file, and the final task limits the rows of all tasks
+    assert len(scan.tasks) == 3
+    assert len(got) == rows
+    assert set(got) <= set(duckdb.sql(sql.split(" LIMIT")[0]).fetchall())
+
+
+@pytest.fixture
+def readings(tmp_path):
+    for i in range(20):
+        duckdb.sql(f"""COPY (
+                SELECT range AS v, range % 5 AS w FROM range({i * 100}, {i * 100 + 100})
+            ) TO '{tmp_path}/readings_{i:02}.parquet' (FORMAT PARQUET)""")
+    yield f"READ_PARQUET(['{tmp_path}/readings_*.parquet'])"
+
+
+def test_sample(readings, tmp_path, ExecutePlanLocally, monkeypatch):
+    monkeypatch.setattr(DuckConfig().session, "max_invokations", "auto")
+    monkeypatch.setattr(DuckConfig().session, "bytes_per_invokation", 1)
+    monkeypatch.setattr(DuckConfig().session, "shuffle_partitions", 0)
+
+    sql = (
+        f"SELECT w, COUNT(*) AS n, SUM(v) AS total, MAX(v), AVG(v) AS mean FROM {readings} "
+        "GROUP BY w ORDER BY w"
+    )
+    plan = Plan.from_query(Query.parse(sql), sample=0.25)
+
+    scan = next(iter(plan.root.dependencies))
+    assert scan.sample == 0.25
+    assert plan.metadata is None
+
+    got = ExecutePlanLocally(plan)
+    # A task per sampled file, whose counts and sums are scaled up by the sample
+    assert len(scan.tasks) == 5
+    assert len(got) == 5
+    for w, n, total, _, _, n_low, n_high, total_low, total_high in got:
+        assert n == n_low == n_high == 400
+        assert total_low < total < total_high
+
+    files = [re.search(r"'([^']+readings_\d+\.parquet)'", t.subquery).group(1) for t in scan.tasks]
+    sampled = duckdb.sql(f"SELECT SUM(v) FROM READ_PARQUET({files})")
+    assert sum(row[2] for row in got) == 4 * sampled.fetchone()[0]
+
+    # The mean is a ratio of sums, which the scale cancels out of
+    means = duckdb.sql(f"SELECT w, AVG(v) FROM READ_PARQUET({files}) GROUP BY w ORDER BY w")
+    assert [(row[0], row[4]) for row in got] == means.fetchall()
+
+
+@pytest.mark.parametrize("sample", [0, -0.5, 1.5])
+def test_sample_must_be_a_share(sample):
+    with pytest.raises(ValueError):
+        Plan.from_query(Query.parse("SELECT * FROM READ_PARQUET(['s3://BUCKET_NAME/*'])"), sample)
+
+
+@pytest.mark.parametrize(
+    "sql, concatenated",
+    [
+        ("SELECT shop, amount FROM {sales} UNION ALL SELECT w, v FROM {numbers}", True),
+        ("SELECT * FROM {sales} UNION ALL SELECT * FROM {sales} WHERE returned", True),
+        (
+            "SELECT amount FROM {sales} UNION ALL SELECT v FROM {numbers} "
+            "UNION ALL SELECT amount * 2 FROM {sales} ORDER BY amount DESC LIMIT 5",
+            True,
+        ),
+        ("SELECT * FROM {sales} UNION ALL SELECT shop, amount, true FROM {sales}", False),
+        (
+            "SELECT SUM(amount) AS total FROM ("
+            "SELECT shop, amount FROM {sales} UNION ALL SELECT w, v FROM {numbers}) t",
+            True,
+        ),
+    ],
+)
+def test_union_all(sales, numbers, sql, concatenated, ExecutePlanLocally, monkeypatch):
+    monkeypatch.setattr(DuckConfig().session, "max_invokations", "auto")
+    monkeypatch.setattr(DuckConfig().session, "bytes_per_invokation", 1)
+
+    sql = sql.format(sales=f"READ_PARQUET(['{sales}'])", numbers=numbers)
+    plan = Plan.from_query(Query.parse(sql))
+
+    unions = [stage for stage in plan.dag if stage.stage_type == Stages.UNION]
+    assert len(unions) == 1
+    assert (len(unions[0].branches) > 0) == concatenated
+
+    got = ExecutePlanLocally(plan)
+    # The output of the branches is concatenated without a task of its own
+    assert (len(unions[0].tasks) == 0) == concatenated
+    if "ORDER BY" in sql:
+        assert got == duckdb.sql(sql).fetchall()
+    else:
+        assert sorted(got, key=str) == sorted(duckdb.sql(sql).fetchall(), key=str)
+
+
+@pytest.mark.parametrize("partitions", [0, 3])
+def test_union(sales, numbers, partitions, ExecutePlanLocally, monkeypatch):
+    monkeypatch.setattr(DuckConfig().session, "max_invokations", "auto")
+    monkeypatch.setattr(DuckConfig().session, "bytes_per_invokation", 1024**3)
+    monkeypatch.setattr(DuckConfig().session, "shuffle_partitions", partitions)
+
+    sql = (
+        f"SELECT shop, amount % 10 AS amount FROM READ_PARQUET(['{sales}']) "
+        f"UNION SELECT w, v % 10 FROM {numbers}"
+    )
+    plan = Plan.from_query(Query.parse(sql))
+
+    # Each branch deduplicates its rows before the union
+    assert all("DISTINCT" in branch.sql for branch in plan.root.dependencies)
+
+    got = ExecutePlanLocally(plan)
+    assert len(plan.root.tasks) == max(partitions, 1)
+    assert sorted(got, key=str) == sorted(duckdb.sql(sql).fetchall(), key=str)
+
+
+@pytest.mark.parametrize(
+    "sql, concatenated",
+    [
+        ("SELECT shop FROM {sales} UNION ALL SELECT v / 2 FROM {numbers}", True),
+        ("SELECT shop FROM {sales} UNION ALL SELECT 'w-' || w FROM {numbers}", True),
+        ("SELECT * FROM {numbers} UNION ALL SELECT * FROM {swapped}", False),
+        ("SELECT * FROM {numbers} UNION ALL SELECT * FROM {numbers} WHERE w = 1", True),
+    ],
+)
+def test_union_all_coerces_types_of_branches(
+    sales, numbers, sql, concatenated, tmp_path, ExecutePlanLocally, monkeypatch
+):
+    monkeypatch.setattr(DuckConfig().session, "max_invokations", "auto")
+    monkeypatch.setattr(DuckConfig().session, "bytes_per_invokation", 1)
+
+    duckdb.sql(
+        f"COPY (SELECT w, v FROM {numbers}) TO '{tmp_path}/swapped.parquet' (FORMAT PARQUET)"
+    )
+    sql = sql.format(
+        sales=f"READ_PARQUET(['{sales}'])",
+        numbers=numbers,
+        swapped=f"READ_PARQUET(['{tmp_path}/swapped.parquet'])",
+    )
+    plan = Plan.from_query(Query.parse(sql))
+
+    assert (len(plan.root.branches) > 0) == concatenated
+
+    # The columns are matched by position, and their values are of the types of the union
+    got = ExecutePlanLocally(plan)
+    assert sorted(map(str, got)) == sorted(map(str, duckdb.sql(sql).fetchall()))
+
+
+def test_union_is_shuffled_by_types_of_union(sales, numbers, ExecutePlanLocally, monkeypatch):
+    monkeypatch.setattr(DuckConfig().session, "shuffle_partitions", 3)
+
+    sql = (
+        f"SELECT shop FROM READ_PARQUET(['{sales}']) "
+        f"UNION SELECT CAST(w AS DOUBLE) FROM {numbers}"
+    )
+    plan = Plan.from_query(Query.parse(sql))
+
+    # Equal values of different types, e.g. 0 and 0.0, are in the same partition
+    got = ExecutePlanLocally(plan)
+    assert len(plan.root.tasks) == 3
+    assert sorted(map(str, got)) == sorted(map(str, duckdb.sql(sql).fetchall()))
+
+
+def test_intersect_is_not_supported():
+    with pytest.raises(NotImplementedError):
+        Plan.from_query(
+            Query.parse(
+                "SELECT * FROM READ_PARQUET(['s3://BUCKET_NAME/a/*']) "
+                "INTERSECT SELECT * FROM READ_PARQUET(['s3://BUCKET_NAME/b/*'])"
+            )
+        )
+
+
+@pytest.mark.parametrize(
+    "sql, pushed",
+    [
+        (
+            "WITH s AS (SELECT * FROM {sales}) SELECT shop, amount FROM s WHERE amount > 150",
+            "amount > 150",
+        ),
+        (
+            "SELECT t.shop, SUM(t.amount) AS total FROM (SELECT * FROM {sales}) t "
+            "WHERE NOT t.returned GROUP BY t.shop",
+            "NOT returned",
+        ),
+        (
+            "WITH s AS (SELECT shop AS id, amount * 2 AS double FROM {sales}) "
+            "SELECT id, double FROM s WHERE double > 300 AND id <> 3",
+            "amount * 2 > 300 AND shop <> 3",
+        ),
+    ],
+)
+def test_predicate_and_projection_pushdown(sales, sql, pushed, ExecutePlanLocally, monkeypatch):
+    monkeypatch.setattr(DuckConfig().session, "max_invokations", "auto")
+    monkeypatch.setattr(DuckConfig().session, "bytes_per_invokation", 1)
+
+    sql = sql.format(sales=f"READ_PARQUET(['{sales}'])")
+    plan = Plan.from_query(Query.parse(sql))
+
+    # The scan of the source filters its rows and only reads the columns referred to
+    scan = next(stage for stage in plan.dag if "READ_PARQUET" in stage.sql)
+    assert f"WHERE {pushed}" in scan.sql
+    assert "SELECT *" not in scan.sql and "returned" not in scan.sql.split("WHERE")[0]
+
+    got = ExecutePlanLocally(plan)
+    assert sorted(got, key=str) == sorted(duckdb.sql(sql).fetchall(), key=str)
+
+
+def test_predicate_on_null_supplying_side_is_not_pushed(sales, shops, ExecutePlanLocally):
+    sql = (
+        f"WITH h AS (SELECT * FROM READ_PARQUET(['{shops}'])), "
+        f"s AS (SELECT * FROM READ_PARQUET(['{sales}'])) "
+        "SELECT h.name, s.amount FROM h LEFT JOIN s ON h.shop = s.shop "
+        "WHERE h.shop > 1 AND s.amount IS NULL"
+    )
+    plan = Plan.from_query(Query.parse(sql))
+
+    scans = {stage.sql for stage in plan.dag if "READ_PARQUET" in stage.sql}
+    assert any("WHERE shop > 1" in scan for scan in scans)
+    assert not any("IS NULL" in scan for scan in scans)
+
+    got = ExecutePlanLocally(plan)
+    assert sorted(got, key=str) == sorted(duckdb.sql(sql).fetchall(), key=str)
+
+
+@pytest.fixture
+def events(tmp_path):
+    for year, month in [(2022, "05"), (2023, "05"), (2023, "06")]:
+        os.makedirs(f"{tmp_path}/year={year}/month={month}")
+        duckdb.sql(
+            f"COPY (SELECT range AS id, range * {year % 10} AS amount FROM range(10)) "
+            f"TO '{tmp_path}/year={year}/month={month}/events.parquet' (FORMAT PARQUET)"
+        )
+    yield f"{tmp_path}/year=*/month=*/*.parquet"
+
+
+@pytest.mark.parametrize(
+    "sql, expected",
+    [
+        ("SELECT * FROM {events} WHERE year = 2023 AND month = '05'", ["year=2023/month=05"]),
+        (
+            "SELECT id, year FROM {events} WHERE month = 5 AND amount > 10",
+            ["year=2022/month=05", "year=2023/month=05"],
+        ),
+        (
+            "WITH e AS (SELECT * FROM {events}) SELECT SUM(amount) FROM e WHERE year < 2023",
+            ["year=2022/month=05"],
+        ),
+        ("SELECT * FROM {events} WHERE year > 2023", ["year=2022/month=05"]),
+    ],
+)
+def test_hive_partitions_are_pruned(events, sql, expected, ExecutePlanLocally, monkeypatch):
+    monkeypatch.setattr(DuckConfig().session, "max_invokations", "auto")
+    monkeypatch.setattr(DuckConfig().session, "bytes_per_invokation", 1)
+
+    sql = sql.format(events=f"READ_PARQUET(['{events}'])")
+    plan = Plan.from_query(Query.parse(sql))
+
+    got = ExecutePlanLocally(plan)
+
+    # Only the files of the partitions left are scanned, but at least one
+    scan = next(stage for stage in plan.dag if "READ_PARQUET" in stage.sql)
+    scanned = sorted(re.search(r"year=\d+/month=\d+", task.subquery)[0] for task in scan.tasks)
+    assert scanned == expected
+    assert sorted(got, key=str) == sorted(duckdb.sql(sql).fetchall(), key=str)
+
+
+@pytest.mark.parametrize("statistics", [False, True])
+def test_partitions_left_are_listed_by_directory(
+    events, statistics, tmp_path, ExecutePlanLocally, monkeypatch
+):
+    monkeypatch.setattr(DuckConfig().session, "max_invokations", "auto")
+    monkeypatch.setattr(DuckConfig().session, "bytes_per_invokation", 1)
+    if statistics:
+        monkeypatch.setattr(DuckConfig().session, "statistics_path", f"{tmp_path}/statistics")
+
+    sql = f"SELECT * FROM READ_PARQUET(['{events}']) WHERE year = 2023"
+    query = Query.parse(sql)
+
+    # A glob per directory left rather than a list of files, see `ListingCache`
+    assert ast.literal_eval(query.pruned_source) == [
+        f"{tmp_path}/year=2023/month=05/*.parquet",
+        f"{tmp_path}/year=2023/month=06/*.parquet",
+    ]
+
+    got = ExecutePlanLocally(Plan.from_query(query))
+    assert sorted(got, key=str) == sorted(duckdb.sql(sql).fetchall(), key=str)
+
+
+@pytest.mark.parametrize(
+    "sql, expected",
+    [
+        ("SELECT shop, amount FROM {sales} WHERE amount > 200", ["sales_2.parquet"]),
+        (
+            "SELECT shop, SUM(amount) FROM {sales} WHERE amount >= 150 GROUP BY shop",
+            ["sales_1.parquet", "sales_2.parquet"],
+        ),
+        ("SELECT COUNT(*) FROM {sales} WHERE amount > 1000", ["sales_0.parquet"]),
+    ],
+)
+def test_files_are_skipped_by_statistics(
+    sales, sql, expected, tmp_path, ExecutePlanLocally, monkeypatch
+):
+    monkeypatch.setattr(DuckConfig().session, "max_invokations", "auto")
+    monkeypatch.setattr(DuckConfig().session, "bytes_per_invokation", 1)
+    monkeypatch.setattr(DuckConfig().session, "statistics_path", f"{tmp_path}/statistics")
+
+    sql = sql.format(sales=f"READ_PARQUET(['{sales}'])")
+    plan = Plan.from_query(Query.parse(sql))
+
+    got = ExecutePlanLocally(plan)
+
+    # Only the files with values in range are scanned, but at least one
+    scan = next(stage for stage in plan.dag if "READ_PARQUET" in stage.sql)
+    scanned = sorted(re.search(r"sales_\d\.parquet", task.subquery)[0] for task in scan.tasks)
+    assert scanned == expected
+    assert sorted(got, key=str) == sorted(duckdb.sql(sql).fetchall(), key=str)
+
+
+@pytest.mark.parametrize("listing_ttl_seconds, expected", [(0, 2), (3600, 1)])
+def test_plan_cache(row_groups, listing_ttl_seconds, expected, monkeypatch):
+    monkeypatch.setattr(DuckConfig().session, "max_invokations", "auto")
+    monkeypatch.setattr(DuckConfig().session, "bytes_per_invokation", 128 * MB)
+    monkeypatch.setattr(DuckConfig().session, "listing_ttl_seconds", listing_ttl_seconds)
+
+    listings = []
+    monkeypatch.setattr(
+        "duckingit._parser.scan_source_parquet_metadata",
+        lambda source: listings.append(source) or row_groups,
+    )
+    planned = []
+    from_query = Plan.from_query
+    monkeypatch.setattr(
+        Plan,
+        "from_query",
+        lambda query, **kwargs: planned.append(query) or from_query(query, **kwargs),
+    )
+
+    cache = PlanCache()
+    first = cache.get("SELECT * FROM READ_PARQUET(['s3://BUCKET_NAME/2023/*'])")
+    first.root.create_tasks()
+    parsed = dict(first.root._queries)
+    second = cache.get("SELECT *\n  FROM READ_PARQUET(['s3://BUCKET_NAME/2023/*'])")
+    second.root.create_tasks()
+
+    # The query is planned once, but every execution gets a plan of its own
+    assert len(planned) == 1
+    assert first is not second and first.root is not second.root
+    assert first.root.tasks == second.root.tasks
+    assert len(listings) == expected
+    # An expired listing is dropped by the cached plan, not by the forks executing already
+    assert all(first.root._queries[sql] is query for sql, query in parsed.items())
+
+
+def test_plan_cache_keeps_whitespace_of_literals():
+    cache = PlanCache()
+    first = cache.get("SELECT * FROM READ_PARQUET(['s3://BUCKET_NAME/*']) WHERE s = 'a  b'")
+    second = cache.get("SELECT * FROM READ_PARQUET(['s3://BUCKET_NAME/*']) WHERE s = 'a b'")
+
+    assert len(cache) == 2
+    assert "'a  b'" in first.root.sql
+    assert "'a b'" in second.root.sql
+
+
+def test_plan_cache_evicts_least_recently_used(monkeypatch):
+    monkeypatch.setattr(DuckConfig().session, "plan_cache_size", 2)
+
+    cache = PlanCache()
+    queries = [f"SELECT * FROM READ_PARQUET(['s3://BUCKET_NAME/{i}/*'])" for i in range(3)]
+    first = cache.get(queries[0])
+    cache.get(queries[1])
+    cache.get(queries[0])
+    cache.get(queries[2])
+
+    assert len(cache) == 2
+    assert cache.get(queries[0]).query is first.query
+    assert cache.get(queries[1]).query is not first.query
+
+    # Configurations take part in planning, and thus in the key of the cache
+    monkeypatch.setattr(DuckConfig().session, "shuffle_partitions", 4)
+    assert cache.get(queries[0]).query is not first.query
+
+
+@pytest.mark.parametrize(
+    "sql",
+    [
+        "SELECT COUNT(*) FROM {source}",
+        "SELECT COUNT(*) AS n, COUNT(1), COUNT(v) AS m, MIN(v), MAX(v) - MIN(w) AS spread "
+        "FROM {source}",
+        "SELECT MAX(s.w) AS w, MIN(s.v) FROM {source} AS s",
+    ],
+)
+def test_metadata_answers_aggregation(numbers, sql, ExecutePlanLocally):
+    sql = sql.format(source=numbers)
+    plan = Plan.from_query(Query.parse(sql))
+
+    plan.metadata.create_tasks()
+
+    # The answer is a single task of constants, without any scan
+    assert len(plan.metadata.tasks) == 1
+    answer = next(iter(plan.metadata.tasks)).subquery
+    assert "READ_PARQUET" not in answer.upper()
+    assert duckdb.sql(answer).fetchall() == duckdb.sql(sql).fetchall()
+    assert duckdb.sql(answer).types == duckdb.sql(sql).types
+
+
+@pytest.mark.parametrize(
+    "sql",
+    [
+        "SELECT COUNT(*) FROM {source} WHERE v > 1",
+        "SELECT w, COUNT(*) FROM {source} GROUP BY w",
+        "SELECT SUM(v) FROM {source}",
+        "SELECT COUNT(DISTINCT v) FROM {source}",
+        "SELECT MIN(v + 1) FROM {source}",
+        "SELECT MIN(v) FROM {source} LIMIT 0",
+    ],
+)
+def test_metadata_cannot_answer_query(numbers, sql):
+    plan = Plan.from_query(Query.parse(sql.format(source=numbers)))
+
+    assert plan.metadata is None
+
+
+@pytest.mark.parametrize(
+    "sql",
+    [
+        "SELECT MAX(name) FROM READ_PARQUET(['{shops}'])",
+        "SELECT COUNT(*), MIN(year) FROM READ_PARQUET(['{events}'])",
+    ],
+)
+def test_metadata_cannot_answer_from_statistics(shops, events, sql, ExecutePlanLocally):
+    # Strings may have truncated min/max values, and hive partitions have none
+    plan = Plan.from_query(Query.parse(sql.format(shops=shops, events=events)))
+
+    plan.metadata.create_tasks()
+
+    assert len(plan.metadata.tasks) == 0
+
+
+def test_predicate_of_self_join_is_not_pushed(sales, ExecutePlanLocally):
+    sql = (
+        f"WITH s AS (SELECT * FROM READ_PARQUET(['{sales}'])) "
+        "SELECT x.amount, y.amount FROM s x JOIN s y ON x.shop = y.shop WHERE y.amount = 101"
+    )
+    plan = Plan.from_query(Query.parse(sql))
+
+    # The scan is read by both sides of the join, thus the filter of one side isn't pushed
+    scan = next(stage for stage in plan.dag if "READ_PARQUET" in stage.sql)
+    assert "WHERE" not in scan.sql
+
+    got = ExecutePlanLocally(plan)
+    assert sorted(got, key=str) == sorted(duckdb.sql(sql).fetchall(), key=str)
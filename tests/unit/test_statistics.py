@@ -0,0 +1,91 @@
+import duckdb
+import pytest
+
+from duckingit._statistics import StatisticsIndex, may_pass
+
+
+@pytest.fixture
+def readings(tmp_path, monkeypatch):
+    monkeypatch.setattr("duckingit._utils.create_conn_with_httpfs_loaded", duckdb.connect)
+    monkeypatch.setattr("duckingit._statistics.create_conn_with_httpfs_loaded", duckdb.connect)
+
+    (tmp_path / "readings").mkdir()
+    for i in range(3):
+        write_readings(f"{tmp_path}/readings/{i}.parquet", start=i * 100)
+    yield f"'{tmp_path}/readings/*.parquet'"
+
+
+def write_readings(path: str, start: int, rows: int = 100) -> None:
+    duckdb.sql(f"""COPY (
+            SELECT
+                range AS v,
+                'sensor-' || (range % 10) AS sensor,
+                DATE '2023-01-01' + (range // 10)::INT AS day,
+                CASE WHEN range % 2 = 0 THEN range END AS even
+            FROM range({start}, {start + rows})
+        ) TO '{path}' (FORMAT PARQUET)""")
+
+
+@pytest.mark.parametrize(
+    "filters, expected",
+    [
+        ([], [0, 1, 2]),
+        ([("v", ">=", [150.0])], [1, 2]),
+        ([("V", "<", [100.0])], [0]),
+        ([("v", "IN", [5.0, 250.0])], [0, 2]),
+        ([("v", "=", [1000.0])], []),
+        ([("v", "!=", [0.0])], [0, 1, 2]),
+        ([("v", ">", [50.0]), ("v", "<", [150.0])], [0, 1]),
+        ([("day", ">=", ["2023-01-25"])], [2]),
+        ([("day", ">=", ["2023-1-25"])], [0, 1, 2]),
+        ([("sensor", "=", ["sensor-x"])], []),
+        ([("even", "IS NULL", [])], [0, 1, 2]),
+        ([("unknown", "=", [1.0])], [0, 1, 2]),
+    ],
+)
+def test_match(readings, filters, expected, tmp_path):
+    index = StatisticsIndex(path=f"{tmp_path}/statistics", source=readings)
+
+    got = index.match(filters)
+
+    assert got == [f"{tmp_path}/readings/{i}.parquet" for i in expected]
+
+
+def test_refresh_is_incremental(readings, tmp_path):
+    StatisticsIndex(path=f"{tmp_path}/statistics", source=readings).refresh()
+
+    # New, removed and overwritten files are picked up, see `scan_source_for_versions`
+    write_readings(f"{tmp_path}/readings/0.parquet", start=1000, rows=200)
+    write_readings(f"{tmp_path}/readings/3.parquet", start=300)
+    (tmp_path / "readings" / "1.parquet").unlink()
+
+    index = StatisticsIndex(path=f"{tmp_path}/statistics", source=readings)
+    files = [file.split("/")[-1] for file, _, _, _ in index.row_groups()]
+
+    assert files == ["0.parquet", "2.parquet", "3.parquet"]
+    assert index.match([("v", ">=", [1000.0])]) == [f"{tmp_path}/readings/0.parquet"]
+
+
+@pytest.mark.parametrize(
+    "statistics, operator, values, expected",
+    [
+        (("a", 0, 10, "x", "INT64", "1", "5", 0, 80), ">", [5.0], False),
+        (("a", 0, 10, "x", "INT64", "1", "5", 0, 80), ">=", [5.0], True),
+        (("a", 0, 10, "x", "INT64", "1", "5", 0, 80), "IS NULL", [], False),
+        (("a", 0, 10, "x", "INT64", None, None, 10, 80), "=", [1.0], False),
+        (("a", 0, 10, "x", "INT64", None, None, 10, 80), "IS NOT NULL", [], False),
+        (("a", 0, 10, "x", "BYTE_ARRAY", "10", "9", 0, 80), "=", [5.0], True),
+        (("a", 0, 10, "x", "BYTE_ARRAY", "b", "d", 0, 80), "<", ["b"], False),
+        (
+            ("a", 0, 10, "x", "INT64", "2023-01-01 00:00:00", "2023-01-02 00:00:00", 0, 80),
+            "=",
+            ["2023-01-01"],
+            True,
+        ),
+        (None, "=", [1.0], True),
+    ],
+)
+def test_may_pass(statistics, operator, values, expected):
+    got = may_pass(statistics, operator, values)
+
+    assert got == expected
@@ -1,6 +1,17 @@
+import duckdb
 import pytest
 
-from duckingit._utils import ensure_iterable, flatten_list, split_list_in_chunks
+from duckingit._config import DuckConfig
+from duckingit._utils import (
+    create_conn_for_metadata,
+    ensure_iterable,
+    flatten_list,
+    match_hive_partitions,
+    sample_systematically,
+    split_list_in_bins,
+    split_list_in_chunks,
+    split_row_groups_in_ranges,
+)
 
 
 def test_flatten_list():
@@ -41,3 +52,105 @@ def test_split_list_in_chunks(input, invokations, expected):
     got = split_list_in_chunks(input, invokations)
 
     assert got == expected
+
+
+@pytest.mark.parametrize(
+    "input, bins, expected",
+    [
+        ([("a", 10), ("b", 2), ("c", 7), ("d", 1)], 2, [["a"], ["b", "c", "d"]]),
+        ([("a", 10), ("b", 2)], 3, [["a"], ["b"]]),
+        ([("a", 10), ("b", 2)], 0, [["a", "b"]]),
+        ([], 2, []),
+    ],
+)
+def test_split_list_in_bins(input, bins, expected):
+    got = split_list_in_bins(input, bins)
+
+    assert got == expected
+
+
+@pytest.mark.parametrize(
+    "row_groups, max_bytes, expected",
+    [
+        ([(100, 10), (100, 10), (50, 5)], 20, [(0, 199), (200, 249)]),
+        ([(100, 30), (100, 10)], 20, [(0, 99), (100, 199)]),
+        ([(100, 10)], 20, [(0, 99)]),
+        ([], 20, []),
+    ],
+)
+def test_split_row_groups_in_ranges(row_groups, max_bytes, expected):
+    got = split_row_groups_in_ranges(row_groups, max_bytes)
+
+    assert got == expected
+
+
+@pytest.mark.parametrize(
+    "path, filters, expected",
+    [
+        ("s3://BUCKET_NAME/year=2023/month=05/a.parquet", [("year", "=", [2023.0])], True),
+        ("s3://BUCKET_NAME/year=2023/month=05/a.parquet", [("month", "=", [5.0])], True),
+        ("s3://BUCKET_NAME/year=2023/month=05/a.parquet", [("month", "=", ["05"])], True),
+        ("s3://BUCKET_NAME/year=2023/month=05/a.parquet", [("month", "=", ["06"])], False),
+        ("s3://BUCKET_NAME/year=2023/month=05/*", [("YEAR", "IN", [2021.0, 2022.0])], False),
+        ("s3://BUCKET_NAME/year=2023/month=05/*", [("year", ">=", [2023.0])], True),
+        ("s3://BUCKET_NAME/year=2023/month=05/*", [("year", "<", [2023.0])], False),
+        ("s3://BUCKET_NAME/year=2023/month=05/*", [("year", "!=", [2023.0])], False),
+        ("s3://BUCKET_NAME/country=DK/a.parquet", [("country", "=", [1.0])], True),
+        ("s3://BUCKET_NAME/2023/05/a.parquet", [("year", "=", [2022.0])], True),
+        ("s3://BUCKET_NAME/year=2023/a.parquet", [("year", "IS NULL", [])], True),
+        (
+            "s3://BUCKET_NAME/year=2023/a.parquet",
+            [("year", "=", [2023.0]), ("x", "<", [0.0])],
+            True,
+        ),
+    ],
+)
+def test_match_hive_partitions(path, filters, expected):
+    got = match_hive_partitions(path, filters)
+
+    assert got == expected
+
+
+@pytest.mark.parametrize(
+    "items, fraction, expected",
+    [
+        (list(range(100)), 0.1, 10),
+        (list(range(100)), 0.05, 5),
+        (list(range(10)), 1.0, 10),
+        (list(range(3)), 0.1, 1),
+        ([], 0.5, 0),
+    ],
+)
+def test_sample_systematically(items, fraction, expected):
+    got = sample_systematically(items, fraction, seed="source")
+
+    assert len(got) == expected
+    assert got == sorted(set(got))
+    # Repeatable by the seed
+    assert got == sample_systematically(items, fraction, seed="source")
+
+
+@pytest.mark.parametrize("listing_ttl_seconds, cached", [(0, "false"), (3600, "true")])
+def test_create_conn_for_metadata(listing_ttl_seconds, cached, monkeypatch):
+    created = []
+
+    def connect():
+        created.append(duckdb.connect())
+        return created[-1]
+
+    monkeypatch.setattr("duckingit._utils.create_conn_with_httpfs_loaded", connect)
+    monkeypatch.setattr(DuckConfig().session, "listing_ttl_seconds", listing_ttl_seconds)
+
+    first, second = create_conn_for_metadata(), create_conn_for_metadata()
+    got = second.sql(
+        "SELECT value FROM duckdb_settings() WHERE name = 'enable_http_metadata_cache'"
+    ).fetchall()
+
+    assert len(created) == 1
+    assert got == [(cached,)]
+    assert first.sql("SELECT 1").fetchall() == [(1,)]
+
+    # The connection is renewed once the TTL changes
+    monkeypatch.setattr(DuckConfig().session, "listing_ttl_seconds", listing_ttl_seconds + 1)
+    create_conn_for_metadata()
+    assert len(created) == 2